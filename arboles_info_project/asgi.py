@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'arboles_info_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Importar tras inicializar Django, ya que depende de settings
+from maps.lifecycle import LifespanMiddleware  # noqa: E402
+
+application = LifespanMiddleware(django_application)
@@ -43,8 +43,16 @@ INSTALLED_APPS = [
     'maps',
 ]
 
+# Todos los middleware deben admitir modo asíncrono (ver maps/checks.py): bajo
+# ASGI uno solo síncrono haría que las vistas asíncronas ocupen un hilo por
+# petición. Los de Django ejecutan sus hooks con sync_to_async y solo tocan la
+# base de datos (sesiones, mensajes) en las páginas que las usan, como /admin/;
+# CompressionMiddleware es nativo asíncrono.
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'maps.middleware.StaticFilesMiddleware',
+    'maps.middleware.MetricsMiddleware',
+    'maps.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -124,6 +132,16 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# collectstatic genera nombres con el hash del contenido y copias .gz/.br (ver maps/staticfiles.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'maps.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -163,6 +181,114 @@ LOGGING = {
     },
 }
 
+# API de Overpass
+OVERPASS_URL = os.environ.get('OVERPASS_URL', 'https://overpass-api.de/api/interpreter')
+# Servidores entre los que repartir las consultas, separados por comas (por defecto solo OVERPASS_URL)
+OVERPASS_URLS = [url.strip() for url in os.environ.get('OVERPASS_URLS', OVERPASS_URL).split(',') if url.strip()]
+# Cobertura: si un servidor tarda más que su p90, repetir la consulta en otro y usar la primera respuesta
+OVERPASS_HEDGE = os.environ.get('OVERPASS_HEDGE', 'False') == 'True'
+OVERPASS_HEDGE_MIN_DELAY = float(os.environ.get('OVERPASS_HEDGE_MIN_DELAY', '0.5'))  # segundos
+
+# Planificador de consultas a Overpass (ver maps/upstream.py), por proceso y servidor
+OVERPASS_MAX_CONCURRENT = int(os.environ.get('OVERPASS_MAX_CONCURRENT', '4'))  # consultas simultáneas
+OVERPASS_RATE = float(os.environ.get('OVERPASS_RATE', '2'))  # consultas/s, se reduce con cada 429
+OVERPASS_BURST = int(os.environ.get('OVERPASS_BURST', '4'))
+OVERPASS_MIN_RATE = float(os.environ.get('OVERPASS_MIN_RATE', '0.1'))
+OVERPASS_QUEUE_TIMEOUT = float(os.environ.get('OVERPASS_QUEUE_TIMEOUT', '30'))  # espera máxima en cola, segundos
+OVERPASS_BREAKER_THRESHOLD = int(os.environ.get('OVERPASS_BREAKER_THRESHOLD', '5'))  # fallos seguidos para abrir
+OVERPASS_BREAKER_RESET = float(os.environ.get('OVERPASS_BREAKER_RESET', '30'))  # segundos con el circuito abierto
+OVERPASS_MAX_RETRY_WAIT = float(os.environ.get('OVERPASS_MAX_RETRY_WAIT', '10'))  # Retry-After mayor: no reintentar
+
+# Pool de conexiones HTTP compartido para Overpass
+OVERPASS_HTTP_MAX_CONNECTIONS = int(os.environ.get('OVERPASS_HTTP_MAX_CONNECTIONS', '20'))
+OVERPASS_HTTP_MAX_KEEPALIVE = int(os.environ.get('OVERPASS_HTTP_MAX_KEEPALIVE', '10'))
+OVERPASS_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('OVERPASS_HTTP_KEEPALIVE_EXPIRY', '30'))  # segundos
+# HTTP/2 requiere instalar el extra opcional: pip install 'httpx[http2]'
+OVERPASS_HTTP2 = os.environ.get('OVERPASS_HTTP2', 'False') == 'True'
+
+# Fuente de datos de árboles y tocones:
+# 'overpass' (en vivo), 'local' (almacén importado con import_osm) o
+# 'local+overpass' (almacén local y Overpass para las áreas no importadas)
+MAPS_DATA_SOURCE = os.environ.get('MAPS_DATA_SOURCE', 'overpass')
+LOCAL_STORE_PATH = os.environ.get('LOCAL_STORE_PATH', str(BASE_DIR / 'osm_trees.sqlite3'))
+# Segundos entre lecturas de la versión de los datos del almacén: los diffs aplicados llegan a los workers con este retraso
+LOCAL_STORE_CHECK_INTERVAL = float(os.environ.get('LOCAL_STORE_CHECK_INTERVAL', '1'))
+
+# Caché de teselas para las consultas a Overpass
+# Las consultas se dividen en teselas z/x/y fijas que se cachean por separado
+TILE_CACHE_ZOOM = int(os.environ.get('TILE_CACHE_ZOOM', '15'))
+TILE_CACHE_TTL = int(os.environ.get('TILE_CACHE_TTL', '3600'))  # segundos
+# Tiempo extra que se conservan las teselas caducadas para servirlas si Overpass falla
+TILE_CACHE_STALE_TTL = int(os.environ.get('TILE_CACHE_STALE_TTL', '86400'))  # segundos
+# Teselas caducadas hace menos de esto se sirven al momento y se refrescan en segundo plano (0 = esperar a Overpass)
+TILE_CACHE_REVALIDATE_TTL = int(os.environ.get('TILE_CACHE_REVALIDATE_TTL', '3600'))  # segundos
+TILE_REFRESH_WORKERS = int(os.environ.get('TILE_REFRESH_WORKERS', '2'))  # refrescos simultáneos
+TILE_REFRESH_MAX_PENDING = int(os.environ.get('TILE_REFRESH_MAX_PENDING', '1024'))  # teselas en cola como máximo
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Directorio para el nivel en disco (vacío = solo memoria)
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', '')
+# Por encima de este número de teselas se consulta el bbox directamente sin caché
+TILE_CACHE_MAX_TILES = int(os.environ.get('TILE_CACHE_MAX_TILES', '64'))
+
+# Precarga de teselas (ver maps/prefetch.py), solo si Overpass tiene capacidad libre
+PREFETCH_MARGIN = int(os.environ.get('PREFETCH_MARGIN', '1'))  # teselas alrededor de cada vista (0 = no)
+PREFETCH_HOT_TILES = int(os.environ.get('PREFETCH_HOT_TILES', '50'))  # teselas más visitadas a mantener (0 = no)
+PREFETCH_INTERVAL = float(os.environ.get('PREFETCH_INTERVAL', '300'))  # segundos entre pasadas de las más visitadas
+PREFETCH_HALF_LIFE = float(os.environ.get('PREFETCH_HALF_LIFE', '3600'))  # vida media del contador de visitas
+PREFETCH_MAX_TRACKED = int(os.environ.get('PREFETCH_MAX_TRACKED', '10000'))  # teselas con contador como máximo
+
+# Planificador de los bbox que no caben en la caché de teselas (ver maps/planner.py):
+# se dividen en una rejilla de celdas que se consultan en paralelo
+PLANNER_ENABLED = os.environ.get('PLANNER_ENABLED', 'True') == 'True'
+PLANNER_MAX_CELL_AREA = float(os.environ.get('PLANNER_MAX_CELL_AREA', '0.01'))  # grados² por celda como máximo
+PLANNER_CELL_TARGET = int(os.environ.get('PLANNER_CELL_TARGET', '2000'))  # elementos estimados por celda
+PLANNER_MAX_CELLS = int(os.environ.get('PLANNER_MAX_CELLS', '16'))
+PLANNER_CONCURRENCY = int(os.environ.get('PLANNER_CONCURRENCY', '4'))  # celdas en vuelo por petición
+PLANNER_MIN_CELL_LIMIT = int(os.environ.get('PLANNER_MIN_CELL_LIMIT', '50'))  # límite por capa y celda como mínimo
+PLANNER_DENSITY_ZOOM = int(os.environ.get('PLANNER_DENSITY_ZOOM', '12'))  # teselas en que se promedia la densidad
+
+# Agregación de árboles en clusters para zoom bajo
+CLUSTER_CELLS_PER_TILE = int(os.environ.get('CLUSTER_CELLS_PER_TILE', '4'))  # celdas por ancho de tesela
+CLUSTER_MAX_POINTS = int(os.environ.get('CLUSTER_MAX_POINTS', '50000'))
+
+# Teselas vectoriales (MVT)
+MVT_MIN_ZOOM = int(os.environ.get('MVT_MIN_ZOOM', '10'))  # por debajo, teselas vacías
+MVT_DETAIL_ZOOM = int(os.environ.get('MVT_DETAIL_ZOOM', '16'))  # desde aquí, un feature por elemento
+MVT_GRID_SIZE = int(os.environ.get('MVT_GRID_SIZE', '128'))  # celdas por lado de tesela bajo MVT_DETAIL_ZOOM
+MVT_MAX_FEATURES = int(os.environ.get('MVT_MAX_FEATURES', '4096'))  # por capa y tesela
+MVT_MAX_POINTS = int(os.environ.get('MVT_MAX_POINTS', '50000'))  # elementos leídos por tesela
+MVT_CACHE_TTL = int(os.environ.get('MVT_CACHE_TTL', '300'))
+MVT_CACHE_MAX_BYTES = int(os.environ.get('MVT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+MVT_MAX_AGE = int(os.environ.get('MVT_MAX_AGE', '300'))  # Cache-Control para navegador y CDN
+
+# Estadísticas de /api/stats, precalculadas por tesela (ver maps/stats.py)
+STATS_ZOOM = int(os.environ.get('STATS_ZOOM', '14'))  # zoom de los resúmenes; como mucho TILE_CACHE_ZOOM
+STATS_MIN_ZOOM = int(os.environ.get('STATS_MIN_ZOOM', '12'))  # zoom más bajo para bbox grandes
+STATS_MAX_TILES = int(os.environ.get('STATS_MAX_TILES', '32'))  # teselas por petición
+STATS_GRID = int(os.environ.get('STATS_GRID', '8'))  # subceldas por lado para recortar las teselas del borde
+STATS_MAX_POINTS = int(os.environ.get('STATS_MAX_POINTS', '50000'))  # elementos leídos por tesela
+STATS_TOP_SPECIES = int(os.environ.get('STATS_TOP_SPECIES', '20'))
+STATS_CONCURRENCY = int(os.environ.get('STATS_CONCURRENCY', '4'))  # resúmenes calculados a la vez por petición
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', '600'))
+STATS_CACHE_MAX_BYTES = int(os.environ.get('STATS_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Compresión de respuestas (brotli si está instalado, si no gzip)
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+# Métricas de latencia por etapa en /metrics (formato Prometheus)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True') == 'True'
+# Directorio compartido por los workers para que /metrics devuelva las métricas de todos (vacío = solo las del proceso)
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', '5'))  # segundos entre escrituras de cada worker
+# Enviar las etapas de cada petición en la cabecera Server-Timing
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'False') == 'True'
+
+# Caché HTTP: ETag y Cache-Control de la API y de los estáticos (ver maps/http_cache.py)
+API_CACHE_MAX_AGE = int(os.environ.get('API_CACHE_MAX_AGE', '60'))
+API_ETAG_INDEX_SIZE = int(os.environ.get('API_ETAG_INDEX_SIZE', '10000'))  # consultas cuyo ETag se recuerda
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '3600'))  # estáticos sin huella; los que la tienen, un año
+STATIC_MEMORY_MAX_BYTES = int(os.environ.get('STATIC_MEMORY_MAX_BYTES', str(1024 * 1024)))  # por fichero
+
 # Security settings for production
 if not DEBUG:
     SECURE_SSL_REDIRECT = True
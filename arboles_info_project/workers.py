@@ -0,0 +1,31 @@
+"""
+Worker de gunicorn para servir la aplicación ASGI con uvicorn
+
+Uso (ver gunicorn.conf.py):
+    gunicorn arboles_info_project.asgi:application -k arboles_info_project.workers.UvicornWorker
+
+El bucle de eventos, la implementación HTTP y el límite de conexiones
+concurrentes por worker se configuran con variables de entorno.
+"""
+import os
+
+from uvicorn_worker import UvicornWorker as BaseUvicornWorker
+
+
+def _limit_concurrency():
+    value = int(os.environ.get('UVICORN_LIMIT_CONCURRENCY', '0'))
+    return value or None  # 0 = sin límite
+
+
+class UvicornWorker(BaseUvicornWorker):
+    """UvicornWorker con bucle, HTTP y límite de concurrencia configurables"""
+
+    CONFIG_KWARGS = {
+        # 'auto' usa uvloop y httptools si están instalados (uvicorn[standard])
+        'loop': os.environ.get('UVICORN_LOOP', 'auto'),
+        'http': os.environ.get('UVICORN_HTTP', 'auto'),
+        # El ciclo de vida arranca el cliente HTTP compartido en el loop del worker
+        'lifespan': 'on',
+        # Por encima del límite uvicorn responde 503 en lugar de encolar sin fin
+        'limit_concurrency': _limit_concurrency(),
+    }
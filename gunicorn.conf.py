@@ -0,0 +1,52 @@
+"""
+Configuración de gunicorn para Árboles Info Maps
+
+Uso:
+    gunicorn -c gunicorn.conf.py
+
+SERVER_MODE elige cómo se sirve la aplicación:
+
+- 'asgi' (por defecto): workers de uvicorn sobre arboles_info_project.asgi.
+  Cada worker atiende muchas peticiones a la vez en su bucle de eventos, así
+  que las vistas asíncronas pueden tener cientos de consultas a Overpass en
+  vuelo mientras esperan la respuesta.
+- 'wsgi': workers gthread sobre arboles_info_project.wsgi. Cada petición ocupa
+  un hilo hasta que termina, por lo que la concurrencia está limitada a
+  WEB_CONCURRENCY x GUNICORN_THREADS peticiones.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'asgi')
+if SERVER_MODE not in ('asgi', 'wsgi'):
+    raise RuntimeError(f"SERVER_MODE inválido: {SERVER_MODE!r} (usa 'asgi' o 'wsgi')")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', str(min(multiprocessing.cpu_count(), 4))))
+# Las métricas son de cada worker: con varios, /metrics junta las de todos en un directorio compartido
+metrics_tmp_dir = None
+if workers > 1 and not os.environ.get('METRICS_DIR'):
+    metrics_tmp_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='arboles-metrics-')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+if SERVER_MODE == 'asgi':
+    wsgi_app = 'arboles_info_project.asgi:application'
+    # Bucle, HTTP y límite de concurrencia: ver arboles_info_project/workers.py
+    worker_class = 'arboles_info_project.workers.UvicornWorker'
+else:
+    wsgi_app = 'arboles_info_project.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', '2'))
+
+
+def on_exit(server):
+    if metrics_tmp_dir:
+        shutil.rmtree(metrics_tmp_dir, ignore_errors=True)
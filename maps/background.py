@@ -0,0 +1,99 @@
+"""
+Event loop de larga duración en un hilo dedicado
+
+Bajo WSGI cada vista async se ejecuta con async_to_sync en un event loop que
+solo vive lo que dura la petición. Los recursos ligados a un loop (conexiones
+HTTP reutilizables, tareas en segundo plano) se ejecutan en este loop, que
+vive lo mismo que el proceso.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import threading
+from typing import Awaitable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class BackgroundLoop:
+    """Event loop ejecutándose en un hilo daemon, arrancado bajo demanda"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Loop del hilo, arrancándolo si hace falta"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    ready = threading.Event()
+
+                    def run():
+                        asyncio.set_event_loop(loop)
+                        loop.call_soon(ready.set)
+                        loop.run_forever()
+
+                    self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+                    self._thread.start()
+                    ready.wait()
+                    self._loop = loop
+                    logger.debug(f"Event loop en segundo plano '{self.name}' arrancado")
+        return self._loop
+
+    @property
+    def started_loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """Loop del hilo si ya está arrancado, sin arrancarlo"""
+        return self._loop
+
+    def is_current(self) -> bool:
+        """Indica si el código se está ejecutando en este loop"""
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def submit(self, coro: Awaitable[T]) -> "concurrent.futures.Future[T]":
+        """Programa una corrutina en el loop desde cualquier hilo"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro: Awaitable[T]) -> T:
+        """Ejecuta una corrutina en el loop y espera su resultado desde otro loop"""
+        if self.is_current():
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Detiene el loop y espera a que termine el hilo"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        # Cancelar las tareas pendientes (p. ej. los workers de refresco) para que no se destruyan con el loop cerrado
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"No se pudieron cancelar las tareas del loop '{self.name}': {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout)
+        loop.close()
+
+
+async def _cancel_tasks() -> None:
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+background_loop = BackgroundLoop('maps-background')
+atexit.register(background_loop.stop)
@@ -0,0 +1,3 @@
+"""
+Herramientas de benchmark: servidor Overpass simulado y utilidades de medida
+"""
@@ -0,0 +1,81 @@
+"""
+Generador de carga HTTP asíncrono contra un servidor ya levantado
+"""
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+import httpx
+
+
+@dataclass
+class LoadResult:
+    latencies: List[float] = field(default_factory=list)  # peticiones con respuesta 2xx/3xx
+    statuses: Counter = field(default_factory=Counter)    # código HTTP o nombre de la excepción
+    elapsed: float = 0.0
+    bytes: int = 0                                        # cuerpo de las respuestas correctas
+    by_path: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))  # latencias por ruta sin query
+
+    @property
+    def errors(self) -> int:
+        return sum(count for status, count in self.statuses.items() if not str(status).startswith(('2', '3')))
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+
+def distinct_bboxes(count: int, origin: tuple = (36.0, -6.5), step: float = 0.02, size: float = 0.005) -> Iterator[str]:
+    """
+    Bboxes "min_lat,min_lon,max_lat,max_lon" distintos en una rejilla.
+
+    Con el paso por defecto cada bbox cae en teselas distintas de la caché, así
+    que ninguna petición se sirve de la caché ni se une a otra en vuelo.
+    """
+    side = max(1, int(count ** 0.5) + 1)
+    for i in range(count):
+        lat = origin[0] + (i // side) * step
+        lon = origin[1] + (i % side) * step
+        yield f"{lat:.5f},{lon:.5f},{lat + size:.5f},{lon + size:.5f}"
+
+
+def mixed_bboxes(count: int, repeat_rate: float, hot: int = 10, seed: int = 0) -> List[str]:
+    """
+    `count` bboxes donde una fracción `repeat_rate` repite uno de los `hot`
+    primeros (y puede servirse de la caché) y el resto son distintos
+    """
+    rng = random.Random(seed)
+    grid = distinct_bboxes(count + hot)
+    hot_bboxes = [next(grid) for _ in range(hot)]
+    return [rng.choice(hot_bboxes) if hot and rng.random() < repeat_rate else next(grid) for _ in range(count)]
+
+
+async def run_load(base_url: str, paths: List[str], concurrency: int, timeout: float = 120.0) -> LoadResult:
+    """Pide cada ruta de `paths` con como mucho `concurrency` peticiones en vuelo"""
+    result = LoadResult()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def one(path: str):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                except httpx.HTTPError as e:
+                    result.statuses[type(e).__name__] += 1
+                    return
+                latency = time.perf_counter() - start
+                result.statuses[response.status_code] += 1
+                if response.status_code < 400:
+                    result.latencies.append(latency)
+                    result.by_path[path.split('?', 1)[0]].append(latency)
+                    result.bytes += len(response.content)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(path) for path in paths))
+        result.elapsed = time.perf_counter() - start
+    return result
@@ -0,0 +1,101 @@
+"""
+Arranque de la aplicación con gunicorn en un subproceso para las pruebas de carga
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import httpx
+from django.conf import settings
+
+STARTUP_TIMEOUT = 30  # segundos
+
+
+class ServerStartError(RuntimeError):
+    pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise ServerStartError(f"gunicorn terminó al arrancar (código {process.returncode})")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise ServerStartError(f"gunicorn no respondió en {STARTUP_TIMEOUT}s")
+
+
+class AppServer:
+    """
+    gunicorn con gunicorn.conf.py apuntando a un Overpass (normalmente el
+    simulado). Sin caché de teselas por defecto; `env` añade o sustituye
+    variables de entorno.
+    """
+
+    def __init__(self, overpass_url: str, mode: str = 'asgi', workers: int = 2, threads: int = 2,
+                 env: Optional[dict] = None):
+        self.port = free_port()
+        self.env = {
+            **os.environ,
+            'SERVER_MODE': mode,
+            'PORT': str(self.port),
+            'WEB_CONCURRENCY': str(workers),
+            'GUNICORN_THREADS': str(threads),
+            'GUNICORN_ACCESS_LOG': '',
+            'GUNICORN_LOG_LEVEL': 'warning',
+            'OVERPASS_URL': overpass_url,
+            'OVERPASS_URLS': overpass_url,
+            'MAPS_DATA_SOURCE': 'overpass',
+            # Sin caché de teselas ni en disco: todas las peticiones llegan a Overpass
+            'TILE_CACHE_MAX_BYTES': '0',
+            'TILE_CACHE_DIR': '',
+            'ALLOWED_HOSTS': '127.0.0.1',
+            'DEBUG': 'True',
+            **(env or {}),
+        }
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self) -> 'AppServer':
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            cwd=settings.BASE_DIR, env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_ready(self.url + '/', self.process)
+        except ServerStartError:
+            self.stop()
+            raise
+        return self
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
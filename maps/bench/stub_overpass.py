@@ -0,0 +1,241 @@
+"""
+Servidor Overpass simulado para benchmarks sin red
+
+Atiende POST /api/interpreter generando nodos dentro de los bboxes de la
+consulta (o reproduciendo una respuesta grabada) y GET /api/status. La
+latencia, los errores, el tamaño de las respuestas y el coste de establecer
+conexión son configurables.
+
+Una respuesta grabada (`fixture`, el JSON de una consulta real a Overpass) se
+carga una vez y de cada consulta se devuelven los nodos de la capa y el bbox
+de cada sentencia que cumplen sus filtros, con el límite de `out N`. Si la
+consulta no tiene sentencias reconocibles se devuelve completa.
+"""
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs
+
+# node["natural"="tree"]["species"~"...",i](if: ...)(min_lat,min_lon,max_lat,max_lon)
+STATEMENT_RE = re.compile(
+    r'node\["natural"="(?P<natural>[a-z_]+)"\](?P<filters>[^\n]*?)'
+    r'\((?P<bbox>[-\d.]+,[-\d.]+,[-\d.]+,[-\d.]+)\)'
+)
+# Filtros de etiqueta por regex y límites de altura de FeatureFilter.overpass()
+TAG_REGEX_RE = re.compile(r'\["(?P<key>\w+)"~"(?P<pattern>[^"]*)"(?P<flags>,i)?\]')
+HEIGHT_BOUND_RE = re.compile(r'number\(t\["height"\]\) (?P<op>[<>]=) (?P<value>[-\d.e]+)')
+OUT_LIMIT_RE = re.compile(r'\bout(?:\s+\w+)*?\s+(\d+)\s*;')
+
+SPECIES = ['Pinus pinea', 'Olea europaea', 'Platanus x hispanica', 'Citrus aurantium', None]
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.05            # segundos por petición
+    jitter: float = 0.0              # variación aleatoria máxima añadida a la latencia
+    tail_rate: float = 0.0           # fracción de peticiones lentas (cola de latencia)
+    tail_latency: float = 2.0        # latencia de las peticiones lentas
+    error_rate: float = 0.0          # fracción de peticiones que fallan
+    error_status: int = 504
+    retry_after: Optional[int] = None  # cabecera Retry-After de los errores simulados
+    density: int = 50                # nodos generados por bbox de la consulta
+    connect_delay: float = 0.0       # coste simulado de una conexión nueva (TCP+TLS)
+    fixture: Optional[str] = None    # respuesta grabada a reproducir
+    tag_bytes: int = 0               # bytes de relleno por nodo generado (etiqueta description)
+
+
+def matches_filters(tags: dict, filters: str) -> bool:
+    """Aplica a unas etiquetas los filtros que genera FeatureFilter.overpass()"""
+    for tag in TAG_REGEX_RE.finditer(filters):
+        flags = re.IGNORECASE if tag.group('flags') else 0
+        if not re.search(tag.group('pattern'), tags.get(tag.group('key'), ''), flags):
+            return False
+    bounds = HEIGHT_BOUND_RE.findall(filters)
+    if bounds:
+        if not tags.get("height"):
+            return False
+        height = float(tags["height"])
+        for op, value in bounds:
+            if (op == '>=' and height < float(value)) or (op == '<=' and height > float(value)):
+                return False
+    return True
+
+
+def apply_out_limit(query: str, elements: list) -> list:
+    limit = OUT_LIMIT_RE.search(query)
+    if limit:
+        return elements[:int(limit.group(1))]
+    return elements
+
+
+def generate_elements(query: str, density: int, tag_bytes: int = 0) -> list:
+    """
+    Genera `density` nodos deterministas para cada bbox de la consulta y
+    devuelve los que cumplen sus filtros, como haría Overpass
+    """
+    elements = []
+    for match in STATEMENT_RE.finditer(query):
+        min_lat, min_lon, max_lat, max_lon = map(float, match.group('bbox').split(','))
+        # Mismos nodos con y sin filtros
+        rng = random.Random(match.group('natural') + match.group('bbox'))
+        for _ in range(density):
+            tags = {"natural": match.group('natural')}
+            species = rng.choice(SPECIES)
+            if species:
+                tags["species"] = species
+            if rng.random() < 0.3:
+                tags["height"] = str(rng.randint(2, 25))
+            if tag_bytes:
+                tags["description"] = "x" * tag_bytes
+            element = {
+                "type": "node",
+                "id": rng.randint(1, 10 ** 10),
+                "lat": rng.uniform(min_lat, max_lat),
+                "lon": rng.uniform(min_lon, max_lon),
+                "tags": tags,
+            }
+            if matches_filters(tags, match.group('filters')):
+                elements.append(element)
+    return apply_out_limit(query, elements)
+
+
+def load_fixture(path: str) -> list:
+    """Elementos de una respuesta de Overpass grabada"""
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get("elements", [])
+
+
+def replay_elements(query: str, recorded: list) -> list:
+    """Nodos grabados que devolvería la consulta: capa, bbox y filtros de cada sentencia"""
+    statements = list(STATEMENT_RE.finditer(query))
+    if not statements:
+        return recorded
+    elements = []
+    for match in statements:
+        natural = match.group('natural')
+        min_lat, min_lon, max_lat, max_lon = map(float, match.group('bbox').split(','))
+        elements.extend(
+            element for element in recorded
+            if element.get("type") == "node"
+            and (element.get("tags") or {}).get("natural") == natural
+            and min_lat <= element["lat"] <= max_lat and min_lon <= element["lon"] <= max_lon
+            and matches_filters(element["tags"], match.group('filters'))
+        )
+    return apply_out_limit(query, elements)
+
+
+class StubOverpassHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        stub = self.server.stub
+        with stub.lock:
+            stub.connections += 1
+        if stub.config.connect_delay:
+            time.sleep(stub.config.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers: Optional[dict] = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente puede cerrar la conexión sin leer toda la respuesta
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path.startswith('/api/status'):
+            body = (
+                "Connected as: 0\n"
+                "Current time: 2025-01-01T00:00:00Z\n"
+                "Rate limit: 0\n"
+                "2 slots available now.\n"
+                "Currently running queries (pid, space limit, time limit, start time):\n"
+            ).encode()
+            self._send(200, body, 'text/plain')
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        stub = self.server.stub
+        config = stub.config
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length).decode('utf-8', errors='replace')
+        query = parse_qs(raw).get('data', [raw])[0] if raw.startswith('data=') else raw
+        with stub.lock:
+            stub.requests += 1
+            fail = stub.rng.random() < config.error_rate
+            delay = config.latency + (stub.rng.uniform(0, config.jitter) if config.jitter else 0)
+            if config.tail_rate and stub.rng.random() < config.tail_rate:
+                delay = config.tail_latency
+
+        if delay:
+            time.sleep(delay)
+        if fail:
+            headers = {'Retry-After': str(config.retry_after)} if config.retry_after is not None else None
+            self._send(config.error_status, b'{"error": "stub"}', headers=headers)
+            return
+
+        if stub.recorded is not None:
+            elements = replay_elements(query, stub.recorded)
+        else:
+            elements = generate_elements(query, config.density, config.tag_bytes)
+        body = json.dumps({"version": 0.6, "generator": "stub-overpass", "elements": elements}).encode()
+        self._send(200, body)
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # La cola por defecto (5) rechaza conexiones en las pruebas de carga
+    request_queue_size = 1024
+
+
+class StubOverpassServer:
+    """Servidor simulado ejecutándose en un hilo"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, config: Optional[StubConfig] = None):
+        self.config = config or StubConfig()
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+        self.requests = 0
+        self.connections = 0
+        self.recorded = load_fixture(self.config.fixture) if self.config.fixture else None
+        self._server = StubHTTPServer((host, port), StubOverpassHandler)
+        self._server.stub = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/interpreter"
+
+    def start(self) -> 'StubOverpassServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-overpass', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
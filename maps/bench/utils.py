@@ -0,0 +1,36 @@
+"""
+Utilidades comunes para medir latencias
+"""
+import math
+from typing import Dict, Sequence
+
+
+def percentile(sorted_values: Sequence[float], pct: float) -> float:
+    """Percentil (0-100) de una lista ya ordenada, por el método del rango más cercano"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: Sequence[float]) -> Dict[str, float]:
+    """Resumen de una serie de latencias en segundos"""
+    values = sorted(latencies)
+    count = len(values)
+    return {
+        "count": count,
+        "mean": sum(values) / count if count else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else 0.0,
+    }
+
+
+def format_summary(label: str, summary: Dict[str, float]) -> str:
+    """Línea de texto con el resumen en milisegundos"""
+    return (
+        f"{label:<28} n={summary['count']:<6} "
+        f"media={summary['mean'] * 1000:8.1f}ms p50={summary['p50'] * 1000:8.1f}ms "
+        f"p95={summary['p95'] * 1000:8.1f}ms p99={summary['p99'] * 1000:8.1f}ms"
+    )
@@ -0,0 +1,31 @@
+"""
+Comprobaciones del sistema (manage.py check) de la aplicación maps
+"""
+from django.conf import settings
+from django.core.checks import Warning, register
+from django.utils.module_loading import import_string
+
+
+@register()
+def check_async_middleware(app_configs, **kwargs):
+    """
+    Avisa de los middleware que no admiten modo asíncrono.
+
+    Bajo ASGI basta uno de ellos para que Django ejecute toda la cadena, y las
+    vistas asíncronas, en modo síncrono: cada petición vuelve a ocupar un hilo
+    mientras espera a Overpass.
+    """
+    errors = []
+    for path in settings.MIDDLEWARE:
+        try:
+            middleware = import_string(path)
+        except ImportError:
+            continue  # Django ya informa del error al cargar el middleware
+        if not getattr(middleware, 'async_capable', False):
+            errors.append(Warning(
+                f"El middleware {path} no admite modo asíncrono",
+                hint="Bajo ASGI obliga a servir las vistas asíncronas en un hilo por petición. "
+                     "Usa un middleware con async_capable = True o retíralo.",
+                id='maps.W001',
+            ))
+    return errors
@@ -0,0 +1,67 @@
+"""
+Agregación de puntos en celdas para niveles de zoom bajos
+
+Los puntos se agrupan en una rejilla global (anclada en lat -90 / lon -180)
+cuyo tamaño de celda depende del zoom, de modo que los clusters no cambian al
+desplazar el mapa. El binning se hace vectorizado con NumPy.
+"""
+import math
+from typing import List
+
+import numpy as np
+
+
+def cell_size(zoom: int, cells_per_tile: int, center_lat: float) -> tuple:
+    """
+    Tamaño de celda (lat, lon) en grados para un zoom.
+
+    El ancho es una fracción del ancho de una tesela del zoom; el alto se
+    corrige por la latitud (redondeada a grados enteros para que la rejilla
+    sea estable) para que las celdas sean aproximadamente cuadradas.
+    """
+    cell_lon = 360.0 / (1 << zoom) / cells_per_tile
+    cell_lat = cell_lon * max(math.cos(math.radians(round(center_lat))), 0.01)
+    return cell_lat, cell_lon
+
+
+def cluster_points(lats: np.ndarray, lons: np.ndarray, cell_lat: float, cell_lon: float) -> List[dict]:
+    """
+    Agrupa puntos por celda de la rejilla.
+
+    Devuelve una lista de clusters con el número de puntos, su centroide y el
+    bbox de la celda, ordenada por número de puntos descendente.
+    """
+    if lats.size == 0:
+        return []
+
+    iy = np.floor((lats + 90.0) / cell_lat).astype(np.int64)
+    ix = np.floor((lons + 180.0) / cell_lon).astype(np.int64)
+    cols = int(math.ceil(360.0 / cell_lon)) + 1
+    keys = iy * cols + ix
+
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    centroid_lats = np.bincount(inverse, weights=lats) / counts
+    centroid_lons = np.bincount(inverse, weights=lons) / counts
+    cell_rows = unique_keys // cols
+    cell_cols = unique_keys % cols
+
+    order = np.argsort(-counts, kind='stable')
+    clusters = []
+    for i in order.tolist():
+        min_lat = float(cell_rows[i] * cell_lat - 90.0)
+        min_lon = float(cell_cols[i] * cell_lon - 180.0)
+        clusters.append({
+            "lat": float(centroid_lats[i]),
+            "lon": float(centroid_lons[i]),
+            "count": int(counts[i]),
+            "bbox": [min_lat, min_lon, min_lat + cell_lat, min_lon + cell_lon],
+        })
+    return clusters
+
+
+def elements_to_arrays(elements: list) -> tuple:
+    """Coordenadas de una lista de elementos OSM como arrays de NumPy"""
+    count = len(elements)
+    lats = np.fromiter((element["lat"] for element in elements), dtype=np.float64, count=count)
+    lons = np.fromiter((element["lon"] for element in elements), dtype=np.float64, count=count)
+    return lats, lons
@@ -0,0 +1,526 @@
+"""
+Fuentes de datos de árboles y tocones
+
+Las vistas piden elementos OSM (en formato Overpass) de una o varias capas
+dentro de un bbox a la fuente configurada en MAPS_DATA_SOURCE:
+
+- 'overpass': API de Overpass en vivo, con caché de teselas; los bbox que no
+  caben en la caché se dividen en celdas consultadas en paralelo (ver planner.py).
+- 'local': almacén local indexado (ver local_store.py y import_osm).
+- 'local+overpass': almacén local, recurriendo a Overpass para las áreas
+  que no se han importado o si el almacén falla.
+
+Todas admiten un FeatureFilter (ver filters.py) que se aplica antes del límite.
+"""
+import logging
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .filters import FeatureFilter
+from .local_store import get_local_store
+from .metrics import log_event, register_collector, set_cache_outcome, stats_samples
+from .overpass import query_overpass_with_retry, stream_overpass
+from .planner import get_query_planner
+from .prefetch import Prefetcher
+from .refresh import TileRefresher
+from .singleflight import SingleFlight
+from .tiles import count_tiles_for_bbox, get_tile_cache, lat_lon_to_tile, tile_bounds, tiles_for_bbox
+from .upstream import OverpassError, Priority, get_endpoint_pool
+
+logger = logging.getLogger(__name__)
+
+Bbox = Tuple[float, float, float, float]
+
+# Filtros de Overpass para cada capa de datos
+LAYER_FILTERS = {
+    'trees': '["natural"="tree"]',
+    'stumps': '["natural"="tree_stump"]',
+}
+
+# Agrupación de descargas de teselas en curso
+tile_flight = SingleFlight()
+
+# Timeout de Overpass para los refrescos en segundo plano, en segundos
+REFRESH_QUERY_TIMEOUT = 60
+
+# Elementos por lote en DataSource.stream
+STREAM_BATCH_SIZE = 200
+
+
+def element_layer(element: dict) -> Optional[str]:
+    """Capa a la que pertenece un elemento OSM según su etiqueta natural"""
+    natural = element.get("tags", {}).get("natural")
+    if natural == "tree":
+        return 'trees'
+    if natural == "tree_stump":
+        return 'stumps'
+    return None
+
+
+def build_bbox_query(layers: List[str], bbox: Bbox, limit: Optional[int], timeout: int,
+                     filters: Optional[FeatureFilter] = None) -> str:
+    """
+    Consulta Overpass de varias capas en un bbox, con un límite independiente
+    por capa (None = sin límite) que se aplica después de los filtros
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    bbox_filter = f"({min_lat},{min_lon},{max_lat},{max_lon})"
+    tag_filters = filters.overpass() if filters is not None else ""
+    out_limit = f" {limit}" if limit is not None else ""
+    sets = "\n".join(f'        node{LAYER_FILTERS[layer]}{tag_filters}{bbox_filter}->.{layer};' for layer in layers)
+    outputs = "\n".join(f'        .{layer} out{out_limit};' for layer in layers)
+    return f"""
+        [out:json][timeout:{timeout}];
+{sets}
+{outputs}
+        """
+
+
+def build_tiles_query(tile_keys: List[tuple], timeout: int) -> str:
+    """Construye una consulta Overpass con la unión de los bboxes de varias teselas (capa, z, x, y)"""
+    statements = []
+    for layer, z, x, y in tile_keys:
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(z, x, y)
+        statements.append(f'  node{LAYER_FILTERS[layer]}({min_lat:.7f},{min_lon:.7f},{max_lat:.7f},{max_lon:.7f});')
+    body = "\n".join(statements)
+    return f"""
+        [out:json][timeout:{timeout}];
+        (
+{body}
+        );
+        out;
+        """
+
+
+def split_by_layer(elements: list, layers: List[str]) -> Dict[str, list]:
+    """Reparte una lista de elementos entre las capas pedidas"""
+    elements_by_layer = {layer: [] for layer in layers}
+    for element in elements:
+        layer_elements = elements_by_layer.get(element_layer(element))
+        if layer_elements is not None:
+            layer_elements.append(element)
+    return elements_by_layer
+
+
+def layer_limit_reached(layers: List[str], limit: int) -> Callable[[dict], bool]:
+    """
+    Condición de parada para la lectura en streaming: True cuando ya se han
+    recibido `limit` nodos de cada capa.
+    """
+    counts = dict.fromkeys(layers, 0)
+
+    def done(element: dict) -> bool:
+        layer = element_layer(element)
+        if layer in counts and element.get("type") == "node":
+            counts[layer] += 1
+        return all(count >= limit for count in counts.values())
+
+    return done
+
+
+class LayerElements(dict):
+    """
+    Diccionario capa -> elementos OSM que devuelven las fuentes de datos.
+
+    `fetched_at` es el instante (time.time()) en que se obtuvieron los datos
+    más antiguos de la respuesta, o None si la fuente no lo sabe. `partial`
+    es (celdas fallidas, celdas) si el bbox se dividió y faltan celdas.
+    """
+
+    def __init__(self, elements_by_layer: Dict[str, list], fetched_at: Optional[float] = None,
+                 partial: Optional[Tuple[int, int]] = None):
+        super().__init__(elements_by_layer)
+        self.fetched_at = fetched_at
+        self.partial = partial
+
+
+async def fetch_tiles(tile_keys: List[tuple], timeout: int, priority: Priority) -> dict:
+    """Descarga de Overpass varias teselas (capa, z, x, y) en una sola consulta y las guarda en caché"""
+    zoom = settings.TILE_CACHE_ZOOM
+    query = build_tiles_query(tile_keys, timeout)
+    result = await query_overpass_with_retry(query, priority=priority)
+
+    # Repartir los elementos recibidos entre las teselas pedidas
+    fetched = {key: [] for key in tile_keys}
+    for element in result.get("elements", []):
+        if element.get("type") != "node" or "lat" not in element or "lon" not in element:
+            continue
+        x, y = lat_lon_to_tile(element["lat"], element["lon"], zoom)
+        tile_elements = fetched.get((element_layer(element), zoom, x, y))
+        if tile_elements is not None:
+            tile_elements.append(element)
+
+    cache = get_tile_cache()
+    density = get_query_planner().density
+    fetched_at = time.time()
+    await cache.offload(cache.set_many, fetched)
+    for key, tile_elements in fetched.items():
+        density.observe(key[0], tile_bounds(*key[1:]), len(tile_elements))
+    return {key: (fetched_at, tile_elements) for key, tile_elements in fetched.items()}
+
+
+async def refresh_tiles(tile_keys: List[tuple]) -> dict:
+    """Vuelve a descargar teselas caducadas con prioridad de segundo plano"""
+    return await tile_flight.do_many(
+        tile_keys, lambda keys: fetch_tiles(keys, REFRESH_QUERY_TIMEOUT, Priority.BACKGROUND)
+    )
+
+
+_tile_refresher: Optional[TileRefresher] = None
+
+
+def get_tile_refresher() -> TileRefresher:
+    """Cola de refresco de teselas del proceso"""
+    global _tile_refresher
+    if _tile_refresher is None:
+        _tile_refresher = TileRefresher(refresh_tiles, settings.TILE_REFRESH_WORKERS, settings.TILE_REFRESH_MAX_PENDING)
+    return _tile_refresher
+
+
+_prefetcher: Optional[Prefetcher] = None
+
+
+def get_prefetcher() -> Prefetcher:
+    """Precarga de teselas del proceso, configurada desde settings"""
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = Prefetcher(
+            get_tile_refresher(),
+            get_tile_cache(),
+            margin=settings.PREFETCH_MARGIN,
+            hot_tiles=settings.PREFETCH_HOT_TILES,
+            interval=settings.PREFETCH_INTERVAL,
+            half_life=settings.PREFETCH_HALF_LIFE,
+            max_tracked=settings.PREFETCH_MAX_TRACKED,
+            batch_size=settings.TILE_CACHE_MAX_TILES,
+        )
+    return _prefetcher
+
+
+async def fetch_layers_by_tiles(layers: List[str], min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                                timeout: int, priority: Priority = Priority.INTERACTIVE) -> Optional[LayerElements]:
+    """
+    Obtiene los elementos de una o varias capas en un bbox a través de la caché de teselas.
+
+    Solo se consultan a Overpass las teselas que no están en caché, todas las
+    capas en una única petición. Las que caducaron hace menos de
+    TILE_CACHE_REVALIDATE_TTL segundos se sirven sin esperar y se encolan para
+    refrescarlas en segundo plano. Las peticiones interactivas se registran
+    para precargar sus teselas vecinas y las zonas más visitadas. Si Overpass
+    falla y todas las teselas que faltan siguen en caché aunque hayan
+    caducado, se sirven esas. Devuelve los
+    elementos por capa, o None si el bbox cubre demasiadas teselas, en cuyo
+    caso el llamador debe consultar el bbox directamente.
+    """
+    zoom = settings.TILE_CACHE_ZOOM
+    if count_tiles_for_bbox(min_lat, min_lon, max_lat, max_lon, zoom) > settings.TILE_CACHE_MAX_TILES:
+        log_event(logger, logging.DEBUG, "tile_cache_bypass", zoom=zoom)
+        set_cache_outcome('direct')
+        return None
+
+    cache = get_tile_cache()
+    tiles = tiles_for_bbox(min_lat, min_lon, max_lat, max_lon, zoom)
+    keys = [(layer, z, x, y) for layer in layers for z, x, y in tiles]
+    found, missing = await cache.offload(cache.get_many, keys, max_stale=settings.TILE_CACHE_REVALIDATE_TTL)
+    stale = [key for key, (fetched_at, _) in found.items() if not cache.is_fresh(fetched_at)]
+    log_event(logger, logging.DEBUG, "tile_cache", layers=",".join(layers), hits=len(found), stale=len(stale),
+              misses=len(missing))
+    set_cache_outcome('miss' if missing else 'stale' if stale else 'hit')
+    if stale:
+        get_tile_refresher().schedule(stale)
+    if priority == Priority.INTERACTIVE:
+        get_prefetcher().record(layers, tiles)
+
+    if missing:
+        # Las teselas que otra petición ya está descargando se esperan en lugar de repetirse
+        try:
+            found.update(await tile_flight.do_many(missing, lambda tile_keys: fetch_tiles(tile_keys, timeout, priority)))
+        except OverpassError as e:
+            fallback = await cache.offload(lambda: {key: cache.get_stale(key) for key in missing})
+            if any(entry is None for entry in fallback.values()):
+                raise
+            logger.warning(f"Overpass no disponible ({e}), sirviendo {len(fallback)} teselas caducadas")
+            found.update(fallback)
+
+    # Recortar al bbox pedido, ya que las teselas lo exceden
+    elements_by_layer = {layer: [] for layer in layers}
+    for key in keys:
+        layer_elements = elements_by_layer[key[0]]
+        for element in found[key][1]:
+            if min_lat <= element["lat"] <= max_lat and min_lon <= element["lon"] <= max_lon:
+                layer_elements.append(element)
+    return LayerElements(elements_by_layer, min(fetched_at for fetched_at, _ in found.values()) if found else None)
+
+
+def local_data_state() -> Optional[Tuple[int, List[Bbox]]]:
+    """Versión de los datos y áreas del almacén local (ver LocalStore.data_state), o None si la fuente no lo usa"""
+    if settings.MAPS_DATA_SOURCE == 'overpass':
+        return None
+    try:
+        return get_local_store().data_state()
+    except Exception as e:
+        logger.error(f"Error en el almacén local: {str(e)}")
+        return None
+
+
+def local_data_version() -> Optional[int]:
+    """Versión de los datos del almacén local, o None si la fuente no lo usa"""
+    state = local_data_state()
+    return state[0] if state is not None else None
+
+
+def cached_data_version(layers: List[str], bbox: Bbox) -> Optional[tuple]:
+    """
+    Versión de los datos que se servirían para un bbox. Del almacén local, su
+    versión de los datos; de la caché de teselas, el instante de descarga de
+    cada tesela. None si el bbox no cabe en la caché o alguna tesela falta o
+    ha caducado.
+    """
+    state = local_data_state()
+    if state is not None:
+        version, areas = state
+        min_lat, min_lon, max_lat, max_lon = bbox
+        if settings.MAPS_DATA_SOURCE == 'local' or any(
+                area[0] <= min_lat and area[1] <= min_lon and area[2] >= max_lat and area[3] >= max_lon
+                for area in areas):
+            return ('local', version)
+    zoom = settings.TILE_CACHE_ZOOM
+    if count_tiles_for_bbox(*bbox, zoom) > settings.TILE_CACHE_MAX_TILES:
+        return None
+    cache = get_tile_cache()
+    version = []
+    for layer in layers:
+        for z, x, y in tiles_for_bbox(*bbox, zoom):
+            fetched_at = cache.peek((layer, z, x, y))
+            if fetched_at is None or not cache.is_fresh(fetched_at):
+                return None
+            version.append(fetched_at)
+    return tuple(version)
+
+
+async def acached_data_version(layers: List[str], bbox: Bbox) -> Optional[tuple]:
+    """cached_data_version desde código asíncrono: en un hilo si tiene que leer el almacén local o el disco"""
+    if settings.MAPS_DATA_SOURCE == 'overpass' and get_tile_cache().cache_dir is None:
+        return cached_data_version(layers, bbox)
+    return await sync_to_async(cached_data_version, thread_sensitive=False)(layers, bbox)
+
+
+async def alocal_data_version() -> Optional[int]:
+    """local_data_version desde código asíncrono, con la lectura de SQLite en un hilo"""
+    if settings.MAPS_DATA_SOURCE == 'overpass':
+        return None
+    return await sync_to_async(local_data_version, thread_sensitive=False)()
+
+
+def filter_layers(elements_by_layer: LayerElements, filters: Optional[FeatureFilter]) -> LayerElements:
+    """Aplica el filtro a los elementos de cada capa, conservando su antigüedad"""
+    if filters is None:
+        return elements_by_layer
+    return LayerElements({layer: filters.apply(elements) for layer, elements in elements_by_layer.items()},
+                         elements_by_layer.fetched_at, elements_by_layer.partial)
+
+
+def layer_limit_condition(layers: List[str], limit: Optional[int]):
+    """Condición de parada de la lectura en streaming para el límite por capa, si hay límite"""
+    return (lambda: layer_limit_reached(layers, limit)) if limit is not None else None
+
+
+async def fetch_bbox_direct(layers: List[str], bbox: Bbox, limit: Optional[int], timeout: int,
+                            filters: Optional[FeatureFilter] = None) -> LayerElements:
+    """
+    Consulta a Overpass un bbox que no cabe en la caché de teselas, dividido
+    en celdas paralelas si es grande, cada una con su parte del límite (ver
+    planner.py)
+    """
+    planner = get_query_planner()
+    cells = planner.plan(layers, bbox) if settings.PLANNER_ENABLED else [bbox]
+    fetched_at = time.time()
+
+    cell_limit = planner.cell_limit(limit, len(cells))
+
+    async def fetch_cell(cell: Bbox) -> Dict[str, list]:
+        result = await query_overpass_with_retry(build_bbox_query(layers, cell, cell_limit, timeout, filters),
+                                                 stop_condition=layer_limit_condition(layers, cell_limit))
+        return split_by_layer(result.get("elements", []), layers)
+
+    if len(cells) == 1:
+        return LayerElements(await fetch_cell(bbox), fetched_at)
+    plan = await planner.fetch(layers, cells, limit, fetch_cell, observe=filters is None)
+    return LayerElements(plan.elements_by_layer, fetched_at, (plan.failed, plan.cells) if plan.failed else None)
+
+
+class DataSource:
+    """Interfaz de las fuentes de datos"""
+
+    name = 'base'
+
+    async def fetch(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                    filters: Optional[FeatureFilter] = None) -> LayerElements:
+        """
+        Devuelve un diccionario capa -> elementos OSM dentro del bbox que cumplen el filtro.
+
+        Cada lista puede contener más de `limit` elementos; el llamador recorta.
+        """
+        raise NotImplementedError
+
+    async def stream(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                     filters: Optional[FeatureFilter] = None) -> AsyncIterator[Tuple[str, list]]:
+        """
+        Devuelve los elementos por lotes (capa, elementos) a medida que están disponibles.
+
+        Por defecto obtiene todo con fetch() y lo entrega en lotes.
+        """
+        elements_by_layer = await self.fetch(layers, bbox, limit, timeout, filters)
+        for layer, elements in elements_by_layer.items():
+            for start in range(0, len(elements), STREAM_BATCH_SIZE):
+                yield layer, elements[start:start + STREAM_BATCH_SIZE]
+
+    async def prefetch(self, layers: List[str], bbox: Bbox) -> bool:
+        """
+        Precarga en segundo plano un bbox que el cliente prevé pedir pronto.
+
+        Devuelve si se ha aceptado; por defecto no hace nada.
+        """
+        return False
+
+
+class OverpassSource(DataSource):
+    """API de Overpass en vivo, a través de la caché de teselas"""
+
+    name = 'overpass'
+
+    # Las teselas de la caché se guardan sin filtrar y se filtran en memoria;
+    # las consultas directas llevan el filtro a Overpass, que devuelve menos
+    # datos, y se vuelven a filtrar aquí por si Overpass interpreta distinto
+    # alguna etiqueta (p. ej. una altura con unidades)
+    async def fetch(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                    filters: Optional[FeatureFilter] = None) -> LayerElements:
+        elements_by_layer = await fetch_layers_by_tiles(layers, *bbox, timeout)
+        if elements_by_layer is None:
+            elements_by_layer = await fetch_bbox_direct(layers, bbox, limit, timeout, filters)
+        return filter_layers(elements_by_layer, filters)
+
+    async def stream(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                     filters: Optional[FeatureFilter] = None) -> AsyncIterator[Tuple[str, list]]:
+        # Las teselas en caché y los bbox divididos en celdas se entregan de una
+        # vez; las consultas directas de una sola celda, según llega la respuesta
+        if (count_tiles_for_bbox(*bbox, settings.TILE_CACHE_ZOOM) <= settings.TILE_CACHE_MAX_TILES
+                or (settings.PLANNER_ENABLED and len(get_query_planner().plan(layers, bbox)) > 1)):
+            async for batch in super().stream(layers, bbox, limit, timeout, filters):
+                yield batch
+            return
+        query = build_bbox_query(layers, bbox, limit, timeout, filters)
+        async for elements in stream_overpass(query, layer_limit_condition(layers, limit)):
+            if filters is not None:
+                elements = filters.apply(elements)
+            for layer, layer_elements in split_by_layer(elements, layers).items():
+                if layer_elements:
+                    yield layer, layer_elements
+
+    async def prefetch(self, layers: List[str], bbox: Bbox) -> bool:
+        zoom = settings.TILE_CACHE_ZOOM
+        if count_tiles_for_bbox(*bbox, zoom) > settings.TILE_CACHE_MAX_TILES:
+            return False
+        get_prefetcher().hint(layers, tiles_for_bbox(*bbox, zoom))
+        return True
+
+
+class LocalSource(DataSource):
+    """Almacén local con índice espacial"""
+
+    name = 'local'
+
+    async def fetch(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                    filters: Optional[FeatureFilter] = None) -> LayerElements:
+        store = get_local_store()
+        set_cache_outcome('local')
+        return LayerElements(await sync_to_async(store.query, thread_sensitive=False)(layers, bbox, limit, filters))
+
+
+class FallbackSource(DataSource):
+    """Almacén local para las áreas importadas y Overpass para el resto"""
+
+    name = 'local+overpass'
+
+    def __init__(self, primary: LocalSource, fallback: DataSource):
+        self.primary = primary
+        self.fallback = fallback
+
+    async def fetch(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                    filters: Optional[FeatureFilter] = None) -> LayerElements:
+        store = get_local_store()
+        try:
+            if await sync_to_async(store.covers, thread_sensitive=False)(bbox):
+                return await self.primary.fetch(layers, bbox, limit, timeout, filters)
+            logger.info("Área no importada en el almacén local, consultando Overpass")
+        except Exception as e:
+            logger.error(f"Error en el almacén local, consultando Overpass: {str(e)}")
+        return await self.fallback.fetch(layers, bbox, limit, timeout, filters)
+
+    async def stream(self, layers: List[str], bbox: Bbox, limit: int, timeout: int,
+                     filters: Optional[FeatureFilter] = None) -> AsyncIterator[Tuple[str, list]]:
+        store = get_local_store()
+        try:
+            covered = await sync_to_async(store.covers, thread_sensitive=False)(bbox)
+        except Exception as e:
+            logger.error(f"Error en el almacén local, consultando Overpass: {str(e)}")
+            covered = False
+        source = self.primary if covered else self.fallback
+        async for batch in source.stream(layers, bbox, limit, timeout, filters):
+            yield batch
+
+    async def prefetch(self, layers: List[str], bbox: Bbox) -> bool:
+        try:
+            if await sync_to_async(get_local_store().covers, thread_sensitive=False)(bbox):
+                return False
+        except Exception as e:
+            logger.error(f"Error en el almacén local: {str(e)}")
+        return await self.fallback.prefetch(layers, bbox)
+
+
+_data_source: Optional[DataSource] = None
+
+
+def get_data_source() -> DataSource:
+    """Fuente de datos configurada en MAPS_DATA_SOURCE"""
+    global _data_source
+    if _data_source is None:
+        kind = settings.MAPS_DATA_SOURCE
+        if kind == 'overpass':
+            _data_source = OverpassSource()
+        elif kind == 'local':
+            _data_source = LocalSource()
+        elif kind == 'local+overpass':
+            _data_source = FallbackSource(LocalSource(), OverpassSource())
+        else:
+            raise ValueError(f"MAPS_DATA_SOURCE desconocida: {kind}")
+        logger.info(f"Fuente de datos: {_data_source.name}")
+    return _data_source
+
+
+def set_data_source(source: Optional[DataSource]) -> None:
+    """Sustituye la fuente de datos del proceso (pruebas); None la vuelve a crear desde settings"""
+    global _data_source
+    _data_source = source
+
+
+def collect_metrics():
+    """Contadores de la caché de teselas, el refresco, la precarga y los servidores Overpass para /metrics"""
+    yield from stats_samples('maps_tile_cache', get_tile_cache().stats(),
+                             counters=('hits', 'disk_hits', 'stale_hits', 'misses', 'evictions', 'expirations'))
+    yield from stats_samples('maps_tile_refresh', get_tile_refresher().stats(),
+                             counters=('scheduled', 'refreshed', 'failed', 'dropped'))
+    yield from stats_samples('maps_prefetch', get_prefetcher().stats(), counters=('scheduled', 'skipped'))
+    yield from stats_samples('maps_planner', get_query_planner().stats(),
+                             counters=('plans', 'cells', 'failed_cells', 'partial'))
+    for endpoint in get_endpoint_pool().stats()["endpoints"]:
+        labels = {"url": endpoint["url"]}
+        yield from stats_samples('maps_overpass', endpoint, labels,
+                                 counters=('requests', 'failures', 'hedges', 'hedge_wins'))
+        yield 'maps_overpass_circuit_open', labels, int(endpoint["circuit"] != 'closed'), 'gauge'
+
+
+register_collector(collect_metrics)
@@ -0,0 +1,155 @@
+"""
+Filtros de atributos de la API: especie, estado de salud y rango de altura
+
+Un mismo FeatureFilter se traduce a cada fuente de datos para que el filtrado
+ocurra lo antes posible:
+
+- en la consulta Overpass directa, como filtros de etiquetas y una condición
+  `if:` sobre la altura, de modo que Overpass solo devuelve (y el límite
+  `out N` solo cuenta) los nodos que cumplen el filtro;
+- en el almacén local, como condiciones sobre columnas indexadas (ver
+  LocalStore.query);
+- en memoria con `apply`, para las teselas de la caché, que se guardan sin
+  filtrar y sirven a todas las consultas.
+
+La especie se compara sin distinguir mayúsculas y admite el género:
+"Quercus" incluye "Quercus ilex" y "Quercus robur", pero no "Quercusia".
+"""
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from .parsing import parse_float_tag
+
+# Caracteres admitidos en los valores de texto; evita escapar la consulta Overpass
+SPECIES_RE = re.compile(r"^[\w .'×-]{1,100}$")
+HEALTH_RE = re.compile(r"^[\w -]{1,50}$")
+
+
+def _parse_height(value: Optional[str], name: str) -> Optional[float]:
+    if value is None or value == '':
+        return None
+    height = parse_float_tag(value)
+    if height is None:
+        raise ValueError(f"{name} debe ser un número")
+    return height
+
+
+@dataclass(frozen=True)
+class FeatureFilter:
+    """Filtro de elementos por etiquetas OSM. Los campos a None no filtran"""
+
+    species: Optional[str] = None          # especie o género, en minúsculas
+    health: Tuple[str, ...] = ()           # valores admitidos de la etiqueta health
+    min_height: Optional[float] = None     # metros, inclusive
+    max_height: Optional[float] = None
+
+    @classmethod
+    def from_query(cls, params) -> Optional['FeatureFilter']:
+        """
+        Filtro a partir de los parámetros species, health (uno o varios
+        separados por comas), min_height y max_height de la petición.
+
+        Devuelve None si no hay ninguno y lanza ValueError si no son válidos.
+        """
+        species = params.get('species', '').strip() or None
+        if species is not None and not SPECIES_RE.match(species):
+            raise ValueError("species solo admite letras, números, espacios y . ' × -")
+        health = tuple(value.strip() for value in params.get('health', '').split(',') if value.strip())
+        if any(not HEALTH_RE.match(value) for value in health):
+            raise ValueError("health solo admite letras, números, espacios y guiones")
+        min_height = _parse_height(params.get('min_height'), 'min_height')
+        max_height = _parse_height(params.get('max_height'), 'max_height')
+        if min_height is not None and max_height is not None and min_height > max_height:
+            raise ValueError("min_height no puede ser mayor que max_height")
+
+        if species is None and not health and min_height is None and max_height is None:
+            return None
+        return cls(species.lower() if species else None, health, min_height, max_height)
+
+    # Evaluación en memoria
+    def matches(self, element: dict) -> bool:
+        tags = element.get("tags") or {}
+        if self.species is not None:
+            species = tags.get("species")
+            if not species:
+                return False
+            species = species.lower()
+            if species != self.species and not species.startswith(self.species + " "):
+                return False
+        if self.health and tags.get("health") not in self.health:
+            return False
+        if self.min_height is not None or self.max_height is not None:
+            height = parse_float_tag(tags.get("height"))
+            if height is None:
+                return False
+            if self.min_height is not None and height < self.min_height:
+                return False
+            if self.max_height is not None and height > self.max_height:
+                return False
+        return True
+
+    def apply(self, elements: list) -> list:
+        """Elementos que cumplen el filtro, en el mismo orden"""
+        return [element for element in elements if self.matches(element)]
+
+    # Traducción a Overpass
+    def overpass(self) -> str:
+        """Filtros de Overpass QL a añadir a la sentencia `node[...]` de cada capa"""
+        clauses = []
+        if self.species is not None:
+            # Los valores ya están validados: solo el punto es especial en la regex
+            pattern = self.species.replace('.', '[.]')
+            clauses.append(f'["species"~"^{pattern}( |$)",i]')
+        if self.health:
+            alternatives = "|".join(self.health)
+            clauses.append(f'["health"~"^({alternatives})$"]')
+        conditions = []
+        if self.min_height is not None:
+            conditions.append(f'number(t["height"]) >= {self.min_height!r}')
+        if self.max_height is not None:
+            conditions.append(f'number(t["height"]) <= {self.max_height!r}')
+        if conditions:
+            clauses.append(f'(if: is_number(t["height"]) && {" && ".join(conditions)})')
+        return "".join(clauses)
+
+    # Traducción al almacén local
+    def species_range(self) -> Tuple[str, str]:
+        """
+        Rango [desde, hasta) de la columna species que contiene la especie del
+        filtro y todas las de su género, para recorrer solo ese tramo del índice
+        """
+        # '!' es el carácter siguiente al espacio: el rango cubre "valor" y "valor *"
+        return self.species, self.species + "!"
+
+    def sql(self, alias: str = 'n') -> Tuple[str, List]:
+        """Condiciones SQL (precedidas de AND) sobre las columnas species, health y height"""
+        clauses = []
+        params: List = []
+        if self.species is not None:
+            # El rango admite también un carácter de control tras el valor: se descarta aparte
+            clauses.append(f"{alias}.species >= ? AND {alias}.species < ? "
+                           f"AND ({alias}.species = ? OR {alias}.species >= ?)")
+            params.extend((*self.species_range(), self.species, self.species + " "))
+        if self.health:
+            clauses.append(f"{alias}.health IN ({','.join('?' * len(self.health))})")
+            params.extend(self.health)
+        if self.min_height is not None:
+            clauses.append(f"{alias}.height >= ?")
+            params.append(self.min_height)
+        if self.max_height is not None:
+            clauses.append(f"{alias}.height <= ?")
+            params.append(self.max_height)
+        return "".join(f" AND {clause}" for clause in clauses), params
+
+    def __str__(self) -> str:
+        parts = []
+        if self.species is not None:
+            parts.append(f"species={self.species}")
+        if self.health:
+            parts.append(f"health={','.join(self.health)}")
+        if self.min_height is not None:
+            parts.append(f"min_height={self.min_height}")
+        if self.max_height is not None:
+            parts.append(f"max_height={self.max_height}")
+        return " ".join(parts)
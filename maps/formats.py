@@ -0,0 +1,229 @@
+"""
+Formatos de salida compactos para las listas de árboles y tocones
+
+El parámetro `format` de las vistas API elige entre:
+
+- 'json' (por defecto): lista de objetos, un diccionario completo por elemento.
+- 'columnar': JSON por columnas. Cada atributo es un array paralelo; los
+  atributos de texto (especie, salud, ...) se codifican con diccionario y las
+  columnas sin ningún valor se omiten. La fecha de actualización, común a toda
+  la respuesta (la de obtención de los datos), se envía una sola vez en
+  `generated_at`.
+- 'bin': binario con un bloque por capa (ver `encode_binary_block`).
+- 'ndjson': un objeto JSON por línea, enviado en streaming a medida que la
+  fuente de datos entrega los elementos (ver `ndjson_response`).
+"""
+import json
+import logging
+import math
+import struct
+import time
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+
+from .filters import FeatureFilter
+from .metrics import stage
+from .mvt import varint, zigzag
+from .parsing import data_time, parse_stumps, parse_trees
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('json', 'columnar', 'bin', 'ndjson')
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+LAYER_PARSERS = {'trees': parse_trees, 'stumps': parse_stumps}
+NDJSON_ENCODER = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+BINARY_CONTENT_TYPE = 'application/vnd.arboles.points'
+BINARY_MAGIC = b"ARB1"
+
+# Columnas numéricas y de texto de cada capa (además de id, lat y lon)
+LAYER_COLUMNS = {
+    'trees': {'numeric': ('height', 'diameter', 'age'), 'categorical': ('species', 'health')},
+    'stumps': {'numeric': ('diameter',), 'categorical': ('species', 'reason')},
+}
+NULL_INDEX = 0xFFFF
+
+
+def osm_id(item: dict) -> int:
+    """Id numérico de OSM a partir del id de la API ("tree_123" -> 123)"""
+    return int(str(item["id"]).rsplit("_", 1)[-1])
+
+
+def _dictionary_encode(values: list) -> tuple:
+    dictionary: Dict[str, int] = {}
+    index = []
+    for value in values:
+        if value is None:
+            index.append(-1)
+        else:
+            index.append(dictionary.setdefault(value, len(dictionary)))
+    return list(dictionary), index
+
+
+def to_columnar(layer: str, items: List[dict], generated_at: Optional[datetime] = None) -> dict:
+    """Convierte una lista de elementos de la API al formato por columnas"""
+    columns = LAYER_COLUMNS[layer]
+    data = {
+        "count": len(items),
+        "generated_at": (generated_at or datetime.now()).isoformat(),
+        "id": [osm_id(item) for item in items],
+        "lat": [item["lat"] for item in items],
+        "lon": [item["lon"] for item in items],
+    }
+    for name in columns['numeric']:
+        values = [item.get(name) for item in items]
+        if any(value is not None for value in values):
+            data[name] = values
+    for name in columns['categorical']:
+        values = [item.get(name) for item in items]
+        if any(value is not None for value in values):
+            dictionary, index = _dictionary_encode(values)
+            data[name] = {"values": dictionary, "index": index}
+    return data
+
+
+def _pad4(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+def encode_binary_block(layer: str, items: List[dict], generated_at: Optional[datetime] = None) -> bytes:
+    """
+    Codifica una capa en un bloque binario autodelimitado.
+
+    Estructura (little-endian):
+      - "ARB1" y uint32 con la longitud de la cabecera
+      - cabecera JSON: layer, count, generated_at, columnas numéricas,
+        diccionarios de las de texto y body_length (bytes tras la cabecera)
+      - relleno hasta múltiplo de 4
+      - float32 lat[count], float32 lon[count]
+      - float32[count] por columna numérica (NaN = sin valor)
+      - uint16[count] por columna de texto (0xFFFF = sin valor), relleno a 4
+      - ids de OSM como varints zigzag de la diferencia con el anterior,
+        con relleno final hasta múltiplo de 4 para que el siguiente bloque
+        quede alineado
+    """
+    count = len(items)
+    columns = LAYER_COLUMNS[layer]
+    float_array = struct.Struct(f"<{count}f").pack
+    index_array = struct.Struct(f"<{count}H").pack
+
+    body = [
+        float_array(*(item["lat"] for item in items)),
+        float_array(*(item["lon"] for item in items)),
+    ]
+    numeric = []
+    for name in columns['numeric']:
+        values = [item.get(name) for item in items]
+        if any(value is not None for value in values):
+            numeric.append(name)
+            body.append(float_array(*(math.nan if value is None else float(value) for value in values)))
+    dictionaries = {}
+    for name in columns['categorical']:
+        values = [item.get(name) for item in items]
+        if any(value is not None for value in values):
+            dictionary, index = _dictionary_encode(values)
+            dictionaries[name] = dictionary
+            body.append(index_array(*(NULL_INDEX if i < 0 else i for i in index)))
+
+    ids = bytearray()
+    previous = 0
+    for item in items:
+        current = osm_id(item)
+        ids += varint(zigzag(current - previous))
+        previous = current
+    body_bytes = _pad4(_pad4(b"".join(body)) + bytes(ids))
+
+    header = json.dumps({
+        "layer": layer,
+        "count": count,
+        "generated_at": (generated_at or datetime.now()).isoformat(),
+        "numeric": numeric,
+        "categorical": dictionaries,
+        "body_length": len(body_bytes),
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return _pad4(BINARY_MAGIC + struct.pack("<I", len(header)) + header) + body_bytes
+
+
+def set_data_age(response: HttpResponse, fetched_at: Optional[float]) -> HttpResponse:
+    """Añade la cabecera X-Data-Age con la antigüedad en segundos de los datos, si se conoce"""
+    if fetched_at is not None:
+        response['X-Data-Age'] = str(max(0, int(time.time() - fetched_at)))
+    return response
+
+
+def layers_response(layers: Dict[str, List[dict]], fmt: str, single: bool = False,
+                    fetched_at: Optional[float] = None, partial: Optional[Tuple[int, int]] = None) -> HttpResponse:
+    """
+    Respuesta con los elementos de una o varias capas en el formato pedido.
+
+    Con `single` la respuesta JSON/columnar es la de la única capa en lugar de
+    un diccionario capa -> datos. `fetched_at` es cuándo se obtuvieron los
+    datos (ver set_data_age). Si el bbox se consultó por celdas y fallaron
+    algunas, `partial` es (fallidas, total) y se indica en X-Partial-Results.
+    """
+    with stage('serialize'):
+        response = _encode_layers(layers, fmt, single, data_time(fetched_at))
+    if partial is not None:
+        response['X-Partial-Results'] = f"{partial[0]}/{partial[1]}"
+    return set_data_age(response, fetched_at)
+
+
+def _encode_layers(layers: Dict[str, List[dict]], fmt: str, single: bool, generated_at: datetime) -> HttpResponse:
+    if fmt == 'bin':
+        body = b"".join(encode_binary_block(layer, items, generated_at) for layer, items in layers.items())
+        return HttpResponse(body, content_type=BINARY_CONTENT_TYPE)
+    if fmt == 'ndjson':
+        # Misma salida que ndjson_lines, para respuestas que no necesitan streaming
+        lines = [NDJSON_ENCODER.encode({"layer": layer, **item}) for layer, items in layers.items() for item in items]
+        lines.append(NDJSON_ENCODER.encode({"done": True, "counts": {layer: len(items) for layer, items in layers.items()}}))
+        return HttpResponse("".join(line + "\n" for line in lines), content_type=NDJSON_CONTENT_TYPE)
+    if fmt == 'columnar':
+        data = {layer: to_columnar(layer, items, generated_at) for layer, items in layers.items()}
+    else:
+        data = layers
+    if single:
+        (data,) = data.values()
+    return JsonResponse(data, safe=False)
+
+
+async def ndjson_lines(source, layers: List[str], bbox: tuple, limit: int, timeout: int,
+                       filters: Optional[FeatureFilter] = None) -> AsyncIterator[str]:
+    """
+    Líneas NDJSON con los elementos de las capas pedidas, un trozo por lote.
+
+    Cada elemento es {"layer": capa, ...campos de la API}. La última línea es
+    {"done": true, "counts": {...}} o, si la fuente falla a mitad,
+    {"error": mensaje}, para que el cliente distinga el final de un corte.
+    """
+    now = datetime.now()
+    counts = dict.fromkeys(layers, 0)
+    encode = NDJSON_ENCODER.encode
+    try:
+        async for layer, elements in source.stream(layers, bbox, limit, timeout, filters):
+            remaining = limit - counts[layer]
+            if remaining <= 0:
+                continue
+            items = LAYER_PARSERS[layer](elements, remaining, now)
+            if not items:
+                continue
+            counts[layer] += len(items)
+            yield "".join(encode({"layer": layer, **item}) + "\n" for item in items)
+            if all(count >= limit for count in counts.values()):
+                break
+    except Exception as e:
+        logger.error(f"Error en respuesta NDJSON: {str(e)}")
+        yield encode({"error": "Error interno del servidor."}) + "\n"
+        return
+    yield encode({"done": True, "counts": counts}) + "\n"
+
+
+def ndjson_response(source, layers: List[str], bbox: tuple, limit: int, timeout: int,
+                    filters: Optional[FeatureFilter] = None) -> StreamingHttpResponse:
+    """Respuesta en streaming con los elementos en NDJSON (ver ndjson_lines)"""
+    response = StreamingHttpResponse(ndjson_lines(source, layers, bbox, limit, timeout, filters),
+                                     content_type=NDJSON_CONTENT_TYPE)
+    # Evitar que proxies como nginx acumulen la respuesta antes de enviarla
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,217 @@
+"""
+Caché HTTP condicional de las respuestas de la API
+
+Las respuestas JSON/columnar/bin de la API llevan un ETag con el hash de su
+contenido, Cache-Control público de API_CACHE_MAX_AGE segundos y Vary:
+Accept-Encoding, de modo que navegador y CDN las pueden reutilizar y
+revalidar. Un If-None-Match coincidente devuelve 304 sin cuerpo.
+
+Además se recuerda el último ETag de cada consulta, con una clave de
+parámetros normalizada (orden, decimales del bbox y de las teselas, formato
+por defecto, parámetros que no cambian el resultado), junto con la versión
+de los datos: el instante de descarga de cada tesela de la caché que cubre
+el bbox, o la versión de los datos del almacén local, que cambia al aplicar
+diffs. Si al revalidar no han cambiado, el 304 se responde sin consultar la
+fuente ni serializar. Con los bbox que no caben en la caché no hay versión y
+solo se ahorra el envío del cuerpo.
+
+Las respuestas en streaming (ndjson) y las parciales (ver planner.py) no
+llevan ETag; las parciales tampoco se cachean.
+"""
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from .datasources import acached_data_version
+from .metrics import register_collector, stats_samples
+from .tiles import parse_tile_list, tiles_bbox
+
+# Parámetros que no cambian el contenido de la respuesta
+IGNORED_PARAMS = {'timeout', '_'}
+
+
+def content_etag(content: bytes) -> str:
+    """ETag fuerte a partir del contenido"""
+    return '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request, etag: str) -> bool:
+    """
+    Si el If-None-Match de la petición incluye el ETag. La comparación es
+    débil: CompressionMiddleware convierte los ETag fuertes en W/"..."
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    etag = etag.removeprefix('W/')
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in header.split(','))
+
+
+def not_modified(headers: dict) -> HttpResponseNotModified:
+    response = HttpResponseNotModified()
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def _normalize_number(value: str) -> str:
+    return repr(round(float(value), 6))
+
+
+def normalized_params(request) -> str:
+    """
+    Clave de una petición a la API que no depende del orden de los
+    parámetros ni de su escritura: peticiones equivalentes comparten clave
+    """
+    params = []
+    for name in sorted(request.GET):
+        if name in IGNORED_PARAMS:
+            continue
+        value = request.GET.get(name, '')
+        try:
+            if name == 'bbox':
+                value = ",".join(_normalize_number(part) for part in value.split(','))
+            elif name == 'tiles':
+                value = ",".join(sorted(set(part.strip() for part in value.split(',') if part.strip())))
+            elif name in ('limit', 'zoom'):
+                value = str(int(value))
+            elif name in ('min_height', 'max_height'):
+                value = _normalize_number(value)
+            elif name == 'species':
+                value = value.strip().lower()
+            elif name == 'health':
+                value = ",".join(part.strip() for part in value.split(',') if part.strip())
+        except ValueError:
+            pass  # la vista responderá 400; la clave solo tiene que ser estable
+        if name == 'format' and value == 'json':
+            continue
+        params.append(f"{name}={value}")
+    return request.path + "?" + "&".join(params)
+
+
+def request_bbox(request) -> Optional[Tuple[float, float, float, float]]:
+    """Bbox de la petición (parámetro bbox o tiles), o None si no es válido"""
+    try:
+        if request.GET.get('tiles'):
+            return tiles_bbox(parse_tile_list(request.GET['tiles']))
+        min_lat, min_lon, max_lat, max_lon = map(float, request.GET['bbox'].split(','))
+        return min_lat, min_lon, max_lat, max_lon
+    except (KeyError, ValueError):
+        return None
+
+
+class ETagIndex:
+    """LRU de clave normalizada -> (ETag, versión de los datos)"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.shortcuts = 0
+        self.not_modified = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, tuple]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, etag: str, version: tuple) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (etag, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def count(self, shortcut: bool) -> None:
+        with self._lock:
+            self.not_modified += 1
+            if shortcut:
+                self.shortcuts += 1
+
+    def stats(self) -> dict:
+        """Entradas, respuestas 304 y cuántas se resolvieron sin consultar los datos"""
+        with self._lock:
+            return {"entries": len(self._entries), "not_modified": self.not_modified, "shortcuts": self.shortcuts}
+
+
+_etag_index: Optional[ETagIndex] = None
+
+
+def get_etag_index() -> ETagIndex:
+    global _etag_index
+    if _etag_index is None:
+        _etag_index = ETagIndex(settings.API_ETAG_INDEX_SIZE)
+    return _etag_index
+
+
+def collect_metrics():
+    """Contadores del índice de ETags para /metrics"""
+    yield from stats_samples('maps_api_etag', get_etag_index().stats(), counters=('not_modified', 'shortcuts'))
+
+
+register_collector(collect_metrics)
+
+
+def api_cache_headers(etag: str) -> dict:
+    return {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={settings.API_CACHE_MAX_AGE}',
+        'Vary': 'Accept-Encoding',
+    }
+
+
+def conditional_api(layers: Optional[List[str]] = None):
+    """
+    Decorador de las vistas asíncronas de la API que devuelven datos de
+    `layers`: añade ETag y las cabeceras de caché y responde 304 cuando el
+    cliente ya tiene el contenido (ver el docstring del módulo). Sin `layers`
+    el 304 solo se decide con el contenido, tras ejecutar la vista.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            index = get_etag_index()
+            key = normalized_params(request)
+            bbox = request_bbox(request)
+            version = await acached_data_version(layers, bbox) if layers and bbox is not None else None
+            if version is not None and request.headers.get('If-None-Match'):
+                entry = index.get(key)
+                if entry is not None and entry[1] == version and etag_matches(request, entry[0]):
+                    index.count(shortcut=True)
+                    return not_modified(api_cache_headers(entry[0]))
+
+            response = await view(request, *args, **kwargs)
+            if response.status_code != 200 or response.streaming:
+                return response
+            if response.has_header('X-Partial-Results'):
+                response['Cache-Control'] = 'no-store'
+                return response
+
+            etag = content_etag(response.content)
+            # Solo se recuerda si las teselas no cambiaron mientras se generaba la respuesta
+            if version is not None and await acached_data_version(layers, bbox) == version:
+                index.set(key, etag, version)
+            headers = api_cache_headers(etag)
+            if etag_matches(request, etag):
+                index.count(shortcut=False)
+                return not_modified(headers)
+            for header, value in headers.items():
+                if header == 'Vary':
+                    patch_vary_headers(response, (value,))
+                else:
+                    response[header] = value
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,142 @@
+"""
+Cliente HTTP compartido para las consultas a Overpass
+
+Un único httpx.AsyncClient con pool de conexiones y keep-alive evita pagar
+DNS, TCP y TLS en cada consulta. Los clientes httpx están ligados al event
+loop en el que se usan, así que:
+
+- Bajo ASGI, los hooks de arranque/parada (ver arboles_info_project/asgi.py)
+  registran el loop del servidor y el cliente se usa directamente en él.
+- En cualquier otro loop (vistas async bajo WSGI, comandos de gestión) las
+  peticiones se delegan al loop de segundo plano del proceso.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+from django.conf import settings
+
+from .background import background_loop
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mapa-Arboles-Tocones/1.0'
+
+T = TypeVar('T')
+
+
+def http2_available() -> bool:
+    """HTTP/2 requiere el extra opcional httpx[http2]"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class OverpassClientManager:
+    """Gestiona un httpx.AsyncClient por event loop de larga duración"""
+
+    def __init__(self):
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._server_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=settings.OVERPASS_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OVERPASS_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=settings.OVERPASS_HTTP_KEEPALIVE_EXPIRY,
+        )
+        http2 = settings.OVERPASS_HTTP2
+        if http2 and not http2_available():
+            logger.warning("OVERPASS_HTTP2 activado pero el paquete h2 no está instalado, usando HTTP/1.1")
+            http2 = False
+        return httpx.AsyncClient(
+            limits=limits,
+            http2=http2,
+            timeout=httpx.Timeout(60.0, connect=10.0, read=60.0, write=10.0),
+            headers={'User-Agent': USER_AGENT},
+        )
+
+    def _client_for_current_loop(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._build_client()
+                self._clients[loop] = client
+            return client
+
+    def _owns_current_loop(self) -> bool:
+        loop = asyncio.get_running_loop()
+        return loop is self._server_loop or background_loop.is_current()
+
+    async def startup(self) -> None:
+        """Hook de arranque: usar el loop actual (el del servidor ASGI) para el cliente"""
+        self._server_loop = asyncio.get_running_loop()
+        self._client_for_current_loop()
+        logger.info("Cliente HTTP compartido de Overpass inicializado")
+
+    async def shutdown(self) -> None:
+        """Hook de parada: cerrar el cliente del loop actual y el del loop de segundo plano"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.pop(loop, None)
+            background_client = self._clients.pop(background_loop.started_loop, None)
+        if client is not None:
+            await client.aclose()
+        if background_client is not None:
+            await asyncio.wrap_future(background_loop.submit(background_client.aclose()))
+        if loop is self._server_loop:
+            self._server_loop = None
+        logger.info("Cliente HTTP compartido de Overpass cerrado")
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Realiza una petición con el cliente compartido, leyendo la respuesta completa"""
+        if self._owns_current_loop():
+            return await self._client_for_current_loop().request(method, url, **kwargs)
+        return await background_loop.run(self._request_in_background(method, url, **kwargs))
+
+    async def _request_in_background(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self._client_for_current_loop().request(method, url, **kwargs)
+
+    async def stream(self, method: str, url: str, consume: Callable[[httpx.Response], Awaitable[T]], **kwargs) -> T:
+        """
+        Realiza una petición en streaming con el cliente compartido.
+
+        `consume(response)` se ejecuta en el loop del cliente con la respuesta
+        abierta y sin leer; al terminar la respuesta se cierra, aunque no se haya
+        leído entera.
+        """
+        if self._owns_current_loop():
+            return await self._stream(method, url, consume, **kwargs)
+        return await background_loop.run(self._stream(method, url, consume, **kwargs))
+
+    async def _stream(self, method: str, url: str, consume, **kwargs):
+        async with self._client_for_current_loop().stream(method, url, **kwargs) as response:
+            return await consume(response)
+
+    def close_background_client(self) -> None:
+        """Cierra el cliente del loop de segundo plano (al salir el proceso bajo WSGI)"""
+        loop = background_loop.started_loop
+        with self._lock:
+            client = self._clients.pop(loop, None) if loop is not None else None
+        if client is not None and not client.is_closed:
+            try:
+                background_loop.submit(client.aclose()).result(timeout=5)
+            except Exception as e:
+                logger.warning(f"Error cerrando el cliente HTTP de Overpass: {e}")
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+
+client_manager = OverpassClientManager()
+atexit.register(client_manager.close_background_client)
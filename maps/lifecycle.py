@@ -0,0 +1,59 @@
+"""
+Hooks de arranque y parada de la aplicación
+
+Bajo ASGI se invocan desde el protocolo lifespan (ver
+arboles_info_project/asgi.py). Bajo WSGI no hay eventos de ciclo de vida: los
+recursos se crean bajo demanda y se liberan al salir el proceso.
+"""
+import logging
+
+from .http_client import client_manager
+
+logger = logging.getLogger(__name__)
+
+
+async def startup() -> None:
+    """Inicializa los recursos compartidos del proceso"""
+    await client_manager.startup()
+
+
+async def shutdown() -> None:
+    """Libera los recursos compartidos del proceso"""
+    await client_manager.shutdown()
+
+
+class LifespanMiddleware:
+    """
+    Envoltorio ASGI que atiende el protocolo lifespan.
+
+    El ASGIHandler de Django rechaza los scopes de tipo lifespan, así que este
+    envoltorio los gestiona y delega el resto de peticiones a la aplicación.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            await self.app(scope, receive, send)
+            return
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await startup()
+                except Exception as e:
+                    logger.exception("Error en el arranque de la aplicación")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await shutdown()
+                except Exception as e:
+                    logger.exception("Error en la parada de la aplicación")
+                    await send({'type': 'lifespan.shutdown.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
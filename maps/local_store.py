@@ -0,0 +1,328 @@
+"""
+Almacén local de árboles y tocones con índice espacial
+
+Base de datos SQLite con un índice R*Tree sobre las coordenadas. Se rellena
+con el comando import_osm a partir de un extracto de OSM o de un volcado de
+Overpass y responde consultas por bbox en milisegundos sin salir del proceso.
+Los elementos se devuelven con la misma forma que los de Overpass.
+
+Las etiquetas species, health y height se copian además a columnas propias
+para filtrar sin decodificar el JSON; species (en minúsculas) tiene un índice
+por capa que hace de índice invertido especie -> nodos.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .filters import FeatureFilter
+from .parsing import parse_float_tag
+
+logger = logging.getLogger(__name__)
+
+Bbox = Tuple[float, float, float, float]
+
+# Contador en la tabla meta que cambia con cada importación o diff aplicado
+DATA_VERSION_KEY = 'data_version'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    layer TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    tags TEXT NOT NULL,
+    species TEXT,
+    health TEXT,
+    height REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree USING rtree(
+    id, min_lat, max_lat, min_lon, max_lon
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    min_lat REAL NOT NULL,
+    min_lon REAL NOT NULL,
+    max_lat REAL NOT NULL,
+    max_lon REAL NOT NULL,
+    source TEXT NOT NULL,
+    imported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Columnas de filtrado añadidas después de la primera versión del esquema
+FILTER_COLUMNS = {'species': 'TEXT', 'health': 'TEXT', 'height': 'REAL'}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS nodes_layer_species ON nodes (layer, species);
+"""
+
+# Con menos nodos de la especie pedida que esto, se recorre su tramo del
+# índice de especies en lugar del R*Tree
+SPECIES_INDEX_MAX_POSTINGS = 5000
+
+
+def filter_columns(tags: dict) -> Tuple[Optional[str], Optional[str], Optional[float]]:
+    """Valores de las columnas species, health y height a partir de las etiquetas"""
+    species = tags.get("species")
+    return (species.lower() if isinstance(species, str) else None,
+            tags.get("health"), parse_float_tag(tags.get("height")))
+
+
+class LocalStore:
+    """Acceso al almacén local. Usa una conexión SQLite por hilo"""
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self._state: Optional[Tuple[int, List[Bbox], float]] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._add_filter_columns(conn)
+                    conn.executescript(INDEXES)
+                    self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _add_filter_columns(conn: sqlite3.Connection) -> None:
+        """Añade y rellena las columnas de filtrado en almacenes creados sin ellas"""
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(nodes)")}
+        missing = [column for column in FILTER_COLUMNS if column not in existing]
+        if not missing:
+            return
+        logger.info(f"Añadiendo columnas de filtrado al almacén local: {', '.join(missing)}")
+        with conn:
+            for column in missing:
+                conn.execute(f"ALTER TABLE nodes ADD COLUMN {column} {FILTER_COLUMNS[column]}")
+            rows = [(*filter_columns(json.loads(tags)), node_id)
+                    for node_id, tags in conn.execute("SELECT id, tags FROM nodes")]
+            conn.executemany("UPDATE nodes SET species = ?, health = ?, height = ? WHERE id = ?", rows)
+
+    def close(self) -> None:
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    # Escritura
+    def upsert_nodes(self, elements: Iterable[dict], layer_of, batch_size: int = 5000) -> int:
+        """
+        Inserta o actualiza nodos OSM en formato Overpass.
+
+        `layer_of(element)` devuelve la capa del elemento o None para ignorarlo.
+        Devuelve el número de nodos guardados.
+        """
+        conn = self.connection
+        count = 0
+        batch = []
+
+        def flush():
+            with conn:
+                conn.executemany("DELETE FROM nodes_rtree WHERE id = ?", [(row[0],) for row in batch])
+                conn.executemany(
+                    "INSERT OR REPLACE INTO nodes (id, layer, lat, lon, tags, species, health, height) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch
+                )
+                conn.executemany(
+                    "INSERT INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+                    [(row[0], row[2], row[2], row[3], row[3]) for row in batch],
+                )
+
+        for element in elements:
+            layer = layer_of(element)
+            if layer is None:
+                continue
+            tags = element.get("tags", {})
+            batch.append((
+                int(element["id"]), layer, float(element["lat"]), float(element["lon"]),
+                json.dumps(tags, ensure_ascii=False, separators=(',', ':')), *filter_columns(tags),
+            ))
+            if len(batch) >= batch_size:
+                flush()
+                count += len(batch)
+                batch = []
+        if batch:
+            flush()
+            count += len(batch)
+        return count
+
+    def delete_nodes(self, ids: Iterable[int]) -> int:
+        """Elimina nodos por id. Devuelve cuántos existían"""
+        conn = self.connection
+        rows = [(int(node_id),) for node_id in ids]
+        with conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM nodes WHERE id = ?", rows)
+            deleted = conn.total_changes - before
+            conn.executemany("DELETE FROM nodes_rtree WHERE id = ?", rows)
+        return deleted
+
+    def get_positions(self, ids: Iterable[int]) -> Dict[int, Tuple[float, float]]:
+        """Coordenadas actuales de los nodos indicados que existen en el almacén"""
+        positions = {}
+        ids = [int(node_id) for node_id in ids]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for node_id, lat, lon in self.connection.execute(
+                f"SELECT id, lat, lon FROM nodes WHERE id IN ({placeholders})", chunk
+            ):
+                positions[node_id] = (lat, lon)
+        return positions
+
+    def clear(self) -> None:
+        """Elimina todos los nodos y la cobertura registrada"""
+        with self.connection as conn:
+            conn.execute("DELETE FROM nodes")
+            conn.execute("DELETE FROM nodes_rtree")
+            conn.execute("DELETE FROM coverage")
+        self.bump_data_version()
+
+    def add_coverage(self, bbox: Bbox, source: str) -> None:
+        """Registra un área cuyo contenido está completo en el almacén"""
+        with self.connection as conn:
+            conn.execute(
+                "INSERT INTO coverage (min_lat, min_lon, max_lat, max_lon, source, imported_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*bbox, source, time.time()),
+            )
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.connection as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def bump_data_version(self) -> int:
+        """
+        Incrementa la versión de los datos tras modificarlos. Los workers la
+        comparan para descartar lo que tengan calculado con la anterior
+        """
+        with self.connection as conn:
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, '1') "
+                         "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", (DATA_VERSION_KEY,))
+            version = int(conn.execute("SELECT value FROM meta WHERE key = ?", (DATA_VERSION_KEY,)).fetchone()[0])
+        self._state = None
+        return version
+
+    def data_state(self) -> Tuple[int, List[Bbox]]:
+        """
+        Versión de los datos y áreas importadas, leídas de la base de datos
+        como mucho cada LOCAL_STORE_CHECK_INTERVAL segundos: los cambios de
+        otro proceso se ven con ese retraso
+        """
+        now = time.monotonic()
+        state = self._state
+        if state is None or now - state[2] >= settings.LOCAL_STORE_CHECK_INTERVAL:
+            state = self._state = (int(self.get_meta(DATA_VERSION_KEY, '0')), self.coverage_areas(), now)
+        return state[0], state[1]
+
+    # Lectura
+    def covers(self, bbox: Bbox) -> bool:
+        """Indica si algún área importada contiene por completo el bbox"""
+        min_lat, min_lon, max_lat, max_lon = bbox
+        row = self.connection.execute(
+            "SELECT 1 FROM coverage WHERE min_lat <= ? AND min_lon <= ? AND max_lat >= ? AND max_lon >= ? LIMIT 1",
+            (min_lat, min_lon, max_lat, max_lon),
+        ).fetchone()
+        return row is not None
+
+    def coverage_areas(self) -> List[Bbox]:
+        """Áreas importadas registradas"""
+        return [tuple(row) for row in self.connection.execute("SELECT min_lat, min_lon, max_lat, max_lon FROM coverage")]
+
+    def query(self, layers: List[str], bbox: Bbox, limit: Optional[int] = None,
+              filters: Optional[FeatureFilter] = None) -> Dict[str, list]:
+        """
+        Elementos de cada capa dentro del bbox que cumplen el filtro, en formato Overpass.
+
+        El límite se aplica después de filtrar. Si el filtro de especie deja
+        pocos nodos en la capa, se recorren solo esos con el índice de
+        especies; si no, los del bbox con el R*Tree.
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        filter_sql, filter_params = filters.sql() if filters is not None else ("", [])
+        result = {}
+        for layer in layers:
+            bbox_params = [layer, min_lat, max_lat, min_lon, max_lon]
+            if filters is not None and filters.species is not None and self._few_species_nodes(layer, filters):
+                sql = (
+                    "SELECT n.id, n.lat, n.lon, n.tags FROM nodes n INDEXED BY nodes_layer_species "
+                    "WHERE n.layer = ? AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?"
+                )
+                params = bbox_params
+            else:
+                # El R*Tree guarda float32 redondeando hacia fuera, así que se filtra
+                # también por las coordenadas exactas de la tabla de nodos
+                sql = (
+                    "SELECT n.id, n.lat, n.lon, n.tags FROM nodes_rtree r CROSS JOIN nodes n ON n.id = r.id "
+                    "WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ? "
+                    "AND n.layer = ? AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?"
+                )
+                params = [max_lat, min_lat, max_lon, min_lon, *bbox_params]
+            sql += filter_sql
+            params = params + filter_params
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(limit)
+            result[layer] = [
+                {"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": json.loads(tags)}
+                for node_id, lat, lon, tags in self.connection.execute(sql, params)
+            ]
+        return result
+
+    def _few_species_nodes(self, layer: str, filters: FeatureFilter) -> bool:
+        """Si la capa tiene menos de SPECIES_INDEX_MAX_POSTINGS nodos de la especie del filtro"""
+        start, end = filters.species_range()
+        (postings,) = self.connection.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM nodes INDEXED BY nodes_layer_species "
+            "WHERE layer = ? AND species >= ? AND species < ? LIMIT ?)",
+            (layer, start, end, SPECIES_INDEX_MAX_POSTINGS),
+        ).fetchone()
+        return postings < SPECIES_INDEX_MAX_POSTINGS
+
+    def count(self) -> Dict[str, int]:
+        """Número de nodos por capa"""
+        return dict(self.connection.execute("SELECT layer, COUNT(*) FROM nodes GROUP BY layer"))
+
+
+_local_store: Optional[LocalStore] = None
+_local_store_lock = threading.Lock()
+
+
+def get_local_store() -> LocalStore:
+    """Instancia de LocalStore del proceso, configurada desde settings"""
+    global _local_store
+    if _local_store is None:
+        with _local_store_lock:
+            if _local_store is None:
+                _local_store = LocalStore(settings.LOCAL_STORE_PATH)
+    return _local_store
+
+
+def set_local_store(store: Optional[LocalStore]) -> None:
+    """Sustituye el almacén del proceso (pruebas); None lo vuelve a abrir desde settings"""
+    global _local_store
+    _local_store = store
@@ -0,0 +1,115 @@
+"""
+Aplica diffs de OSM (osmChange) al almacén local
+
+Uso:
+    # Ficheros locales (p. ej. fixtures), en orden
+    python manage.py apply_osm_changes 123.osc.gz 124.osc.gz --sequence 124
+
+    # Servidor de replicación, una vez o como demonio
+    python manage.py apply_osm_changes --replication-url https://planet.openstreetmap.org/replication/minute
+    python manage.py apply_osm_changes --replication-url https://planet.openstreetmap.org/replication/minute --loop
+
+La primera vez contra un servidor hay que indicar desde qué secuencia empezar
+(--sequence), normalmente la de la fecha del extracto importado.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.local_store import get_local_store
+from maps.replication import (
+    SEQUENCE_KEY, TIMESTAMP_KEY, URL_KEY, ReplicationClient, ReplicationResult,
+    apply_changes, invalidate_tiles, open_osmchange, parse_osmchange,
+)
+from maps.tiles import get_tile_cache
+
+
+class Command(BaseCommand):
+    help = 'Aplica diffs de OSM (osmChange) a los árboles y tocones del almacén local'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='Ficheros .osc o .osc.gz a aplicar en orden')
+        parser.add_argument('--replication-url', help='URL base del servidor de replicación')
+        parser.add_argument('--sequence', type=int,
+                            help='Con ficheros: secuencia del último diff. Con servidor: última secuencia ya aplicada')
+        parser.add_argument('--max-diffs', type=int, default=60, help='Máximo de diffs a aplicar por iteración')
+        parser.add_argument('--loop', action='store_true', help='Seguir aplicando diffs indefinidamente')
+        parser.add_argument('--interval', type=float, default=60.0, help='Segundos entre iteraciones con --loop')
+
+    def handle(self, *args, **options):
+        if bool(options['files']) == bool(options['replication_url']):
+            raise CommandError("Indica ficheros osmChange o --replication-url (pero no ambos)")
+
+        store = get_local_store()
+        if options['files']:
+            result = ReplicationResult()
+            for path in options['files']:
+                try:
+                    with open_osmchange(path) as f:
+                        result.merge(self.apply(store, parse_osmchange(f)))
+                except (OSError, ValueError) as e:
+                    raise CommandError(f"Error leyendo {path}: {e}")
+            if options['sequence'] is not None:
+                store.set_meta(SEQUENCE_KEY, str(options['sequence']))
+            self.report(result)
+            return
+
+        client = ReplicationClient(options['replication_url'])
+        try:
+            while True:
+                self.replicate(store, client, options)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.close()
+
+    def apply(self, store, changes) -> ReplicationResult:
+        result = apply_changes(store, changes, settings.TILE_CACHE_ZOOM)
+        # Teselas de Overpass de este proceso y del nivel en disco compartido; lo
+        # calculado a partir del almacén lo invalida en todos los workers la versión de los datos
+        invalidate_tiles(get_tile_cache(), result.touched_tiles)
+        return result
+
+    def replicate(self, store, client: ReplicationClient, options: dict) -> None:
+        stored = store.get_meta(SEQUENCE_KEY)
+        if options['sequence'] is not None and stored is None:
+            stored = str(options['sequence'])
+        if stored is None:
+            raise CommandError("No hay secuencia de replicación guardada: indica --sequence la primera vez")
+        current = int(stored)
+
+        try:
+            remote = int(client.state()['sequenceNumber'])
+        except Exception as e:
+            self.stderr.write(f"Error consultando el estado de replicación: {e}")
+            return
+
+        result = ReplicationResult()
+        applied = 0
+        while current < remote and applied < options['max_diffs']:
+            sequence = current + 1
+            try:
+                with client.diff(sequence) as f:
+                    result.merge(self.apply(store, parse_osmchange(f)))
+                state = client.state(sequence)
+            except Exception as e:
+                self.stderr.write(f"Error aplicando el diff {sequence}: {e}")
+                break
+            store.set_meta(SEQUENCE_KEY, str(sequence))
+            store.set_meta(TIMESTAMP_KEY, state.get('timestamp', ''))
+            store.set_meta(URL_KEY, client.base_url)
+            current = sequence
+            applied += 1
+
+        self.stdout.write(f"Secuencia {current} (servidor: {remote}), diffs aplicados: {applied}")
+        self.report(result)
+
+    def report(self, result: ReplicationResult) -> None:
+        self.stdout.write(self.style.SUCCESS(
+            f"Creados: {result.created}, modificados: {result.modified}, eliminados: {result.deleted}, "
+            f"ignorados: {result.skipped}, teselas invalidadas: {len(result.touched_tiles)}"
+        ))
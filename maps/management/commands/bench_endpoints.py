@@ -0,0 +1,97 @@
+"""
+Reparto de consultas entre varios servidores Overpass simulados
+
+Levanta un servidor simulado por cada entrada de --endpoints, con su latencia,
+tasa de errores y fracción de peticiones lentas, y lanza consultas distintas
+(sin agrupación ni caché) por query_overpass_with_retry, sin y con cobertura
+(hedging). Muestra las latencias observadas y las estadísticas por servidor.
+
+Uso:
+    python manage.py bench_endpoints --endpoints 0.05:0:0.1,0.1,0.05:0.5 --requests 300 --concurrency 10
+"""
+import asyncio
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from maps.bench.load import distinct_bboxes
+from maps.bench.stub_overpass import StubConfig, StubOverpassServer
+from maps.bench.utils import format_summary, summarize
+from maps.overpass import query_overpass_with_retry
+from maps.upstream import OverpassError, build_endpoint_pool, set_endpoint_pool
+
+
+def parse_endpoint_spec(spec: str, tail_latency: float) -> StubConfig:
+    """"latencia[:tasa_errores[:tasa_lentas]]" -> configuración del servidor simulado"""
+    parts = [float(part) for part in spec.split(':')]
+    if not 1 <= len(parts) <= 3:
+        raise CommandError(f"Servidor inválido: {spec!r} (latencia[:tasa_errores[:tasa_lentas]])")
+    latency, error_rate, tail_rate = parts + [0.0] * (3 - len(parts))
+    return StubConfig(latency=latency, error_rate=error_rate, error_status=504,
+                      tail_rate=tail_rate, tail_latency=tail_latency, density=20)
+
+
+def seconds(value) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+
+class Command(BaseCommand):
+    help = 'Benchmark del reparto y la cobertura de consultas entre varios Overpass simulados'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', default='0.05:0:0.1,0.1,0.05:0.5',
+                            help='Servidores separados por comas: latencia[:tasa_errores[:tasa_lentas]]')
+        parser.add_argument('--tail-latency', type=float, default=2.0, help='Latencia de las peticiones lentas')
+        parser.add_argument('--requests', type=int, default=300)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--modes', default='plain,hedge', help='plain (sin cobertura) y/o hedge')
+
+    def handle(self, *args, **options):
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        logging.getLogger('maps').setLevel(logging.CRITICAL)
+        configs = [parse_endpoint_spec(spec, options['tail_latency']) for spec in options['endpoints'].split(',')]
+        stubs = [StubOverpassServer(config=config).start() for config in configs]
+        try:
+            for stub, config in zip(stubs, configs):
+                self.stdout.write(f"{stub.url}: latencia {config.latency}s, errores {config.error_rate:.0%}, "
+                                  f"lentas {config.tail_rate:.0%} ({config.tail_latency}s)")
+            # Sin límite de ritmo: se mide el reparto, no el token bucket
+            with override_settings(OVERPASS_RATE=1000.0, OVERPASS_BURST=1000, OVERPASS_MAX_CONCURRENT=options['concurrency']):
+                for mode in options['modes'].split(','):
+                    pool = build_endpoint_pool([stub.url for stub in stubs], hedge=(mode == 'hedge'))
+                    set_endpoint_pool(pool)
+                    latencies, errors = asyncio.run(self.run(options['requests'], options['concurrency']))
+                    self.stdout.write("")
+                    self.stdout.write(f"{format_summary(mode, summarize(latencies))} errores={errors}")
+                    for stats in pool.stats()['endpoints']:
+                        self.stdout.write(
+                            f"  {stats['url']:<42} consultas={stats['requests']:<5} fallos={stats['failures']:<4} "
+                            f"ewma={seconds(stats['latency_ewma'])} p90={seconds(stats['latency_p90'])} "
+                            f"coberturas={stats['hedges']} ganadas={stats['hedge_wins']} circuito={stats['circuit']}"
+                        )
+        finally:
+            set_endpoint_pool(None)
+            for stub in stubs:
+                stub.stop()
+
+    async def run(self, total: int, concurrency: int) -> tuple:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+
+        async def one(bbox: str):
+            nonlocal errors
+            query = f'[out:json];node["natural"="tree"]({bbox});out;'
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await query_overpass_with_retry(query, initial_delay=0.1)
+                except OverpassError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(one(bbox) for bbox in distinct_bboxes(total)))
+        return latencies, errors
@@ -0,0 +1,91 @@
+"""
+Compara un cliente httpx nuevo por petición con el cliente compartido
+
+Uso:
+    python manage.py bench_http_client --requests 200 --concurrency 10 --connect-delay 0.1
+"""
+import asyncio
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from maps.bench.stub_overpass import StubOverpassServer
+from maps.bench.utils import format_summary, summarize
+from maps.http_client import client_manager
+from maps.management.commands.stub_overpass import add_stub_arguments, stub_config_from_options
+
+QUERY = '[out:json];(node["natural"="tree"](36.62,-6.40,36.63,-6.39););out;'
+
+
+async def run_requests(send, total: int, concurrency: int) -> list:
+    """Lanza `total` peticiones con como mucho `concurrency` en vuelo y devuelve sus latencias"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            response = await send()
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies
+
+
+class Command(BaseCommand):
+    help = 'Benchmark del cliente HTTP de Overpass contra un servidor simulado local'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--url', help='URL de un Overpass (simulado) ya levantado')
+        add_stub_arguments(parser)
+        parser.set_defaults(connect_delay=0.1, latency=0.02, density=200)
+
+    def handle(self, *args, **options):
+        stub = None
+        url = options['url']
+        if not url:
+            stub = StubOverpassServer(config=stub_config_from_options(options)).start()
+            url = stub.url
+        try:
+            asyncio.run(self.run(url, options['requests'], options['concurrency'], stub))
+        finally:
+            if stub is not None:
+                stub.stop()
+
+    async def run(self, url: str, total: int, concurrency: int, stub) -> None:
+        self.stdout.write(f"Overpass: {url} ({total} peticiones, concurrencia {concurrency})")
+
+        async def per_request_client():
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                return await client.post(url, data=QUERY)
+
+        async def shared_client():
+            return await client_manager.post(url, data=QUERY)
+
+        modes = [
+            ('cliente por petición', per_request_client),
+            ('compartido (loop de fondo)', shared_client),
+        ]
+        for label, send in modes:
+            connections_before = stub.connections if stub else 0
+            latencies = await run_requests(send, total, concurrency)
+            line = format_summary(label, summarize(latencies))
+            if stub:
+                line += f" conexiones={stub.connections - connections_before}"
+            self.stdout.write(line)
+
+        # Bajo ASGI el cliente se usa directamente en el loop del servidor
+        await client_manager.startup()
+        try:
+            connections_before = stub.connections if stub else 0
+            latencies = await run_requests(shared_client, total, concurrency)
+            line = format_summary('compartido (loop ASGI)', summarize(latencies))
+            if stub:
+                line += f" conexiones={stub.connections - connections_before}"
+            self.stdout.write(line)
+        finally:
+            await client_manager.shutdown()
@@ -0,0 +1,104 @@
+"""
+Microbenchmarks de las etapas de CPU de la API con 1k-100k elementos
+
+Para cada tamaño mide, con elementos generados por el Overpass simulado:
+
+- decode: json.loads de la respuesta de Overpass;
+- parse: conversión a la salida de la API (parse_trees / parse_stumps), y
+  para los árboles la comparación con un modelo Pydantic por elemento;
+- serialize: codificación de la respuesta en cada formato (json, columnar,
+  bin, ndjson).
+
+Uso:
+    python manage.py bench_parsing --sizes 1000,10000,100000 --repeat 5
+    python manage.py bench_parsing --layers stumps --formats json,bin
+"""
+import json
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.bench.stub_overpass import generate_elements
+from maps.formats import FORMATS, LAYER_PARSERS, layers_response
+from maps.views import Tree
+
+LAYER_NATURAL = {'trees': 'tree', 'stumps': 'tree_stump'}
+
+
+def parse_trees_per_element(elements: list, limit: int) -> list:
+    """Conversión anterior: un modelo Tree por elemento, volcado con model_dump()"""
+    trees = []
+    for element in elements[:limit]:
+        if element.get("type") == "node":
+            try:
+                tags = element.get("tags", {})
+                trees.append(Tree(
+                    id=f"tree_{element['id']}",
+                    lat=element["lat"],
+                    lon=element["lon"],
+                    species=tags.get("species"),
+                    height=float(tags["height"]) if tags.get("height") else None,
+                    diameter=float(tags["diameter"]) if tags.get("diameter") else None,
+                    age=int(tags["age"]) if tags.get("age") and type(tags["age"]) == int else None,
+                    health=tags.get("health"),
+                    last_updated=datetime.now()
+                ).model_dump())
+            except Exception:
+                continue
+    return trees
+
+
+def best_time(func, repeat: int, *args) -> float:
+    """Mejor tiempo de `repeat` ejecuciones de func(*args), en segundos"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def per_element(seconds: float, size: int) -> str:
+    return f"{seconds / size * 1e6:6.2f}µs/elem ({seconds * 1000:8.1f}ms)"
+
+
+class Command(BaseCommand):
+    help = 'Benchmark de la decodificación, conversión y serialización de las respuestas de la API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='Números de elementos separados por comas')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--layers', default='trees,stumps', help='Capas separadas por comas')
+        parser.add_argument('--formats', default=','.join(FORMATS), help='Formatos de salida separados por comas')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        layers = options['layers'].split(',')
+        formats = options['formats'].split(',')
+        unknown = [name for name in layers if name not in LAYER_PARSERS] + [fmt for fmt in formats if fmt not in FORMATS]
+        if unknown:
+            raise CommandError(f"Capas o formatos desconocidos: {', '.join(unknown)}")
+        repeat = options['repeat']
+
+        for layer in layers:
+            parse = LAYER_PARSERS[layer]
+            for size in sizes:
+                query = f'node["natural"="{LAYER_NATURAL[layer]}"](36.6,-6.4,36.7,-6.3)'
+                body = json.dumps({"elements": generate_elements(query, size)})
+                elements = json.loads(body)["elements"]
+                items = parse(elements, size)
+
+                self.stdout.write(f"{layer} {size:>7} elementos ({len(body) / 1024:.0f} KiB de Overpass)")
+                self.stdout.write(f"  decode      {per_element(best_time(json.loads, repeat, body), size)}")
+                after = best_time(parse, repeat, elements, size)
+                line = f"  parse       {per_element(after, size)}"
+                if layer == 'trees':
+                    before = best_time(parse_trees_per_element, repeat, elements, size)
+                    line += f"  por elemento {per_element(before, size)}  x{before / after:.1f}"
+                self.stdout.write(line)
+                for fmt in formats:
+                    seconds = best_time(layers_response, repeat, {layer: items}, fmt, True)
+                    size_kib = len(layers_response({layer: items}, fmt, True).content) / 1024
+                    self.stdout.write(f"  {fmt:<11} {per_element(seconds, size)}  {size_kib:8.0f} KiB")
@@ -0,0 +1,66 @@
+"""
+Compara el servicio WSGI (gthread) y ASGI (uvicorn) con un Overpass simulado
+
+Levanta el servidor simulado y, para cada modo, gunicorn con gunicorn.conf.py
+en un subproceso. Cada petición usa un bbox distinto para que no la sirva la
+caché de teselas, así que el tiempo está dominado por la espera a Overpass.
+
+Uso:
+    python manage.py bench_serving --requests 400 --concurrency 100 --latency 0.5
+"""
+import asyncio
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.bench.load import distinct_bboxes, run_load
+from maps.bench.server import AppServer, ServerStartError
+from maps.bench.stub_overpass import StubOverpassServer
+from maps.bench.utils import format_summary, summarize
+from maps.management.commands.stub_overpass import add_stub_arguments, stub_config_from_options
+
+
+class Command(BaseCommand):
+    help = 'Prueba de carga de los modos de servicio WSGI y ASGI contra un Overpass simulado'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--modes', default='wsgi,asgi', help='Modos a comparar separados por comas')
+        parser.add_argument('--workers', type=int, default=2, help='Procesos de gunicorn (WEB_CONCURRENCY)')
+        parser.add_argument('--threads', type=int, default=2, help='Hilos por proceso en modo wsgi')
+        parser.add_argument('--path', default='/api/features/', help='Ruta de la API a pedir')
+        add_stub_arguments(parser)
+        parser.set_defaults(latency=0.5)
+
+    def handle(self, *args, **options):
+        # httpx registra cada petición en INFO
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        modes = options['modes'].split(',')
+        bboxes = list(distinct_bboxes(options['requests']))
+        paths = [f"{options['path']}?bbox={bbox}" for bbox in bboxes]
+
+        with StubOverpassServer(config=stub_config_from_options(options)) as stub:
+            self.stdout.write(
+                f"Overpass simulado: {stub.url} (latencia {options['latency']}s); "
+                f"{options['requests']} peticiones, concurrencia {options['concurrency']}, "
+                f"{options['workers']} workers"
+            )
+            for mode in modes:
+                requests_before = stub.requests
+                result = self.run_mode(mode, stub.url, paths, options)
+                line = format_summary(f"{mode}", summarize(result.latencies))
+                self.stdout.write(
+                    f"{line} {result.throughput:7.1f} pet/s errores={result.errors} "
+                    f"consultas={stub.requests - requests_before}"
+                )
+                if result.errors:
+                    self.stdout.write(f"  respuestas: {dict(result.statuses)}")
+
+    def run_mode(self, mode: str, overpass_url: str, paths: list, options: dict):
+        server = AppServer(overpass_url, mode, options['workers'], options['threads'])
+        try:
+            with server:
+                return asyncio.run(run_load(server.url, paths, options['concurrency']))
+        except ServerStartError as e:
+            raise CommandError(str(e))
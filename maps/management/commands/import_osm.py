@@ -0,0 +1,85 @@
+"""
+Importa árboles y tocones al almacén local
+
+Uso:
+    python manage.py import_osm andalucia-latest.osm.pbf
+    python manage.py import_osm rota.osm --replace
+    python manage.py import_osm volcado_overpass.json --bbox 36.6,-6.42,36.65,-6.32
+    python manage.py import_osm --from-overpass --bbox 36.6,-6.42,36.65,-6.32
+"""
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.datasources import build_bbox_query, element_layer
+from maps.local_store import get_local_store
+from maps.osm_import import ExtractReader
+from maps.overpass import query_overpass_with_retry
+from maps.upstream import Priority
+
+
+def parse_bbox(value: str):
+    try:
+        min_lat, min_lon, max_lat, max_lon = map(float, value.split(","))
+    except ValueError:
+        raise CommandError(f"bbox inválido: {value}. Formato: min_lat,min_lon,max_lat,max_lon")
+    return min_lat, min_lon, max_lat, max_lon
+
+
+class Command(BaseCommand):
+    help = 'Importa árboles y tocones de un extracto de OSM (.osm, .osm.pbf) o un volcado de Overpass al almacén local'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Fichero .osm, .osm.gz, .osm.bz2, .osm.pbf o .json de Overpass')
+        parser.add_argument('--format', choices=['xml', 'pbf', 'json'], help='Formato del fichero (por defecto según la extensión)')
+        parser.add_argument('--bbox', help='Área cubierta por los datos: min_lat,min_lon,max_lat,max_lon')
+        parser.add_argument('--replace', action='store_true', help='Vaciar el almacén antes de importar')
+        parser.add_argument('--from-overpass', action='store_true', help='Descargar el bbox desde Overpass en lugar de un fichero')
+        parser.add_argument('--timeout', type=int, default=300, help='Timeout de la consulta a Overpass en segundos')
+
+    def handle(self, *args, **options):
+        if not options['path'] and not options['from_overpass']:
+            raise CommandError("Indica un fichero o --from-overpass con --bbox")
+        if options['from_overpass'] and not options['bbox']:
+            raise CommandError("--from-overpass requiere --bbox")
+        bbox = parse_bbox(options['bbox']) if options['bbox'] else None
+
+        store = get_local_store()
+        if options['replace']:
+            store.clear()
+            self.stdout.write("Almacén local vaciado")
+
+        start = time.time()
+        if options['from_overpass']:
+            query = build_bbox_query(['trees', 'stumps'], bbox, None, options['timeout'])
+            try:
+                result = asyncio.run(query_overpass_with_retry(query, priority=Priority.BACKGROUND))
+            except Exception as e:
+                raise CommandError(f"Error consultando Overpass: {e}")
+            saved = store.upsert_nodes(result.get("elements", []), element_layer)
+            source = 'overpass'
+        else:
+            reader = ExtractReader(options['path'], options['format'])
+            try:
+                saved = store.upsert_nodes(reader, element_layer)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Error leyendo {options['path']}: {e}")
+            bbox = bbox or reader.bounds
+            if bbox is None and reader.extent is not None:
+                bbox = reader.extent
+                self.stdout.write(self.style.WARNING(
+                    "El fichero no declara su área; se registra la extensión de los nodos leídos. "
+                    "Usa --bbox para indicarla explícitamente."
+                ))
+            source = options['path']
+
+        if bbox is not None:
+            store.add_coverage(bbox, source)
+        store.bump_data_version()
+
+        counts = store.count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Importados {saved} nodos en {time.time() - start:.1f}s. "
+            f"Almacén: {counts.get('trees', 0)} árboles, {counts.get('stumps', 0)} tocones"
+        ))
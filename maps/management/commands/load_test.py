@@ -0,0 +1,136 @@
+"""
+Prueba de carga de /api/trees y /api/stumps con un Overpass simulado, sin red
+
+Levanta el servidor simulado y la aplicación con gunicorn (ver
+maps/bench/server.py), lanza las peticiones repartidas entre las rutas y
+muestra el rendimiento y los percentiles de latencia por ruta. Una fracción
+de las peticiones (--repeat-rate) repite bboxes para que se sirvan de la
+caché de teselas, como hacen los usuarios que vuelven a la misma zona.
+El límite de ritmo hacia Overpass se levanta por defecto (--overpass-rate)
+para medir la aplicación y no el planificador.
+
+Con --url se prueba un servidor ya levantado en lugar del local. Con
+--max-p95, --max-error-rate o --min-throughput el comando falla si no se
+cumplen, para usarlo en CI; --output guarda el resultado en JSON.
+
+Uso:
+    python manage.py load_test --requests 400 --concurrency 50 --latency 0.05
+    python manage.py load_test --requests 200 --max-p95 2000 --max-error-rate 0.01 --output load.json
+"""
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from maps.bench.load import LoadResult, mixed_bboxes, run_load
+from maps.bench.server import AppServer, ServerStartError
+from maps.bench.stub_overpass import StubOverpassServer
+from maps.bench.utils import format_summary, summarize
+from maps.management.commands.stub_overpass import add_stub_arguments, stub_config_from_options
+
+
+class Command(BaseCommand):
+    help = 'Prueba de carga de /api/trees y /api/stumps con percentiles de latencia'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--paths', default='/api/trees/,/api/stumps/', help='Rutas separadas por comas')
+        parser.add_argument('--query', default='', help='Parámetros añadidos a cada petición, p. ej. "format=columnar"')
+        parser.add_argument('--repeat-rate', type=float, default=0.5,
+                            help='Fracción de peticiones que repiten uno de los bboxes frecuentes')
+        parser.add_argument('--url', help='Servidor ya levantado; si no se da, se levanta uno local')
+        parser.add_argument('--mode', default='asgi', choices=('asgi', 'wsgi'))
+        parser.add_argument('--workers', type=int, default=2, help='Procesos de gunicorn (WEB_CONCURRENCY)')
+        parser.add_argument('--threads', type=int, default=2, help='Hilos por proceso en modo wsgi')
+        parser.add_argument('--no-cache', action='store_true', help='Desactiva la caché de teselas del servidor local')
+        parser.add_argument('--overpass-rate', type=float, default=1000.0,
+                            help='Consultas/s a Overpass del servidor local (OVERPASS_RATE y OVERPASS_BURST)')
+        parser.add_argument('--overpass-concurrency', type=int,
+                            help='Consultas simultáneas a Overpass por proceso (por defecto, --concurrency)')
+        parser.add_argument('--max-p95', type=float, help='p95 máximo en milisegundos')
+        parser.add_argument('--max-error-rate', type=float, help='Fracción máxima de peticiones con error')
+        parser.add_argument('--min-throughput', type=float, help='Peticiones por segundo mínimas')
+        parser.add_argument('--output', help='Fichero JSON donde guardar el resultado')
+        add_stub_arguments(parser)
+
+    def handle(self, *args, **options):
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        route_list = [path for path in options['paths'].split(',') if path]
+        extra = f"&{options['query']}" if options['query'] else ""
+        bboxes = mixed_bboxes(options['requests'], options['repeat_rate'])
+        paths = [f"{route_list[i % len(route_list)]}?bbox={bbox}{extra}" for i, bbox in enumerate(bboxes)]
+
+        if options['url']:
+            self.stdout.write(f"Servidor: {options['url']}")
+            result = asyncio.run(run_load(options['url'], paths, options['concurrency']))
+            upstream_queries = None
+        else:
+            result, upstream_queries = self.run_local(paths, options)
+
+        report = self.report(result, upstream_queries)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        self.check_thresholds(report, options)
+
+    def run_local(self, paths: list, options: dict) -> tuple:
+        env = {
+            'OVERPASS_RATE': str(options['overpass_rate']),
+            'OVERPASS_BURST': str(max(1, int(options['overpass_rate']))),
+            'OVERPASS_MAX_CONCURRENT': str(options['overpass_concurrency'] or options['concurrency']),
+        }
+        if not options['no_cache']:
+            env['TILE_CACHE_MAX_BYTES'] = str(64 * 1024 * 1024)
+        with StubOverpassServer(config=stub_config_from_options(options)) as stub:
+            self.stdout.write(
+                f"Overpass simulado: {stub.url} (latencia {options['latency']}s, errores {options['error_rate']:.0%}); "
+                f"{options['mode']} con {options['workers']} workers, caché {'no' if options['no_cache'] else 'sí'}"
+            )
+            server = AppServer(stub.url, options['mode'], options['workers'], options['threads'], env)
+            try:
+                with server:
+                    result = asyncio.run(run_load(server.url, paths, options['concurrency']))
+            except ServerStartError as e:
+                raise CommandError(str(e))
+            return result, stub.requests
+
+    def report(self, result: LoadResult, upstream_queries: Optional[int]) -> dict:
+        total = sum(result.statuses.values())
+        report = {
+            "requests": total,
+            "errors": result.errors,
+            "error_rate": result.errors / total if total else 0.0,
+            "throughput": result.throughput,
+            "elapsed": result.elapsed,
+            "bytes": result.bytes,
+            "statuses": {str(status): count for status, count in result.statuses.items()},
+            "upstream_queries": upstream_queries,
+            "latency": summarize(result.latencies),
+            "paths": {path: summarize(latencies) for path, latencies in sorted(result.by_path.items())},
+        }
+        self.stdout.write(
+            f"{total} peticiones en {result.elapsed:.1f}s: {result.throughput:.1f} pet/s, "
+            f"errores={result.errors}, {result.bytes / 1024:.0f} KiB"
+            + (f", consultas a Overpass={upstream_queries}" if upstream_queries is not None else "")
+        )
+        for path, summary in report["paths"].items():
+            self.stdout.write(format_summary(path, summary))
+        self.stdout.write(format_summary("total", report["latency"]))
+        if result.errors:
+            self.stdout.write(f"  respuestas: {report['statuses']}")
+        return report
+
+    def check_thresholds(self, report: dict, options: dict) -> None:
+        failures = []
+        p95 = report["latency"]["p95"] * 1000
+        if options['max_p95'] is not None and p95 > options['max_p95']:
+            failures.append(f"p95 {p95:.0f}ms > {options['max_p95']:.0f}ms")
+        if options['max_error_rate'] is not None and report["error_rate"] > options['max_error_rate']:
+            failures.append(f"errores {report['error_rate']:.1%} > {options['max_error_rate']:.1%}")
+        if options['min_throughput'] is not None and report["throughput"] < options['min_throughput']:
+            failures.append(f"rendimiento {report['throughput']:.1f} pet/s < {options['min_throughput']:.1f}")
+        if failures:
+            raise CommandError("Prueba de carga fallida: " + "; ".join(failures))
@@ -0,0 +1,63 @@
+"""
+Levanta un servidor Overpass simulado para pruebas y benchmarks sin red
+
+Uso:
+    python manage.py stub_overpass --port 8999 --latency 0.2 --error-rate 0.05
+    OVERPASS_URL=http://127.0.0.1:8999/api/interpreter python manage.py runserver
+"""
+from django.core.management.base import BaseCommand
+
+from maps.bench.stub_overpass import StubConfig, StubOverpassServer
+
+
+def add_stub_arguments(parser) -> None:
+    """Opciones comunes para configurar el servidor simulado"""
+    parser.add_argument('--latency', type=float, default=0.05, help='Latencia por petición en segundos')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Variación aleatoria máxima de la latencia')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='Fracción de peticiones lentas')
+    parser.add_argument('--tail-latency', type=float, default=2.0, help='Latencia de las peticiones lentas en segundos')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fracción de peticiones que fallan')
+    parser.add_argument('--error-status', type=int, default=504, help='Código HTTP de los errores simulados')
+    parser.add_argument('--retry-after', type=int, help='Cabecera Retry-After de los errores simulados, en segundos')
+    parser.add_argument('--density', type=int, default=50, help='Nodos generados por bbox de la consulta')
+    parser.add_argument('--connect-delay', type=float, default=0.0,
+                        help='Coste simulado de abrir una conexión (TCP+TLS) en segundos')
+    parser.add_argument('--tag-bytes', type=int, default=0,
+                        help='Bytes de relleno por nodo generado, para simular respuestas más pesadas')
+    parser.add_argument('--fixture', help='Respuesta JSON de Overpass grabada a reproducir por bbox')
+
+
+def stub_config_from_options(options: dict) -> StubConfig:
+    return StubConfig(
+        latency=options['latency'],
+        jitter=options['jitter'],
+        tail_rate=options['tail_rate'],
+        tail_latency=options['tail_latency'],
+        error_rate=options['error_rate'],
+        error_status=options['error_status'],
+        retry_after=options['retry_after'],
+        density=options['density'],
+        connect_delay=options['connect_delay'],
+        fixture=options['fixture'],
+        tag_bytes=options['tag_bytes'],
+    )
+
+
+class Command(BaseCommand):
+    help = 'Levanta un servidor Overpass simulado (sin red) para pruebas y benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8999)
+        add_stub_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = StubOverpassServer(options['host'], options['port'], stub_config_from_options(options))
+        self.stdout.write(self.style.SUCCESS(f"Overpass simulado escuchando en {server.url}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            self.stdout.write(f"Peticiones atendidas: {server.requests}, conexiones: {server.connections}")
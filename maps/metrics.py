@@ -0,0 +1,396 @@
+"""
+Métricas de latencia por etapa de las peticiones a la API
+
+Cada petición lleva un RequestTimings (en un contextvar) donde las distintas
+capas anotan el tiempo de sus etapas sin formatear nada:
+
+- upstream: espera a Overpass, con la cola del planificador, los reintentos y
+  la lectura de la respuesta;
+- decode: decodificación del JSON de Overpass (incluida en upstream);
+- parse: conversión de los elementos a la salida de la API;
+- serialize: codificación de la respuesta (json, columnar, bin).
+
+Además se anotan los reintentos a Overpass y el resultado de la caché de
+teselas ('hit', 'stale', 'miss', 'direct' si el bbox no cabe en la caché,
+'local' para el almacén local o 'none').
+
+MetricsMiddleware (en middleware.py) acumula las etapas y el tiempo total en
+histogramas por endpoint y resultado de caché, que /metrics expone en el
+formato de texto de Prometheus junto con los contadores de los componentes
+(servidores Overpass, caché de teselas, refresco y precarga). Con SERVER_TIMING las etapas se
+envían también en la cabecera Server-Timing de cada respuesta.
+
+Las métricas son de cada proceso y llevan la etiqueta worker con su pid. Con
+METRICS_DIR cada worker escribe ahí las suyas cada METRICS_WRITE_INTERVAL
+segundos, y /metrics responde con las de todos los workers vivos, atienda
+quien atienda la petición.
+
+En las respuestas en streaming (ndjson) el tiempo total y las etapas solo
+cubren hasta que empieza el envío.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RETRY_BUCKETS = (0, 1, 2, 3, 5)
+
+# Orden de las etapas en Server-Timing
+STAGES = ('upstream', 'decode', 'parse', 'serialize')
+
+# Precedencia al combinar el resultado de caché de varias consultas de una petición
+CACHE_OUTCOMES = ('none', 'local', 'hit', 'stale', 'direct', 'miss')
+
+LabelValues = Tuple[str, ...]
+
+
+def log_event(log: logging.Logger, level: int, event: str, **fields) -> None:
+    """
+    Registra un evento como "evento clave=valor ..." solo si el nivel está
+    activo, sin formatear nada cuando no lo está
+    """
+    if log.isEnabledFor(level):
+        log.log(level, "%s %s", event, " ".join(
+            f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in fields.items()
+        ))
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Histograma acumulativo con etiquetas, en el formato de Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series: Dict[LabelValues, list] = {}  # etiquetas -> [contadores por bucket, suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self, extra_labels: Optional[Dict[str, str]] = None) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram",
+                *self.series_lines(extra_labels)]
+
+    def series_lines(self, extra_labels: Optional[Dict[str, str]] = None) -> List[str]:
+        """Líneas de las series, con `extra_labels` añadidas a todas"""
+        extra_labels = extra_labels or {}
+        names = (*self.labelnames, *extra_labels)
+        lines = []
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            values = (*labels, *extra_labels.values())
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels((*names, 'le'), (*values, _format_value(bound)))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(names, values)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+request_duration = Histogram(
+    'maps_request_duration_seconds', 'Tiempo total de las peticiones',
+    ('endpoint', 'cache', 'status'), LATENCY_BUCKETS,
+)
+stage_duration = Histogram(
+    'maps_request_stage_seconds', 'Tiempo de cada etapa de las peticiones',
+    ('endpoint', 'cache', 'stage'), LATENCY_BUCKETS,
+)
+overpass_retries = Histogram(
+    'maps_request_overpass_retries', 'Reintentos a Overpass por petición',
+    ('endpoint', 'cache'), RETRY_BUCKETS,
+)
+
+HISTOGRAMS = [request_duration, stage_duration, overpass_retries]
+
+# Funciones que devuelven muestras (nombre, etiquetas, valor, tipo) de los componentes
+Sample = Tuple[str, Dict[str, str], float, str]
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+
+# Nombre -> [tipo, ayuda, líneas de las series]
+Families = Dict[str, list]
+
+
+def register_collector(collector: Callable[[], Iterable[Sample]]) -> None:
+    """Añade una función que aporta métricas instantáneas a /metrics"""
+    _collectors.append(collector)
+
+
+def stats_samples(prefix: str, stats: dict, labels: Optional[Dict[str, str]] = None,
+                  counters: Iterable[str] = ()) -> Iterable[Sample]:
+    """
+    Muestras de los valores numéricos de un diccionario stats(). Las claves de
+    `counters` solo crecen: se exportan como counter con el sufijo _total
+    """
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            if key in counters:
+                yield f"{prefix}_{key}_total", labels or {}, value, 'counter'
+            else:
+                yield f"{prefix}_{key}", labels or {}, value, 'gauge'
+
+
+def process_families() -> Families:
+    """Métricas de este proceso, con la etiqueta worker"""
+    worker = {'worker': str(os.getpid())}
+    families: Families = {}
+    for histogram in HISTOGRAMS:
+        families[histogram.name] = ['histogram', histogram.documentation, histogram.series_lines(worker)]
+    for collector in _collectors:
+        try:
+            for name, labels, value, kind in collector():
+                labels = {**labels, **worker}
+                families.setdefault(name, [kind, '', []])[2].append(
+                    f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        except Exception as e:
+            logger.warning(f"Error recogiendo métricas: {e}")
+    return families
+
+
+_last_write = 0.0
+_write_lock = threading.Lock()
+
+
+def write_worker_metrics() -> Families:
+    """Guarda las métricas del proceso en METRICS_DIR/<pid>.json para /metrics de los demás workers"""
+    global _last_write
+    families = process_families()
+    path = os.path.join(settings.METRICS_DIR, f"{os.getpid()}.json")
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(families, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning(f"No se pudieron guardar las métricas en {path}: {e}")
+    _last_write = time.monotonic()
+    return families
+
+
+def maybe_write_worker_metrics() -> None:
+    """Guarda las métricas del proceso si han pasado METRICS_WRITE_INTERVAL segundos desde la última vez"""
+    if not settings.METRICS_DIR or time.monotonic() - _last_write < settings.METRICS_WRITE_INTERVAL:
+        return
+    if _write_lock.acquire(blocking=False):
+        try:
+            write_worker_metrics()
+        finally:
+            _write_lock.release()
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def worker_families() -> Families:
+    """Métricas de todos los workers: las de este proceso y las guardadas en METRICS_DIR por los demás"""
+    families = write_worker_metrics()
+    own = f"{os.getpid()}.json"
+    try:
+        filenames = sorted(os.listdir(settings.METRICS_DIR))
+    except OSError:
+        return families
+    for filename in filenames:
+        if not filename.endswith('.json') or filename == own:
+            continue
+        path = os.path.join(settings.METRICS_DIR, filename)
+        pid = filename[:-len('.json')]
+        if pid.isdigit() and not _process_alive(int(pid)):
+            # Worker terminado: sus series desaparecen
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, encoding='utf-8') as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, (kind, documentation, lines) in other.items():
+            families.setdefault(name, [kind, documentation, []])[2].extend(lines)
+    return families
+
+
+def render_metrics() -> str:
+    """Todas las métricas en el formato de texto de Prometheus"""
+    families = worker_families() if settings.METRICS_DIR else process_families()
+    lines = []
+    for name, (kind, documentation, series) in families.items():
+        if documentation:
+            lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(series)
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """Tiempos por etapa, reintentos y resultado de caché de una petición"""
+
+    __slots__ = ('start', 'stages', 'retries', 'cache')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.retries = 0
+        self.cache = 'none'
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def set_cache(self, outcome: str) -> None:
+        # Con varias consultas en una petición se queda el peor resultado
+        if CACHE_OUTCOMES.index(outcome) > CACHE_OUTCOMES.index(self.cache):
+            self.cache = outcome
+
+    def server_timing(self, total: float) -> str:
+        entries = [f"{name};dur={self.stages[name] * 1000:.1f}" for name in STAGES if name in self.stages]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        entries.append(f'cache;desc="{self.cache}"')
+        return ", ".join(entries)
+
+
+_current: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar('maps_request_timings', default=None)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """RequestTimings de la petición en curso, o None fuera de una petición (p. ej. en segundo plano)"""
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Suma a la etapa `name` de la petición en curso el tiempo del bloque"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def subtask():
+    """
+    Aísla los tiempos de una subtarea concurrente de la petición en curso (en
+    su propia tarea de asyncio): su etapa upstream se descarta, ya que el
+    llamador mide la espera del conjunto, y el resto se suma a la petición
+    """
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    child = RequestTimings()
+    token = _current.set(child)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        child.stages.pop('upstream', None)
+        for name, seconds in child.stages.items():
+            parent.add(name, seconds)
+        parent.retries += child.retries
+        parent.set_cache(child.cache)
+
+
+def add_stage(name: str, seconds: float) -> None:
+    """Suma tiempo medido aparte a una etapa de la petición en curso"""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def set_cache_outcome(outcome: str) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.set_cache(outcome)
+
+
+def add_retry() -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.retries += 1
+
+
+def endpoint_name(request) -> str:
+    """Nombre de la URL que ha atendido la petición, para etiquetar las métricas"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or 'unnamed'
+
+
+def finish_request(request, response, timings: RequestTimings):
+    """Acumula los tiempos de una petición terminada y añade Server-Timing si está activado"""
+    total = time.perf_counter() - timings.start
+    endpoint = endpoint_name(request)
+    request_duration.observe(total, endpoint, timings.cache, f"{response.status_code // 100}xx")
+    for name, seconds in timings.stages.items():
+        stage_duration.observe(seconds, endpoint, timings.cache, name)
+    if 'upstream' in timings.stages:
+        overpass_retries.observe(timings.retries, endpoint, timings.cache)
+    if settings.SERVER_TIMING:
+        response['Server-Timing'] = timings.server_timing(total)
+    log_event(logger, logging.DEBUG, "request", endpoint=endpoint, status=response.status_code,
+              cache=timings.cache, retries=timings.retries, total=total, **timings.stages)
+    maybe_write_worker_metrics()
+    return response
+
+
+def start_request() -> Tuple[RequestTimings, contextvars.Token]:
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token: contextvars.Token) -> None:
+    _current.reset(token)
@@ -0,0 +1,159 @@
+"""
+Middleware de la aplicación maps
+"""
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.middleware.gzip import GZipMiddleware, re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+from .metrics import end_request, finish_request, start_request
+from .staticfiles import serve_static
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional
+    brotli = None
+
+re_accepts_brotli = _lazy_re_compile(r"\bbr\b")
+
+# Bajo ASGI, las respuestas más grandes se comprimen en un hilo del executor
+# para no bloquear el bucle de eventos
+INLINE_COMPRESSION_MAX_BYTES = 64 * 1024
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Comprime las respuestas con brotli si el cliente lo acepta y el paquete
+    opcional brotli está instalado; si no, con gzip como GZipMiddleware.
+
+    Las respuestas en streaming siempre se comprimen con gzip. Las asíncronas
+    se comprimen como un único flujo gzip vaciado tras cada trozo, para que
+    cada trozo llegue al cliente en cuanto se genera.
+
+    Bajo ASGI no pasa por sync_to_async como el resto de MiddlewareMixin: las
+    respuestas pequeñas se comprimen directamente en el bucle de eventos y las
+    grandes en un hilo del executor, sin serializarse en el hilo compartido.
+    """
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if response.streaming or len(response.content) <= INLINE_COMPRESSION_MAX_BYTES:
+            return self.process_response(request, response)
+        return await sync_to_async(self.process_response, thread_sensitive=False)(request, response)
+
+    def process_response(self, request, response):
+        if (
+            response.streaming
+            and response.is_async
+            and not response.has_header("Content-Encoding")
+            and re_accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        ):
+            patch_vary_headers(response, ("Accept-Encoding",))
+            response.streaming_content = self._gzip_stream(response.streaming_content)
+            del response.headers["Content-Length"]
+            response.headers["Content-Encoding"] = "gzip"
+            return response
+
+        if (
+            brotli is None
+            or response.streaming
+            or len(response.content) < 200
+            or response.has_header("Content-Encoding")
+            or not re_accepts_brotli.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        ):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed_content = brotli.compress(response.content, quality=settings.BROTLI_QUALITY)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response.headers["Content-Length"] = str(len(compressed_content))
+
+        # Igual que GZipMiddleware: el ETag fuerte pasa a débil
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
+        return response
+
+    @staticmethod
+    async def _gzip_stream(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: formato gzip
+        async for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class MetricsMiddleware:
+    """
+    Mide cada petición y acumula sus tiempos por etapa en las métricas de
+    /metrics (ver metrics.py). Debe ir antes que CompressionMiddleware para
+    que el tiempo total incluya la compresión.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED and not settings.SERVER_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        return finish_request(request, response, timings)
+
+    async def __acall__(self, request):
+        timings, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        return finish_request(request, response, timings)
+
+
+class StaticFilesMiddleware:
+    """
+    Sirve los ficheros de STATIC_ROOT generados por collectstatic (ver
+    staticfiles.py) sin pasar por el resto de middleware ni por las vistas.
+    En desarrollo (DEBUG) los sirve runserver o urls.py.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.prefix = '/' + settings.STATIC_URL.lstrip('/')
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def static_response(self, request):
+        if request.method not in ('GET', 'HEAD') or not request.path.startswith(self.prefix):
+            return None
+        return serve_static(request, request.path[len(self.prefix):])
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.static_response(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self.static_response(request) or await self.get_response(request)
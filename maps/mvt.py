@@ -0,0 +1,263 @@
+"""
+Teselas vectoriales (Mapbox Vector Tiles) de árboles y tocones
+
+Codifica los puntos de una capa dentro de una tesela z/x/y en el formato MVT
+(protobuf, especificación 2.1) sin dependencias externas. Por debajo de
+MVT_DETAIL_ZOOM los puntos se agrupan en una rejilla de la tesela y cada
+grupo se emite como un único punto con la propiedad `count`; en todos los
+zooms el número de features por tesela se limita a MVT_MAX_FEATURES.
+
+Las teselas codificadas se guardan en una caché LRU en memoria junto con su
+ETag, de modo que las peticiones repetidas no vuelven a consultar la fuente
+de datos ni a codificar. La clave incluye la versión de los datos del
+almacén local, así que un diff aplicado deja de servirse en todos los workers.
+"""
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .datasources import alocal_data_version, get_data_source
+from .singleflight import SingleFlight
+from .tiles import MAX_LATITUDE, TileCache, tile_bounds
+
+logger = logging.getLogger(__name__)
+
+EXTENT = 4096
+# Margen alrededor de la tesela (en unidades de EXTENT) para que los círculos
+# cercanos al borde no se corten al dibujarlos
+BUFFER = 64
+# Timeout (s) de las consultas a la fuente de datos para una tesela
+QUERY_TIMEOUT = 60
+
+# Propiedades de OSM que se incluyen en cada feature a zoom de detalle
+LAYER_PROPERTIES = {
+    'trees': ('species', 'height', 'diameter', 'age', 'health'),
+    'stumps': ('species', 'diameter', 'removal_reason'),
+}
+NUMERIC_PROPERTIES = ('height', 'diameter')
+
+# Agrupación de renderizados en curso de la misma tesela
+render_flight = SingleFlight()
+
+
+# Codificación protobuf
+def varint(value: int) -> bytes:
+    out = bytearray()
+    value &= 0xFFFFFFFFFFFFFFFF
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return varint((field << 3) | wire_type)
+
+
+def _length_delimited(field: int, data: bytes) -> bytes:
+    return _key(field, 2) + varint(len(data)) + data
+
+
+def _packed(field: int, values: List[int]) -> bytes:
+    return _length_delimited(field, b"".join(varint(v) for v in values))
+
+
+def _encode_value(value) -> bytes:
+    """Mensaje Value de MVT"""
+    if isinstance(value, bool):
+        return _key(7, 0) + varint(int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _key(5, 0) + varint(value)
+        return _key(6, 0) + varint(zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _length_delimited(1, str(value).encode('utf-8'))
+
+
+def encode_layer(name: str, features: List[tuple], extent: int = EXTENT) -> bytes:
+    """
+    Codifica una capa MVT de puntos.
+
+    `features` es una lista de (id, px, py, propiedades) con las coordenadas
+    ya en unidades de la tesela.
+    """
+    keys: Dict[str, int] = {}
+    values: Dict[tuple, int] = {}
+    encoded_values: List[bytes] = []
+    parts = [_length_delimited(1, name.encode('utf-8'))]
+
+    for feature_id, px, py, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            key_index = keys.setdefault(key, len(keys))
+            value_id = (type(value).__name__, value)
+            value_index = values.get(value_id)
+            if value_index is None:
+                value_index = values[value_id] = len(encoded_values)
+                encoded_values.append(_encode_value(value))
+            tags.extend((key_index, value_index))
+
+        feature = b""
+        if feature_id is not None:
+            feature += _key(1, 0) + varint(feature_id)
+        if tags:
+            feature += _packed(2, tags)
+        feature += _key(3, 0) + varint(1)  # POINT
+        feature += _packed(4, [9, zigzag(px), zigzag(py)])  # MoveTo(1)
+        parts.append(_length_delimited(2, feature))
+
+    parts.extend(_length_delimited(3, key.encode('utf-8')) for key in keys)
+    parts.extend(_length_delimited(4, value) for value in encoded_values)
+    parts.append(_key(5, 0) + varint(extent))
+    parts.append(_key(15, 0) + varint(2))
+    return b"".join(parts)
+
+
+def encode_tile(layers: Dict[str, List[tuple]]) -> bytes:
+    """Codifica una tesela MVT con varias capas. Las capas vacías se omiten"""
+    return b"".join(_length_delimited(3, encode_layer(name, features)) for name, features in layers.items() if features)
+
+
+# Proyección
+def project(lat: float, lon: float, z: int, x: int, y: int, extent: int = EXTENT) -> Tuple[int, int]:
+    """Coordenadas de un punto en unidades de la tesela z/x/y (origen arriba a la izquierda)"""
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 1 << z
+    tx = (lon + 180.0) / 360.0 * n
+    ty = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return int(round((tx - x) * extent)), int(round((ty - y) * extent))
+
+
+def buffered_bounds(z: int, x: int, y: int, buffer: int = BUFFER) -> Tuple[float, float, float, float]:
+    """Bbox de la tesela ampliado con el margen de dibujo"""
+    min_lat, min_lon, max_lat, max_lon = tile_bounds(z, x, y)
+    dlat = (max_lat - min_lat) * buffer / EXTENT
+    dlon = (max_lon - min_lon) * buffer / EXTENT
+    return (
+        max(min_lat - dlat, -MAX_LATITUDE), max(min_lon - dlon, -180.0),
+        min(max_lat + dlat, MAX_LATITUDE), min(max_lon + dlon, 180.0),
+    )
+
+
+def _numeric(value: Optional[str]):
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def element_properties(layer: str, element: dict) -> dict:
+    """Propiedades de un elemento OSM para su feature en la tesela"""
+    tags = element.get("tags", {})
+    properties = {}
+    for key in LAYER_PROPERTIES[layer]:
+        value = tags.get(key)
+        properties[key] = _numeric(value) if key in NUMERIC_PROPERTIES else value
+    return properties
+
+
+def tile_features(layer: str, elements: list, z: int, x: int, y: int) -> List[tuple]:
+    """
+    Features de una capa en una tesela, aplicando la simplificación y el
+    límite de features del zoom.
+    """
+    max_features = settings.MVT_MAX_FEATURES
+    points = []
+    for element in elements:
+        if element.get("type") != "node" or "lat" not in element:
+            continue
+        px, py = project(element["lat"], element["lon"], z, x, y)
+        if -BUFFER <= px <= EXTENT + BUFFER and -BUFFER <= py <= EXTENT + BUFFER:
+            points.append((px, py, element))
+
+    if z >= settings.MVT_DETAIL_ZOOM:
+        return [
+            (element["id"], px, py, element_properties(layer, element))
+            for px, py, element in points[:max_features]
+        ]
+
+    # Zoom bajo: un punto por celda de la rejilla, en el centroide, con el número de elementos
+    cell = max(EXTENT // settings.MVT_GRID_SIZE, 1)
+    cells: Dict[Tuple[int, int], list] = {}
+    for px, py, _ in points:
+        acc = cells.setdefault((px // cell, py // cell), [0, 0, 0])
+        acc[0] += px
+        acc[1] += py
+        acc[2] += 1
+    grouped = sorted(cells.values(), key=lambda acc: -acc[2])[:max_features]
+    return [(None, sum_x // count, sum_y // count, {"count": count}) for sum_x, sum_y, count in grouped]
+
+
+# Caché de teselas renderizadas
+class RenderedTileCache(TileCache):
+    """Caché LRU en memoria de teselas MVT codificadas por (capa, z, x, y, versión), guardadas como (etag, datos)"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        super().__init__(max_bytes, ttl)
+
+    def set(self, key: tuple, value: Tuple[str, bytes]) -> None:
+        self._set_memory(key, value, len(value[1]) + 64, time.time())
+
+
+_rendered_cache: Optional[RenderedTileCache] = None
+_rendered_cache_lock = threading.Lock()
+
+
+def get_rendered_cache() -> RenderedTileCache:
+    """Caché de teselas renderizadas del proceso, configurada desde settings"""
+    global _rendered_cache
+    if _rendered_cache is None:
+        with _rendered_cache_lock:
+            if _rendered_cache is None:
+                _rendered_cache = RenderedTileCache(
+                    max_bytes=settings.MVT_CACHE_MAX_BYTES,
+                    ttl=settings.MVT_CACHE_TTL,
+                )
+    return _rendered_cache
+
+
+def tile_etag(data: bytes) -> str:
+    """ETag fuerte del contenido de una tesela"""
+    return f'"{hashlib.sha1(data).hexdigest()}"'
+
+
+async def render_tile(layer: str, z: int, x: int, y: int) -> Tuple[str, bytes]:
+    """
+    Devuelve (etag, datos) de la tesela MVT de una capa.
+
+    Por debajo de MVT_MIN_ZOOM se devuelve una tesela vacía sin consultar la
+    fuente de datos.
+    """
+    key = (layer, z, x, y, await alocal_data_version())
+    cache = get_rendered_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def render() -> Tuple[str, bytes]:
+        if z < settings.MVT_MIN_ZOOM:
+            data = b""
+        else:
+            elements_by_layer = await get_data_source().fetch(
+                [layer], buffered_bounds(z, x, y), settings.MVT_MAX_POINTS, QUERY_TIMEOUT
+            )
+            data = encode_tile({layer: tile_features(layer, elements_by_layer[layer], z, x, y)})
+        rendered = (tile_etag(data), data)
+        cache.set(key, rendered)
+        return rendered
+
+    return await render_flight.do(key, render)
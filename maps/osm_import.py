@@ -0,0 +1,129 @@
+"""
+Lectura de extractos de OSM para el almacén local
+
+Formatos soportados, todos convertidos a nodos en formato Overpass
+({"type": "node", "id", "lat", "lon", "tags"}):
+
+- XML de OSM (.osm, también comprimido .osm.gz / .osm.bz2)
+- Volcado JSON de Overpass ([out:json])
+- PBF (.osm.pbf), que requiere el paquete opcional osmium (pyosmium)
+"""
+import bz2
+import gzip
+import json
+import xml.etree.ElementTree as ET
+from typing import IO, Iterator, Optional, Tuple
+
+Bbox = Tuple[float, float, float, float]
+
+
+def open_maybe_compressed(path: str) -> IO[bytes]:
+    """Abre un fichero en binario descomprimiendo .gz y .bz2"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def detect_format(path: str) -> str:
+    """Formato de un extracto según su extensión: 'pbf', 'json' o 'xml'"""
+    name = path.lower()
+    for suffix in ('.gz', '.bz2'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith('.pbf'):
+        return 'pbf'
+    if name.endswith('.json'):
+        return 'json'
+    return 'xml'
+
+
+class ExtractReader:
+    """
+    Iterador de los nodos con etiquetas de un extracto.
+
+    Tras recorrerlo, `bounds` contiene el área declarada en el fichero (si la
+    declara) y `extent` el área ocupada por los nodos leídos.
+    """
+
+    def __init__(self, path: str, fmt: Optional[str] = None):
+        self.path = path
+        self.format = fmt or detect_format(path)
+        self.bounds: Optional[Bbox] = None
+        self.extent: Optional[Bbox] = None
+        self.nodes_read = 0
+
+    def __iter__(self) -> Iterator[dict]:
+        readers = {'xml': self._iter_xml, 'json': self._iter_json, 'pbf': self._iter_pbf}
+        if self.format not in readers:
+            raise ValueError(f"Formato de extracto desconocido: {self.format}")
+        for element in readers[self.format]():
+            self.nodes_read += 1
+            self._extend(element["lat"], element["lon"])
+            yield element
+
+    def _extend(self, lat: float, lon: float) -> None:
+        if self.extent is None:
+            self.extent = (lat, lon, lat, lon)
+        else:
+            min_lat, min_lon, max_lat, max_lon = self.extent
+            self.extent = (min(min_lat, lat), min(min_lon, lon), max(max_lat, lat), max(max_lon, lon))
+
+    def _iter_xml(self) -> Iterator[dict]:
+        with open_maybe_compressed(self.path) as f:
+            context = ET.iterparse(f, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'start':
+                    if elem.tag == 'bounds':
+                        self.bounds = (
+                            float(elem.get('minlat')), float(elem.get('minlon')),
+                            float(elem.get('maxlat')), float(elem.get('maxlon')),
+                        )
+                    continue
+                if elem.tag == 'node':
+                    tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+                    if tags and elem.get('action') != 'delete':
+                        yield {
+                            "type": "node",
+                            "id": int(elem.get('id')),
+                            "lat": float(elem.get('lat')),
+                            "lon": float(elem.get('lon')),
+                            "tags": tags,
+                        }
+                if elem.tag in ('node', 'way', 'relation'):
+                    # Liberar memoria de los elementos ya procesados
+                    root.clear()
+
+    def _iter_json(self) -> Iterator[dict]:
+        with open_maybe_compressed(self.path) as f:
+            data = json.load(f)
+        for element in data.get("elements", []):
+            if element.get("type") == "node" and element.get("tags") and "lat" in element:
+                yield element
+
+    def _iter_pbf(self) -> Iterator[dict]:
+        try:
+            import osmium
+        except ImportError:
+            raise ValueError("Leer .osm.pbf requiere el paquete opcional osmium: pip install osmium")
+
+        reader = osmium.io.Reader(self.path, osmium.osm.osm_entity_bits.NOTHING)
+        try:
+            box = reader.header().box()
+        finally:
+            reader.close()
+        if box.valid():
+            self.bounds = (box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon)
+
+        for obj in osmium.FileProcessor(self.path, osmium.osm.NODE):
+            if not obj.tags:
+                continue
+            yield {
+                "type": "node",
+                "id": obj.id,
+                "lat": obj.location.lat,
+                "lon": obj.location.lon,
+                "tags": {tag.k: tag.v for tag in obj.tags},
+            }
@@ -0,0 +1,302 @@
+"""
+Consultas a la API de Overpass
+
+Cada consulta se envía al servidor más sano de OVERPASS_URLS y pasa por su
+planificador (cola por prioridad, ritmo adaptativo y circuit breaker, ver
+upstream.py). Los errores se convierten en OverpassError.
+"""
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+import httpx
+from django.conf import settings
+
+from .http_client import client_manager
+from .metrics import add_retry, add_stage, log_event, stage
+from .singleflight import SingleFlight
+from .streaming import ElementStreamParser
+from .upstream import Endpoint, EndpointPool, OverpassError, Priority, get_endpoint_pool, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Agrupación de consultas idénticas en curso
+overpass_flight = SingleFlight()
+
+
+StopCondition = Callable[[], Callable[[dict], bool]]
+
+
+async def query_overpass(query: str, stop_condition: Optional[StopCondition] = None,
+                         priority: Priority = Priority.INTERACTIVE, avoid: Iterable[str] = ()) -> dict:
+    """
+    Realiza una consulta a la API de Overpass (sin reintentos).
+
+    La respuesta se lee e interpreta en streaming, elemento a elemento.
+    `stop_condition` crea una función que se llama con cada elemento; en
+    cuanto devuelve True se deja de leer y se cierra la conexión.
+
+    Se usa el servidor más sano que no esté en `avoid`. Con OVERPASS_HEDGE,
+    si no responde antes de su p90 de latencia la consulta se repite en otro
+    servidor; se usa la primera respuesta correcta y se cancela la otra.
+    """
+    pool = get_endpoint_pool()
+    endpoint = pool.choose(avoid)
+    delay = pool.hedge_delay(endpoint)
+    if delay is None:
+        return await _query_endpoint(endpoint, query, stop_condition, priority)
+    return await _hedged_query(pool, endpoint, delay, query, stop_condition, priority, avoid)
+
+
+async def _hedged_query(pool: EndpointPool, primary: Endpoint, delay: float, query: str,
+                        stop_condition: Optional[StopCondition], priority: Priority, avoid: Iterable[str]) -> dict:
+    first = asyncio.ensure_future(_query_endpoint(primary, query, stop_condition, priority))
+    second = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        secondary = pool.choose({*avoid, primary.url})
+        if secondary is primary:
+            return await first
+
+        logger.info(f"Overpass ({primary.url}) no ha respondido en {delay:.2f}s, repitiendo la consulta en {secondary.url}")
+        secondary.record_hedge()
+        second = asyncio.ensure_future(_query_endpoint(secondary, query, stop_condition, priority))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        secondary.record_hedge(won=True)
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        # La consulta perdedora se cancela y su conexión se cierra
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def _query_endpoint(endpoint: Endpoint, query: str, stop_condition: Optional[StopCondition],
+                          priority: Priority) -> dict:
+    start_time = time.time()
+    log_event(logger, logging.DEBUG, "overpass_query", endpoint=endpoint.url, chars=len(query))
+
+    timeout = httpx.Timeout(60.0, connect=10.0, read=60.0, write=10.0)
+
+    done = stop_condition() if stop_condition is not None else None
+
+    async def consume(response: httpx.Response) -> tuple:
+        # Se ejecuta en el loop del cliente HTTP: el tiempo de decodificación se
+        # devuelve y se anota en la petición desde el loop que la atiende
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+
+        parser = ElementStreamParser()
+        elements = []
+        first_element_time = None
+        decode_time = 0.0
+        async for chunk in response.aiter_bytes():
+            decode_start = time.perf_counter()
+            batch = parser.feed(chunk, done)
+            decode_time += time.perf_counter() - decode_start
+            if batch and first_element_time is None:
+                first_element_time = time.time() - request_start
+            elements.extend(batch)
+            if parser.stopped:
+                # Todas las capas tienen ya su límite: no se lee el resto de la respuesta
+                await response.aclose()
+                return elements, first_element_time, True, decode_time
+        parser.close()
+        return elements, first_element_time, False, decode_time
+
+    async with _endpoint_slot(endpoint, priority):
+        try:
+            request_start = time.time()
+            elements, first_element_time, stopped, decode_time = await client_manager.stream(
+                'POST', endpoint.url, consume, data=query, timeout=timeout
+            )
+            endpoint.record_success(time.time() - request_start)
+            add_stage('decode', decode_time)
+            log_event(logger, logging.INFO, "overpass_ok", endpoint=endpoint.url, elements=len(elements),
+                      stopped=stopped, first_element=first_element_time if first_element_time is not None else '-',
+                      decode=decode_time, total=time.time() - start_time)
+
+            return {"elements": elements}
+
+        except Exception as e:
+            raise _overpass_error(e, start_time, endpoint)
+
+
+@asynccontextmanager
+async def _endpoint_slot(endpoint: Endpoint, priority: Priority):
+    """Hueco en el planificador del servidor; sus errores (circuito abierto, cola llena) indican el servidor"""
+    try:
+        async with endpoint.scheduler.slot(priority):
+            yield
+    except OverpassError as e:
+        e.endpoint = e.endpoint or endpoint.url
+        raise
+
+
+def _overpass_error(e: Exception, start_time: float, endpoint: Endpoint) -> OverpassError:
+    """
+    Registra un error de una consulta a Overpass, lo anota en las estadísticas
+    del servidor y lo convierte en la excepción que ven las vistas
+    """
+    error = _classify_error(e, time.time() - start_time, endpoint.url)
+    if error.retryable:
+        endpoint.record_failure()
+    return error
+
+
+def _classify_error(e: Exception, total_time: float, url: str) -> OverpassError:
+    if isinstance(e, OverpassError):
+        return e
+    if isinstance(e, httpx.TimeoutException):
+        logger.error(f"TIMEOUT consultando Overpass API ({url}) en {total_time:.2f}s: {str(e)}")
+        return OverpassError(f"Timeout al consultar Overpass API", kind='timeout', endpoint=url)
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+        logger.error(f"Error HTTP {status_code} consultando Overpass API ({url}) en {total_time:.2f}s. Response: {e.response.text[:200]}")
+        retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+        if status_code == 504:
+            return OverpassError(f"Gateway Timeout desde Overpass API", kind='http', status_code=504,
+                                 retry_after=retry_after, endpoint=url)
+        return OverpassError(f"Error HTTP {status_code} al consultar Overpass API", kind='http',
+                             status_code=status_code, retry_after=retry_after, endpoint=url)
+    if isinstance(e, httpx.RequestError):
+        logger.error(f"Error de conexión consultando Overpass API ({url}) en {total_time:.2f}s: {str(e)}")
+        return OverpassError(f"Error de conexión con Overpass API: {str(e)}", kind='connection', endpoint=url)
+    logger.error(f"Error inesperado consultando Overpass API ({url}) en {total_time:.2f}s: {str(e)}")
+    return OverpassError(f"Error inesperado al consultar Overpass API: {str(e)}", kind='unexpected', endpoint=url)
+
+
+async def stream_overpass(query: str, stop_condition: Optional[StopCondition] = None,
+                          priority: Priority = Priority.INTERACTIVE) -> AsyncIterator[list]:
+    """
+    Consulta Overpass y devuelve los elementos por lotes a medida que llegan.
+
+    A diferencia de query_overpass_with_retry no hay reintentos (ya se han
+    entregado datos), cobertura en otro servidor ni agrupación de consultas
+    idénticas. El hueco del planificador se ocupa hasta que se termina de leer
+    la respuesta.
+    """
+    start_time = time.time()
+    endpoint = get_endpoint_pool().choose()
+    log_event(logger, logging.DEBUG, "overpass_stream", endpoint=endpoint.url, chars=len(query))
+    timeout = httpx.Timeout(60.0, connect=10.0, read=60.0, write=10.0)
+    done = stop_condition() if stop_condition is not None else None
+
+    # La respuesta se lee en el loop del cliente HTTP, que puede ser otro hilo:
+    # los lotes se pasan a este loop con call_soon_threadsafe
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    decode_time = 0.0
+
+    async def consume(response: httpx.Response) -> None:
+        nonlocal decode_time
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        parser = ElementStreamParser()
+        async for chunk in response.aiter_bytes():
+            decode_start = time.perf_counter()
+            batch = parser.feed(chunk, done)
+            decode_time += time.perf_counter() - decode_start
+            if batch:
+                loop.call_soon_threadsafe(queue.put_nowait, batch)
+            if parser.stopped:
+                await response.aclose()
+                return
+        parser.close()
+
+    async with _endpoint_slot(endpoint, priority):
+        task = asyncio.ensure_future(client_manager.stream('POST', endpoint.url, consume, data=query, timeout=timeout))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        count = 0
+        try:
+            while True:
+                # Solo cuenta como espera a Overpass el tiempo sin lotes pendientes
+                with stage('upstream'):
+                    batch = await queue.get()
+                if batch is None:
+                    break
+                count += len(batch)
+                yield batch
+            try:
+                await task
+            except Exception as e:
+                raise _overpass_error(e, start_time, endpoint)
+            endpoint.record_success(time.time() - start_time)
+            add_stage('decode', decode_time)
+            log_event(logger, logging.INFO, "overpass_stream_ok", endpoint=endpoint.url, elements=count,
+                      decode=decode_time, total=time.time() - start_time)
+        finally:
+            if not task.done():
+                task.cancel()
+
+
+async def query_overpass_with_retry(query: str, max_retries: int = 2, initial_delay: float = 1.5, backoff_factor: float = 2.0,
+                                    stop_condition: Optional[StopCondition] = None,
+                                    priority: Priority = Priority.INTERACTIVE) -> dict:
+    """
+    Ejecuta la consulta a Overpass con reintentos ante errores transitorios.
+
+    Se reintentan los timeouts, los errores de conexión y los HTTP 429, 502,
+    503 y 504: de inmediato en otro servidor si queda alguno sin probar y, si
+    no, con espera exponencial aleatorizada o la que pida Retry-After. Con un
+    circuito abierto, una cola llena o un Retry-After mayor que
+    OVERPASS_MAX_RETRY_WAIT se falla de inmediato.
+
+    Las consultas idénticas que ya están en curso no se repiten: todas las
+    peticiones comparten el resultado (o el error) de la primera, así que
+    `stop_condition` (ver query_overpass) debe depender solo de la consulta.
+    """
+    key = " ".join(query.split())
+    with stage('upstream'):
+        return await overpass_flight.do(
+            key, lambda: _query_overpass_with_retry(query, max_retries, initial_delay, backoff_factor, stop_condition, priority)
+        )
+
+
+async def _query_overpass_with_retry(query: str, max_retries: int, initial_delay: float, backoff_factor: float,
+                                     stop_condition: Optional[StopCondition], priority: Priority) -> dict:
+    pool = get_endpoint_pool()
+    attempt = 0
+    delay = initial_delay
+    failed = set()
+    while True:
+        try:
+            return await query_overpass(query, stop_condition, priority, avoid=failed)
+        except OverpassError as exc:
+            if not exc.retryable or attempt >= max_retries:
+                raise
+            endpoint = pool.get(exc.endpoint)
+            if endpoint is not None:
+                failed.add(endpoint.url)
+                if exc.rate_limited:
+                    await endpoint.scheduler.refresh_status()
+            if any(other.url not in failed and other.available() for other in pool.endpoints):
+                attempt += 1
+                add_retry()
+                logger.warning(f"Intento {attempt}/{max_retries} tras error de Overpass ({exc}). Reintentando en otro servidor")
+                continue
+            # Espera aleatorizada para que los reintentos de varias peticiones no coincidan
+            wait = max(exc.retry_after or 0.0, delay * random.uniform(0.5, 1.5))
+            if wait > settings.OVERPASS_MAX_RETRY_WAIT:
+                logger.warning(f"Overpass pide esperar {wait:.0f}s, no se reintenta")
+                raise
+            attempt += 1
+            add_retry()
+            logger.warning(f"Intento {attempt}/{max_retries} tras error de Overpass ({exc}). Reintentando en {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay *= backoff_factor
@@ -0,0 +1,99 @@
+"""
+Conversión por lotes de elementos OSM a la salida de la API
+
+Convierte la lista `elements` de Overpass (o del almacén local) en los
+diccionarios de /api/trees y /api/stumps en una sola pasada, sin crear un
+modelo Pydantic por elemento. Los diccionarios tienen los mismos campos que
+los modelos Tree y Stump de views.py, que siguen siendo el esquema de la API.
+
+Las etiquetas numéricas que no se pueden convertir quedan a None en lugar de
+descartar el elemento, y todos los elementos de un lote comparten la misma
+fecha: la de obtención de los datos (ver data_time), para que la misma
+respuesta tenga siempre el mismo contenido y ETag.
+"""
+import logging
+import math
+from datetime import datetime
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def parse_float_tag(value) -> Optional[float]:
+    """Valor numérico de una etiqueta OSM, o None si falta o no es un número"""
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def parse_int_tag(value) -> Optional[int]:
+    """Valor entero de una etiqueta OSM, o None si falta o no es un entero"""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def data_time(fetched_at: Optional[float]) -> datetime:
+    """Fecha de los datos: cuándo se obtuvieron si se conoce, si no la actual"""
+    return datetime.fromtimestamp(fetched_at) if fetched_at is not None else datetime.now()
+
+
+def parse_trees(elements: list, limit: int, now: Optional[datetime] = None) -> List[dict]:
+    """Convierte hasta `limit` elementos en árboles de la API, descartando los que no son nodos válidos"""
+    now = now or datetime.now()
+    trees = []
+    append = trees.append
+    for element in elements[:limit]:
+        if element.get("type") != "node":
+            continue
+        try:
+            osm_id, lat, lon = element["id"], float(element["lat"]), float(element["lon"])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Elemento sin id o coordenadas: {element.get('id', 'unknown')}")
+            continue
+        tags = element.get("tags") or {}
+        append({
+            "id": f"tree_{osm_id}",
+            "lat": lat,
+            "lon": lon,
+            "species": tags.get("species"),
+            "height": parse_float_tag(tags.get("height")),
+            "diameter": parse_float_tag(tags.get("diameter")),
+            "age": parse_int_tag(tags.get("age")),
+            "health": tags.get("health"),
+            "last_updated": now,
+        })
+    return trees
+
+
+def parse_stumps(elements: list, limit: int, now: Optional[datetime] = None) -> List[dict]:
+    """Convierte hasta `limit` elementos en tocones de la API, descartando los que no son nodos válidos"""
+    now = now or datetime.now()
+    stumps = []
+    append = stumps.append
+    for element in elements[:limit]:
+        if element.get("type") != "node":
+            continue
+        try:
+            osm_id, lat, lon = element["id"], float(element["lat"]), float(element["lon"])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Elemento sin id o coordenadas: {element.get('id', 'unknown')}")
+            continue
+        tags = element.get("tags") or {}
+        append({
+            "id": f"stump_{osm_id}",
+            "lat": lat,
+            "lon": lon,
+            "species": tags.get("species"),
+            "diameter": parse_float_tag(tags.get("diameter")),
+            "removal_date": now,  # OSM no suele tener esta info
+            "reason": tags.get("removal_reason"),
+        })
+    return stumps
@@ -0,0 +1,283 @@
+"""
+Planificador de consultas de bbox grandes
+
+Los bbox que no caben en la caché de teselas se consultaban a Overpass con
+una sola consulta, que en las vistas amplias es la que más a menudo agota el
+tiempo. El planificador los divide en una rejilla de celdas:
+
+- el número de celdas sale de la densidad de elementos observada en la zona
+  (DensityMap, alimentada por las teselas descargadas y las propias celdas)
+  para que cada una devuelva unos PLANNER_CELL_TARGET elementos, y ninguna
+  celda supera PLANNER_MAX_CELL_AREA grados²;
+- las celdas se consultan en paralelo, con como mucho PLANNER_CONCURRENCY en
+  vuelo por petición (además del límite por servidor del planificador de
+  upstream.py);
+- con límite, cada celda pide solo su parte (ver QueryPlanner.cell_limit),
+  para que dividir en N celdas no descargue hasta N veces más elementos de
+  los que se devuelven;
+- los resultados se unen sin duplicados (los nodos del borde entre celdas
+  aparecen en ambas) y, si hay límite, se reparte entre las celdas por turnos
+  para que el muestreo cubra todo el bbox y no solo las primeras celdas;
+- si fallan algunas celdas se devuelven las demás, marcando el resultado
+  como parcial; solo si fallan todas se propaga el error.
+"""
+import asyncio
+import logging
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .metrics import log_event, stage, subtask
+from .tiles import count_tiles_for_bbox, lat_lon_to_tile, tiles_for_bbox
+from .upstream import OverpassError
+
+logger = logging.getLogger(__name__)
+
+Bbox = Tuple[float, float, float, float]
+
+# Peso de cada observación nueva en la media de densidad de una tesela
+DENSITY_ALPHA = 0.3
+# Teselas de densidad consultadas como mucho al estimar un bbox; por encima se usa la media de la capa
+DENSITY_MAX_TILES = 256
+
+
+def bbox_area(bbox: Bbox) -> float:
+    """Área en grados² (la misma medida que usan las vistas para limitar)"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return abs(max_lat - min_lat) * abs(max_lon - min_lon)
+
+
+class DensityMap:
+    """
+    Densidad observada de elementos por capa, en elementos por grado², como
+    media exponencial por tesela de zoom `zoom` y por capa
+    """
+
+    def __init__(self, zoom: int, max_tiles: int = 10000):
+        self.zoom = zoom
+        self.max_tiles = max_tiles
+        self._tiles: OrderedDict = OrderedDict()  # (capa, x, y) -> densidad
+        self._layers: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, layer: str, bbox: Bbox, count: int) -> None:
+        """Registra que en `bbox` hay `count` elementos de la capa (resultado completo, sin límite)"""
+        area = bbox_area(bbox)
+        if area <= 0:
+            return
+        density = count / area
+        x, y = lat_lon_to_tile((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2, self.zoom)
+        with self._lock:
+            key = (layer, x, y)
+            previous = self._tiles.pop(key, None)
+            self._tiles[key] = density if previous is None else previous + DENSITY_ALPHA * (density - previous)
+            if len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+            previous = self._layers.get(layer)
+            self._layers[layer] = density if previous is None else previous + DENSITY_ALPHA * (density - previous)
+
+    def estimate(self, layers: List[str], bbox: Bbox) -> Optional[float]:
+        """Elementos estimados en el bbox para las capas dadas, o None si no hay observaciones"""
+        area = bbox_area(bbox)
+        many = count_tiles_for_bbox(*bbox, self.zoom) > DENSITY_MAX_TILES
+        tiles = [] if many else tiles_for_bbox(*bbox, self.zoom)
+        total = 0.0
+        known = False
+        with self._lock:
+            for layer in layers:
+                densities = [self._tiles[key] for key in ((layer, x, y) for _, x, y in tiles) if key in self._tiles]
+                if densities:
+                    density = sum(densities) / len(densities)
+                elif layer in self._layers:
+                    density = self._layers[layer]
+                else:
+                    continue
+                known = True
+                total += density * area
+        return total if known else None
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+
+def grid_cells(bbox: Bbox, count: int) -> List[Bbox]:
+    """Divide el bbox en al menos `count` celdas lo más cuadradas posible (en grados)"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if count <= 1:
+        return [bbox]
+    height = max(max_lat - min_lat, 1e-9)
+    width = max(max_lon - min_lon, 1e-9)
+    cols = max(1, round(math.sqrt(count * width / height)))
+    rows = math.ceil(count / cols)
+    cells = []
+    for row in range(rows):
+        lat0 = min_lat + height * row / rows
+        lat1 = min_lat + height * (row + 1) / rows if row < rows - 1 else max_lat
+        for col in range(cols):
+            lon0 = min_lon + width * col / cols
+            lon1 = min_lon + width * (col + 1) / cols if col < cols - 1 else max_lon
+            cells.append((lat0, lon0, lat1, lon1))
+    return cells
+
+
+def fair_sample(groups: List[list], limit: Optional[int]) -> list:
+    """
+    Hasta `limit` elementos tomados por turnos de cada grupo: los grupos con
+    pocos elementos entran enteros y el resto se reparte por igual
+    """
+    total = sum(len(group) for group in groups)
+    if limit is None or total <= limit:
+        return [element for group in groups for element in group]
+    sample = []
+    for index in range(max(len(group) for group in groups)):
+        for group in groups:
+            if index < len(group):
+                sample.append(group[index])
+                if len(sample) == limit:
+                    return sample
+    return sample
+
+
+@dataclass
+class PlanResult:
+    elements_by_layer: Dict[str, list]
+    cells: int
+    failed: int
+
+
+CellFetcher = Callable[[Bbox], Awaitable[Dict[str, list]]]
+
+
+class QueryPlanner:
+    """Divide, consulta en paralelo y une las consultas de bbox grandes"""
+
+    def __init__(self, density: DensityMap, max_cell_area: float, cell_target: int, max_cells: int,
+                 concurrency: int, min_cell_limit: int = 50):
+        self.density = density
+        self.max_cell_area = max_cell_area
+        self.cell_target = cell_target
+        self.max_cells = max_cells
+        self.concurrency = concurrency
+        self.min_cell_limit = min_cell_limit
+        self._lock = threading.Lock()
+        self.plans = 0
+        self.cells = 0
+        self.failed_cells = 0
+        self.partial = 0
+
+    def plan(self, layers: List[str], bbox: Bbox) -> List[Bbox]:
+        """Celdas en que dividir el bbox según su área y la densidad estimada"""
+        # El margen evita una celda de más por el redondeo cuando el área es justo un múltiplo
+        count = math.ceil(bbox_area(bbox) / self.max_cell_area - 1e-9) if self.max_cell_area > 0 else 1
+        estimated = self.density.estimate(layers, bbox)
+        if estimated is not None and self.cell_target > 0:
+            count = max(count, math.ceil(estimated / self.cell_target))
+        return grid_cells(bbox, min(max(count, 1), self.max_cells))
+
+    def cell_limit(self, limit: Optional[int], cells: int) -> Optional[int]:
+        """
+        Límite por capa de cada celda: su parte del límite total, como mínimo
+        `min_cell_limit`. Las celdas poco pobladas no agotan su parte y el
+        resultado puede quedar por debajo del límite aunque otras celdas tengan
+        más elementos; a cambio, lo descargado no pasa de unas `limit`
+        (o cells * min_cell_limit) filas por capa.
+        """
+        if limit is None:
+            return None
+        return min(limit, max(math.ceil(limit / max(cells, 1)), self.min_cell_limit))
+
+    async def fetch(self, layers: List[str], cells: List[Bbox], limit: Optional[int], fetch_cell: CellFetcher,
+                    observe: bool = True) -> PlanResult:
+        """
+        Consulta las celdas con `fetch_cell` (celda -> capa -> elementos, con
+        como mucho cell_limit(limit) por capa) y une los resultados. Con
+        `observe` los resultados completos (por debajo del límite de la celda)
+        actualizan la densidad; no debe usarse con filtros.
+        """
+        cell_limit = self.cell_limit(limit, len(cells))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(cell: Bbox) -> Dict[str, list]:
+            async with semaphore:
+                # Cada celda mide su espera a Overpass aparte; la etapa upstream es la del conjunto
+                with subtask():
+                    return await fetch_cell(cell)
+
+        with stage('upstream'):
+            results = await asyncio.gather(*(run(cell) for cell in cells), return_exceptions=True)
+
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors:
+            if not isinstance(error, OverpassError):
+                raise error
+        with self._lock:
+            self.plans += 1
+            self.cells += len(cells)
+            self.failed_cells += len(errors)
+            if errors and len(errors) < len(cells):
+                self.partial += 1
+        if len(errors) == len(cells):
+            raise errors[0]
+        if errors:
+            logger.warning(f"{len(errors)} de {len(cells)} celdas fallaron ({errors[0]}), resultado parcial")
+
+        elements_by_layer = {}
+        for layer in layers:
+            seen = set()
+            groups = []
+            for cell, result in zip(cells, results):
+                if isinstance(result, BaseException):
+                    continue
+                cell_elements = result.get(layer, [])
+                if observe and (cell_limit is None or len(cell_elements) < cell_limit):
+                    self.density.observe(layer, cell, len(cell_elements))
+                group = []
+                for element in cell_elements:
+                    key = (element.get("type"), element.get("id"))
+                    if key not in seen:
+                        seen.add(key)
+                        group.append(element)
+                groups.append(group)
+            elements_by_layer[layer] = fair_sample(groups, limit)
+        log_event(logger, logging.DEBUG, "query_plan", cells=len(cells), failed=len(errors),
+                  **{layer: len(elements) for layer, elements in elements_by_layer.items()})
+        return PlanResult(elements_by_layer, len(cells), len(errors))
+
+    def stats(self) -> dict:
+        """Consultas divididas, celdas consultadas y fallidas, y respuestas parciales"""
+        with self._lock:
+            return {
+                "plans": self.plans,
+                "cells": self.cells,
+                "failed_cells": self.failed_cells,
+                "partial": self.partial,
+                "density_tiles": len(self.density),
+            }
+
+
+_planner: Optional[QueryPlanner] = None
+
+
+def get_query_planner() -> QueryPlanner:
+    """Planificador del proceso, configurado desde settings"""
+    global _planner
+    if _planner is None:
+        _planner = QueryPlanner(
+            DensityMap(settings.PLANNER_DENSITY_ZOOM),
+            max_cell_area=settings.PLANNER_MAX_CELL_AREA,
+            cell_target=settings.PLANNER_CELL_TARGET,
+            max_cells=settings.PLANNER_MAX_CELLS,
+            concurrency=settings.PLANNER_CONCURRENCY,
+            min_cell_limit=settings.PLANNER_MIN_CELL_LIMIT,
+        )
+    return _planner
+
+
+def set_query_planner(planner: Optional[QueryPlanner]) -> None:
+    """Sustituye el planificador del proceso (pruebas); None lo vuelve a crear desde settings"""
+    global _planner
+    _planner = planner
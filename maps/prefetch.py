@@ -0,0 +1,145 @@
+"""
+Precarga de teselas alrededor de las vistas recientes y de las zonas más visitadas
+
+Cada petición del mapa registra las teselas que ha usado. En el event loop de
+segundo plano se precargan:
+
+- las teselas vecinas de cada vista (PREFETCH_MARGIN teselas alrededor), ya
+  que los usuarios suelen desplazar el mapa poco a poco;
+- cada PREFETCH_INTERVAL segundos, las PREFETCH_HOT_TILES teselas más
+  visitadas, con un contador que decae con una vida media de
+  PREFETCH_HALF_LIFE segundos, antes de que caduquen;
+- las teselas de la próxima vista que anuncia el cliente (ver DataSource.prefetch).
+
+Las descargas pasan por la cola de refresco (ver refresh.py), con prioridad
+de segundo plano, y solo se encolan si Overpass tiene capacidad libre.
+"""
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .background import background_loop
+from .refresh import TileRefresher
+from .tiles import Tile, TileCache, TileKey, neighbour_tiles
+from .upstream import get_endpoint_pool
+
+logger = logging.getLogger(__name__)
+
+
+class TileAccessStats:
+    """Contador de accesos por tesela que decae exponencialmente con el tiempo"""
+
+    def __init__(self, half_life: float, max_tracked: int):
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self._scores: Dict[TileKey, Tuple[float, float]] = {}  # clave -> (puntuación, actualizada)
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, updated: float, now: float) -> float:
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def record(self, keys: List[TileKey]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                score, updated = self._scores.get(key, (0.0, now))
+                self._scores[key] = (self._decayed(score, updated, now) + 1, now)
+            if len(self._scores) > self.max_tracked:
+                # Olvidar la mitad menos visitada
+                keep = heapq.nlargest(self.max_tracked // 2, self._scores.items(),
+                                      key=lambda item: self._decayed(*item[1], now))
+                self._scores = dict(keep)
+
+    def hottest(self, count: int) -> List[TileKey]:
+        """Las `count` teselas con más accesos recientes"""
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._scores.items())
+        return [key for key, _ in heapq.nlargest(count, items, key=lambda item: self._decayed(*item[1], now))]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+class Prefetcher:
+    """Elige las teselas a precargar y las encola en el TileRefresher"""
+
+    def __init__(self, refresher: TileRefresher, cache: TileCache, margin: int, hot_tiles: int,
+                 interval: float, half_life: float, max_tracked: int, batch_size: int):
+        self.refresher = refresher
+        self.cache = cache
+        self.margin = margin
+        self.hot_tiles = hot_tiles
+        self.interval = interval
+        self.batch_size = batch_size
+        self.access = TileAccessStats(half_life, max_tracked)
+        self._hot_task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.skipped = 0
+
+    def record(self, layers: List[str], tiles: List[Tile]) -> None:
+        """Registra una vista servida y precarga sus teselas vecinas"""
+        self.access.record([(layer, z, x, y) for layer in layers for z, x, y in tiles])
+        loop = background_loop.loop
+        if self.hot_tiles > 0 and self._hot_task is None:
+            loop.call_soon_threadsafe(self._start_hot_task)
+        if self.margin > 0:
+            loop.call_soon_threadsafe(self._prefetch, layers, neighbour_tiles(tiles, self.margin), 0.0)
+
+    def hint(self, layers: List[str], tiles: List[Tile]) -> None:
+        """Precarga la próxima vista que anuncia el cliente"""
+        background_loop.loop.call_soon_threadsafe(self._prefetch, layers, tiles, 0.0)
+
+    def _prefetch(self, layers: List[str], tiles: List[Tile], horizon: float) -> int:
+        """Encola las teselas que faltan o caducan en menos de `horizon` segundos"""
+        keys = [(layer, z, x, y) for layer in layers for z, x, y in tiles]
+        return self._schedule(keys, horizon)
+
+    def _schedule(self, keys: List[TileKey], horizon: float) -> int:
+        now = time.time()
+        wanted = []
+        for key in keys:
+            fetched_at = self.cache.peek(key)
+            if fetched_at is None or now - fetched_at > self.cache.ttl - horizon:
+                wanted.append(key)
+        if not wanted:
+            return 0
+        if not get_endpoint_pool().has_spare_capacity():
+            with self._lock:
+                self.skipped += len(wanted)
+            logger.debug(f"Overpass sin capacidad libre, se omite la precarga de {len(wanted)} teselas")
+            return 0
+        scheduled = 0
+        for start in range(0, len(wanted), self.batch_size):
+            scheduled += self.refresher.schedule(wanted[start:start + self.batch_size])
+        with self._lock:
+            self.scheduled += scheduled
+        return scheduled
+
+    def _start_hot_task(self) -> None:
+        if self._hot_task is None:
+            self._hot_task = background_loop.loop.create_task(self._warm_hot_tiles(), name="tile-prefetch-hot")
+
+    async def _warm_hot_tiles(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Las que caducarían antes de la próxima pasada se refrescan ya
+                scheduled = self._schedule(self.access.hottest(self.hot_tiles), self.interval)
+                if scheduled:
+                    logger.info(f"Precarga de zonas frecuentes: {scheduled} teselas encoladas")
+            except Exception as e:
+                logger.warning(f"Error en la precarga de zonas frecuentes: {e}")
+
+    def stats(self) -> dict:
+        """Teselas seguidas, encoladas y omitidas por falta de capacidad"""
+        with self._lock:
+            return {
+                "tracked": len(self.access),
+                "scheduled": self.scheduled,
+                "skipped": self.skipped,
+            }
@@ -0,0 +1,105 @@
+"""
+Refresco en segundo plano de teselas caducadas (stale-while-revalidate)
+
+Las teselas que caducaron hace poco se sirven al momento desde la caché y se
+encolan aquí para volver a pedirlas a Overpass. Un número fijo de workers en
+el event loop de segundo plano vacía la cola, de modo que el refresco no
+retrasa la respuesta ni ocupa más huecos de Overpass de los configurados.
+"""
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from .background import background_loop
+from .tiles import TileKey
+
+logger = logging.getLogger(__name__)
+
+
+class TileRefresher:
+    """
+    Cola de lotes de teselas a refrescar con `workers` tareas consumidoras.
+
+    Una tesela ya encolada o en curso no se vuelve a encolar, y por encima de
+    `max_pending` teselas pendientes los lotes nuevos se descartan: se
+    refrescarán en una petición posterior.
+    """
+
+    def __init__(self, fetch: Callable[[List[TileKey]], Awaitable[object]], workers: int, max_pending: int):
+        self._fetch = fetch
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending: Set[TileKey] = set()
+        self._lock = threading.Lock()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self.scheduled = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def schedule(self, keys: Iterable[TileKey]) -> int:
+        """Encola las teselas que no estén ya pendientes. Devuelve cuántas se han encolado"""
+        with self._lock:
+            batch = [key for key in keys if key not in self._pending]
+            if not batch:
+                return 0
+            if len(self._pending) + len(batch) > self.max_pending:
+                self.dropped += len(batch)
+                return 0
+            self._pending.update(batch)
+            self.scheduled += len(batch)
+        background_loop.loop.call_soon_threadsafe(self._enqueue, batch)
+        return len(batch)
+
+    def _enqueue(self, batch: List[TileKey]) -> None:
+        # Se ejecuta en el loop de segundo plano: la cola y los workers viven en él
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [background_loop.loop.create_task(self._worker(), name=f"tile-refresh-{i}")
+                             for i in range(self.workers)]
+        self._queue.put_nowait(batch)
+
+    async def _worker(self) -> None:
+        queue = self._queue
+        while True:
+            batch = await queue.get()
+            try:
+                await self._fetch(batch)
+                with self._lock:
+                    self.refreshed += len(batch)
+                logger.debug(f"Refrescadas {len(batch)} teselas en segundo plano")
+            except Exception as e:
+                with self._lock:
+                    self.failed += len(batch)
+                logger.warning(f"Error refrescando {len(batch)} teselas en segundo plano: {e}")
+            finally:
+                with self._lock:
+                    self._pending.difference_update(batch)
+                queue.task_done()
+
+    def close(self) -> None:
+        """Detiene los workers y descarta las teselas pendientes"""
+        loop = background_loop.started_loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._cancel_workers)
+
+    def _cancel_workers(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        self._queue = None
+        with self._lock:
+            self._pending.clear()
+
+    def stats(self) -> dict:
+        """Contadores de teselas encoladas, refrescadas, fallidas y descartadas"""
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "scheduled": self.scheduled,
+                "refreshed": self.refreshed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,199 @@
+"""
+Replicación incremental del almacén local a partir de diffs de OSM
+
+Aplica ficheros osmChange (.osc, .osc.gz) a los nodos natural=tree y
+natural=tree_stump del almacén local, guarda el número de secuencia de
+replicación e invalida solo las teselas de la caché afectadas.
+
+Cada diff que cambia algo incrementa la versión de los datos del almacén
+(ver LocalStore.bump_data_version). Los workers la releen cada segundo y con
+ella cambian las claves de las cachés de teselas MVT y de estadísticas y la
+versión con que se validan los ETag, así que los cambios llegan a todos los
+procesos sin esperar al TTL.
+
+Los diffs se pueden leer de ficheros locales o descargar de un servidor de
+replicación (p. ej. https://planet.openstreetmap.org/replication/minute).
+"""
+import gzip
+import io
+import logging
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import IO, Iterable, Iterator, List, Optional, Set, Tuple
+
+import httpx
+
+from .datasources import LAYER_FILTERS, element_layer
+from .local_store import LocalStore
+from .tiles import TileCache, lat_lon_to_tile
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_KEY = 'replication_sequence'
+TIMESTAMP_KEY = 'replication_timestamp'
+URL_KEY = 'replication_url'
+
+
+@dataclass
+class NodeChange:
+    action: str  # create, modify o delete
+    id: int
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    tags: dict = field(default_factory=dict)
+
+    def as_element(self) -> dict:
+        return {"type": "node", "id": self.id, "lat": self.lat, "lon": self.lon, "tags": self.tags}
+
+
+@dataclass
+class ReplicationResult:
+    created: int = 0
+    modified: int = 0
+    deleted: int = 0
+    skipped: int = 0
+    touched_tiles: Set[Tuple[int, int, int]] = field(default_factory=set)
+
+    def merge(self, other: 'ReplicationResult') -> None:
+        self.created += other.created
+        self.modified += other.modified
+        self.deleted += other.deleted
+        self.skipped += other.skipped
+        self.touched_tiles |= other.touched_tiles
+
+
+def parse_osmchange(source: IO[bytes]) -> Iterator[NodeChange]:
+    """Cambios de nodos de un fichero osmChange, en orden"""
+    action = None
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem.tag
+            continue
+        if elem.tag == 'node' and action is not None:
+            lat, lon = elem.get('lat'), elem.get('lon')
+            yield NodeChange(
+                action=action,
+                id=int(elem.get('id')),
+                lat=float(lat) if lat is not None else None,
+                lon=float(lon) if lon is not None else None,
+                tags={tag.get('k'): tag.get('v') for tag in elem.iter('tag')},
+            )
+        if elem.tag in ('create', 'modify', 'delete'):
+            action = None
+        if elem.tag in ('node', 'way', 'relation', 'create', 'modify', 'delete'):
+            # Liberar memoria de los elementos ya procesados
+            root.clear()
+
+
+def open_osmchange(path: str) -> IO[bytes]:
+    """Abre un fichero osmChange, descomprimiendo .gz"""
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _in_areas(lat: float, lon: float, areas: List[tuple]) -> bool:
+    return any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon for min_lat, min_lon, max_lat, max_lon in areas)
+
+
+def apply_changes(store: LocalStore, changes: Iterable[NodeChange], zoom: int) -> ReplicationResult:
+    """
+    Aplica cambios de nodos al almacén.
+
+    Los nodos que ya están en el almacén se actualizan o eliminan siempre; los
+    nodos nuevos solo se añaden si caen dentro de un área importada (si el
+    almacén tiene áreas registradas), para no acumular datos del resto del
+    planeta al aplicar diffs globales.
+    """
+    result = ReplicationResult()
+    changes = list(changes)
+    if not changes:
+        return result
+
+    # Último cambio de cada nodo dentro del diff
+    latest = {}
+    for change in changes:
+        latest[change.id] = change
+    previous = store.get_positions(latest.keys())
+    areas = store.coverage_areas()
+
+    upserts, deletes = [], []
+    for node_id, change in latest.items():
+        old_position = previous.get(node_id)
+        layer = element_layer(change.as_element()) if change.action != 'delete' else None
+
+        if layer is None:
+            # Borrado, o el nodo ha dejado de ser un árbol/tocón
+            if old_position is not None:
+                deletes.append(node_id)
+                result.deleted += 1
+                result.touched_tiles.add((zoom, *lat_lon_to_tile(*old_position, zoom)))
+            else:
+                result.skipped += 1
+            continue
+
+        if old_position is None and areas and not _in_areas(change.lat, change.lon, areas):
+            result.skipped += 1
+            continue
+
+        upserts.append(change.as_element())
+        if old_position is None:
+            result.created += 1
+        else:
+            result.modified += 1
+            result.touched_tiles.add((zoom, *lat_lon_to_tile(*old_position, zoom)))
+        result.touched_tiles.add((zoom, *lat_lon_to_tile(change.lat, change.lon, zoom)))
+
+    if deletes:
+        store.delete_nodes(deletes)
+    if upserts:
+        store.upsert_nodes(upserts, element_layer)
+    if deletes or upserts:
+        store.bump_data_version()
+    return result
+
+
+def invalidate_tiles(cache: TileCache, tiles: Iterable[Tuple[int, int, int]]) -> int:
+    """Invalida en la caché las teselas tocadas, para todas las capas"""
+    keys = [(layer, z, x, y) for layer in LAYER_FILTERS for z, x, y in tiles]
+    return cache.invalidate(keys)
+
+
+# Servidor de replicación
+def parse_state(text: str) -> dict:
+    """Interpreta un fichero state.txt de replicación"""
+    state = {}
+    for line in text.splitlines():
+        if '=' in line and not line.startswith('#'):
+            key, value = line.split('=', 1)
+            state[key.strip()] = value.strip().replace('\\:', ':')
+    return state
+
+
+def sequence_path(sequence: int) -> str:
+    """Ruta relativa de un diff: 5123456 -> 005/123/456"""
+    padded = f"{sequence:09d}"
+    return f"{padded[0:3]}/{padded[3:6]}/{padded[6:9]}"
+
+
+class ReplicationClient:
+    """Descarga estados y diffs de un servidor de replicación de OSM"""
+
+    def __init__(self, base_url: str, timeout: float = 60.0):
+        self.base_url = base_url.rstrip('/')
+        self.client = httpx.Client(timeout=timeout, headers={'User-Agent': 'Mapa-Arboles-Tocones/1.0'})
+
+    def close(self) -> None:
+        self.client.close()
+
+    def state(self, sequence: Optional[int] = None) -> dict:
+        path = f"{sequence_path(sequence)}.state.txt" if sequence is not None else "state.txt"
+        response = self.client.get(f"{self.base_url}/{path}")
+        response.raise_for_status()
+        return parse_state(response.text)
+
+    def diff(self, sequence: int) -> IO[bytes]:
+        response = self.client.get(f"{self.base_url}/{sequence_path(sequence)}.osc.gz")
+        response.raise_for_status()
+        return gzip.GzipFile(fileobj=io.BytesIO(response.content))
@@ -0,0 +1,129 @@
+"""
+Agrupación de peticiones idénticas en curso (single-flight)
+
+Cuando varias peticiones necesitan el mismo resultado a la vez, solo la
+primera ejecuta la llamada real; el resto espera su resultado (o su error).
+Se usan futures de concurrent.futures para que funcione tanto dentro de un
+mismo event loop como entre hilos con loops distintos (p. ej. vistas async
+ejecutadas por async_to_sync bajo gunicorn con --threads).
+"""
+import asyncio
+import concurrent.futures
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, TypeVar
+
+T = TypeVar('T')
+
+
+class LeaderCancelled(Exception):
+    """La petición que ejecutaba la llamada compartida fue cancelada"""
+
+
+class SingleFlight:
+    """Registro de llamadas en curso indexadas por clave"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, concurrent.futures.Future] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def _claim(self, key: Hashable):
+        """Devuelve (future, es_lider) para una clave. Requiere self._lock"""
+        future = self._calls.get(key)
+        if future is None:
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            self.executed += 1
+            return future, True
+        self.coalesced += 1
+        return future, False
+
+    def _resolve(self, key: Hashable, future: concurrent.futures.Future, result=None, exc=None) -> None:
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    async def _wait(future: concurrent.futures.Future):
+        # shield evita que cancelar a un esperador cancele el future compartido
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Ejecuta func() una sola vez para todas las llamadas concurrentes con la misma clave"""
+        while True:
+            with self._lock:
+                future, leader = self._claim(key)
+            if not leader:
+                try:
+                    return await self._wait(future)
+                except LeaderCancelled:
+                    # El líder se canceló: reintentar, posiblemente como nuevo líder
+                    continue
+
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                self._resolve(key, future, exc=LeaderCancelled())
+                raise
+            except BaseException as exc:
+                self._resolve(key, future, exc=exc)
+                raise
+            self._resolve(key, future, result=result)
+            return result
+
+    async def do_many(self, keys: Iterable[Hashable],
+                      func: Callable[[List[Hashable]], Awaitable[Dict[Hashable, T]]]) -> Dict[Hashable, T]:
+        """
+        Variante por claves individuales.
+
+        Las claves que nadie está resolviendo se reclaman y se resuelven con una
+        sola llamada a func(claves_reclamadas), que debe devolver un diccionario
+        clave -> resultado. Para las claves que ya están en curso se espera el
+        resultado de la otra petición.
+        """
+        pending = list(keys)
+        results: Dict[Hashable, T] = {}
+        while pending:
+            own: Dict[Hashable, concurrent.futures.Future] = {}
+            waiting: Dict[Hashable, concurrent.futures.Future] = {}
+            with self._lock:
+                for key in pending:
+                    future, leader = self._claim(key)
+                    (own if leader else waiting)[key] = future
+
+            if own:
+                try:
+                    fetched = await func(list(own))
+                except asyncio.CancelledError:
+                    for key, future in own.items():
+                        self._resolve(key, future, exc=LeaderCancelled())
+                    raise
+                except BaseException as exc:
+                    for key, future in own.items():
+                        self._resolve(key, future, exc=exc)
+                    raise
+                for key, future in own.items():
+                    self._resolve(key, future, result=fetched.get(key))
+                    results[key] = fetched.get(key)
+
+            pending = []
+            for key, future in waiting.items():
+                try:
+                    results[key] = await self._wait(future)
+                except LeaderCancelled:
+                    pending.append(key)
+        return results
+
+    def stats(self) -> dict:
+        """Contadores de llamadas ejecutadas y agrupadas"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,188 @@
+"""
+Ficheros estáticos con huella y precomprimidos
+
+CompressedManifestStaticFilesStorage añade a ManifestStaticFilesStorage
+(nombres con el hash del contenido, p. ej. app.3f2a1b.js) una copia .gz y,
+si está instalado el paquete opcional brotli, otra .br de cada fichero de
+texto, generadas una vez en collectstatic.
+
+StaticFilesMiddleware (ver middleware.py) sirve STATIC_ROOT con un índice
+construido al primer uso: los nombres con huella se sirven como immutable
+durante un año, el resto con STATIC_MAX_AGE; se elige la variante br, gzip o
+sin comprimir según Accept-Encoding, cada una con su ETag, y los ficheros
+pequeños se responden desde memoria.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .http_cache import etag_matches, not_modified
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.txt', '.svg', '.json', '.html', '.map', '.xml')
+# Por debajo de este tamaño no compensa comprimir
+MIN_COMPRESS_BYTES = 200
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Variantes por orden de preferencia: (Content-Encoding, sufijo del fichero)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def compress_file(path: str) -> None:
+    """Escribe path.gz y path.br junto al fichero si resultan más pequeños"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if len(content) < MIN_COMPRESS_BYTES:
+        return
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content, quality=11)
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage que además precomprime los ficheros de texto"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS) and self.exists(name):
+                compress_file(self.path(name))
+
+    def stored_name(self, name):
+        # Sin collectstatic (desarrollo, pruebas) no hay manifiesto: se usa el nombre sin huella
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            logger.warning(f"Sin entrada en el manifiesto de estáticos para {name}, se usa sin huella")
+            return name
+
+
+@dataclass
+class Variant:
+    path: str
+    size: int
+    etag: str
+    content: Optional[bytes] = None  # en memoria si es pequeño
+
+
+@dataclass
+class StaticFile:
+    content_type: str
+    cache_control: str
+    variants: Dict[str, Variant] = field(default_factory=dict)  # Content-Encoding ('' sin comprimir) -> variante
+
+
+def _load_variant(path: str) -> Variant:
+    with open(path, 'rb') as f:
+        content = f.read()
+    etag = '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"'
+    keep = content if len(content) <= settings.STATIC_MEMORY_MAX_BYTES else None
+    return Variant(path, len(content), etag, keep)
+
+
+def build_static_index(root: str) -> Dict[str, StaticFile]:
+    """Nombre relativo -> fichero, con sus variantes comprimidas"""
+    index = {}
+    if not root or not os.path.isdir(root):
+        return index
+    hashed = set()
+    manifest_path = os.path.join(root, 'staticfiles.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            hashed = set(json.load(f).get('paths', {}).values())
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            if filename.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            content_type, _ = mimetypes.guess_type(filename)
+            if content_type is None:
+                content_type = 'application/octet-stream'
+            elif content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+                content_type += '; charset=utf-8'
+            cache_control = IMMUTABLE_CACHE_CONTROL if name in hashed else f'public, max-age={settings.STATIC_MAX_AGE}'
+            static_file = StaticFile(content_type, cache_control)
+            static_file.variants[''] = _load_variant(path)
+            for encoding, suffix in ENCODINGS:
+                if os.path.exists(path + suffix):
+                    static_file.variants[encoding] = _load_variant(path + suffix)
+            index[name] = static_file
+    return index
+
+
+_index: Optional[Dict[str, StaticFile]] = None
+_index_lock = threading.Lock()
+
+
+def get_static_index() -> Dict[str, StaticFile]:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = build_static_index(str(settings.STATIC_ROOT) if settings.STATIC_ROOT else '')
+            logger.info(f"Índice de estáticos: {len(_index)} ficheros")
+        return _index
+
+
+def reset_static_index() -> None:
+    """Vuelve a leer STATIC_ROOT en la próxima petición (pruebas)"""
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def choose_encoding(static_file: StaticFile, accept_encoding: str) -> str:
+    accepted = {part.split(';')[0].strip() for part in accept_encoding.split(',')}
+    for encoding, _ in ENCODINGS:
+        if encoding in static_file.variants and encoding in accepted:
+            return encoding
+    return ''
+
+
+def serve_static(request, name: str) -> Optional[HttpResponse]:
+    """Respuesta para el fichero estático `name`, o None si no está en STATIC_ROOT"""
+    static_file = get_static_index().get(name)
+    if static_file is None:
+        return None
+    encoding = choose_encoding(static_file, request.headers.get('Accept-Encoding', ''))
+    variant = static_file.variants[encoding]
+    headers = {'ETag': variant.etag, 'Cache-Control': static_file.cache_control}
+    if etag_matches(request, variant.etag):
+        response = not_modified(headers)
+    elif request.method == 'HEAD':
+        response = HttpResponse(content_type=static_file.content_type, headers=headers)
+        response['Content-Length'] = str(variant.size)
+    elif variant.content is not None:
+        response = HttpResponse(variant.content, content_type=static_file.content_type, headers=headers)
+    else:
+        response = FileResponse(open(variant.path, 'rb'), content_type=static_file.content_type, headers=headers)
+        response['Content-Length'] = str(variant.size)
+    if encoding and response.status_code == 200:
+        response['Content-Encoding'] = encoding
+    if len(static_file.variants) > 1:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,237 @@
+"""
+Estadísticas de árboles y tocones precalculadas por tesela
+
+/api/stats responde con el número de elementos, la densidad y el histograma
+de especies de cada capa en un bbox sin enviar los puntos. Para cada tesela
+de zoom STATS_ZOOM se calcula una vez un resumen por capa: el total, las
+especies y, en una rejilla de STATS_GRID x STATS_GRID subceldas, los mismos
+recuentos por subcelda. Los resúmenes se guardan en una caché LRU en memoria
+como las teselas MVT, también con la versión de los datos en la clave.
+
+Un bbox se responde sumando los resúmenes de sus teselas: las interiores
+enteras y, en las del borde, las subceldas dentro del bbox, más la parte
+proporcional al área de las que lo cortan (en ese caso el resultado es
+aproximado). El coste depende del número de teselas, no de puntos. Si el bbox
+cubre más de STATS_MAX_TILES teselas se usa un zoom menor, hasta
+STATS_MIN_ZOOM.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .datasources import LAYER_FILTERS, alocal_data_version, get_data_source
+from .singleflight import SingleFlight
+from .tiles import TileCache, count_tiles_for_bbox, lat_lon_to_tile, tile_bounds, tiles_for_bbox
+
+logger = logging.getLogger(__name__)
+
+Bbox = Tuple[float, float, float, float]
+
+# Timeout (s) de las consultas a la fuente de datos para una tesela
+QUERY_TIMEOUT = 60
+# Kilómetros por grado de latitud
+KM_PER_DEGREE = 111.32
+
+# Agrupación de cálculos en curso del resumen de la misma tesela
+summary_flight = SingleFlight()
+
+
+class StatsAreaTooLarge(ValueError):
+    """El bbox cubre demasiadas teselas incluso a STATS_MIN_ZOOM"""
+
+
+@dataclass
+class LayerSummary:
+    """Recuentos de una capa en una tesela: totales y por subcelda"""
+    count: int = 0
+    species: Counter = field(default_factory=Counter)
+    cells: Dict[int, Tuple[int, Counter]] = field(default_factory=dict)  # índice de subcelda -> (total, especies)
+    truncated: bool = False
+
+
+@dataclass
+class TileSummary:
+    layers: Dict[str, LayerSummary]
+    fetched_at: Optional[float]
+
+
+def summarize_tile(elements_by_layer: Dict[str, list], z: int, x: int, y: int, grid: int,
+                   limit: Optional[int] = None) -> Dict[str, LayerSummary]:
+    """
+    Resumen por capa de los elementos de una tesela. Los que están fuera (o
+    justo en el borde con otra) se descartan para no contarlos dos veces.
+    """
+    min_lat, min_lon, max_lat, max_lon = tile_bounds(z, x, y)
+    summaries = {}
+    for layer, elements in elements_by_layer.items():
+        summary = LayerSummary(truncated=limit is not None and len(elements) >= limit)
+        for element in elements:
+            lat, lon = element["lat"], element["lon"]
+            if lat_lon_to_tile(lat, lon, z) != (x, y):
+                continue
+            species = (element.get("tags") or {}).get("species")
+            row = min(grid - 1, max(0, int((lat - min_lat) / (max_lat - min_lat) * grid)))
+            col = min(grid - 1, max(0, int((lon - min_lon) / (max_lon - min_lon) * grid)))
+            cell_count, cell_species = summary.cells.get(row * grid + col, (0, Counter()))
+            cell_species[species] += 1
+            summary.cells[row * grid + col] = (cell_count + 1, cell_species)
+            summary.count += 1
+            summary.species[species] += 1
+        summaries[layer] = summary
+    return summaries
+
+
+def _overlap(low: float, high: float, bbox_low: float, bbox_high: float) -> float:
+    return max(0.0, min(high, bbox_high) - max(low, bbox_low))
+
+
+class StatsAccumulator:
+    """Suma de resúmenes de tesela recortados a un bbox"""
+
+    def __init__(self, layers: List[str], bbox: Bbox, grid: int):
+        self.bbox = bbox
+        self.grid = grid
+        self.counts = dict.fromkeys(layers, 0.0)
+        self.species = {layer: Counter() for layer in layers}
+        self.approximate = False
+        self.truncated = False
+
+    def add(self, z: int, x: int, y: int, summary: TileSummary) -> None:
+        bounds = tile_bounds(z, x, y)
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        inside = min_lat <= bounds[0] and min_lon <= bounds[1] and bounds[2] <= max_lat and bounds[3] <= max_lon
+        for layer in self.counts:
+            layer_summary = summary.layers[layer]
+            self.truncated |= layer_summary.truncated
+            if inside:
+                self.counts[layer] += layer_summary.count
+                self.species[layer].update(layer_summary.species)
+            else:
+                self._add_clipped(layer, bounds, layer_summary)
+
+    def _add_clipped(self, layer: str, bounds: Bbox, summary: LayerSummary) -> None:
+        """Suma las subceldas de una tesela del borde en proporción a su área dentro del bbox"""
+        tile_min_lat, tile_min_lon, tile_max_lat, tile_max_lon = bounds
+        cell_height = (tile_max_lat - tile_min_lat) / self.grid
+        cell_width = (tile_max_lon - tile_min_lon) / self.grid
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        for index, (count, species) in summary.cells.items():
+            row, col = divmod(index, self.grid)
+            cell_lat, cell_lon = tile_min_lat + row * cell_height, tile_min_lon + col * cell_width
+            fraction = (_overlap(cell_lat, cell_lat + cell_height, min_lat, max_lat) / cell_height
+                        * _overlap(cell_lon, cell_lon + cell_width, min_lon, max_lon) / cell_width)
+            if fraction <= 0:
+                continue
+            if fraction < 1 - 1e-9:
+                self.approximate = True
+            self.counts[layer] += count * fraction
+            for name, species_count in species.items():
+                self.species[layer][name] += species_count * fraction
+
+    def result(self, top_species: int) -> dict:
+        """Recuentos redondeados, densidad por km² y las `top_species` especies más frecuentes"""
+        area = bbox_area_km2(self.bbox)
+        layers = {}
+        for layer, count in self.counts.items():
+            species = [(name, round(value)) for name, value in self.species[layer].most_common()]
+            species = [(name, value) for name, value in species if value > 0]
+            layers[layer] = {
+                "count": round(count),
+                "density": round(count / area, 2) if area > 0 else None,
+                "species": [{"species": name, "count": value} for name, value in species[:top_species]],
+                "species_count": len(species),
+                "other_species": sum(value for _, value in species[top_species:]),
+            }
+        return {
+            "area_km2": round(area, 4),
+            "approximate": self.approximate,
+            "truncated": self.truncated,
+            **layers,
+        }
+
+
+def bbox_area_km2(bbox: Bbox) -> float:
+    """Área aproximada de un bbox en km²"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    mid_lat = math.radians((min_lat + max_lat) / 2)
+    return abs(max_lat - min_lat) * KM_PER_DEGREE * abs(max_lon - min_lon) * KM_PER_DEGREE * math.cos(mid_lat)
+
+
+def stats_zoom(bbox: Bbox) -> int:
+    """Mayor zoom entre STATS_MIN_ZOOM y STATS_ZOOM en que el bbox cubre como mucho STATS_MAX_TILES teselas"""
+    for zoom in range(settings.STATS_ZOOM, settings.STATS_MIN_ZOOM - 1, -1):
+        if count_tiles_for_bbox(*bbox, zoom) <= settings.STATS_MAX_TILES:
+            return zoom
+    raise StatsAreaTooLarge(f"el área cubre más de {settings.STATS_MAX_TILES} teselas a zoom {settings.STATS_MIN_ZOOM}")
+
+
+# Caché de resúmenes
+class SummaryCache(TileCache):
+    """Caché LRU en memoria de resúmenes de tesela por (z, x, y, versión de los datos)"""
+
+    def set(self, key, value: TileSummary) -> None:
+        cells = sum(len(summary.cells) + len(summary.species) for summary in value.layers.values())
+        self._set_memory(key, value, 256 + cells * 96, time.time())
+
+
+_summary_cache: Optional[SummaryCache] = None
+_summary_cache_lock = threading.Lock()
+
+
+def get_summary_cache() -> SummaryCache:
+    """Caché de resúmenes del proceso, configurada desde settings"""
+    global _summary_cache
+    if _summary_cache is None:
+        with _summary_cache_lock:
+            if _summary_cache is None:
+                _summary_cache = SummaryCache(max_bytes=settings.STATS_CACHE_MAX_BYTES, ttl=settings.STATS_CACHE_TTL)
+    return _summary_cache
+
+
+async def tile_summary(z: int, x: int, y: int) -> TileSummary:
+    """Resumen de todas las capas de una tesela, de la caché o calculado a partir de la fuente de datos"""
+    key = (z, x, y, await alocal_data_version())
+    cache = get_summary_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def compute() -> TileSummary:
+        limit = settings.STATS_MAX_POINTS
+        elements_by_layer = await get_data_source().fetch(list(LAYER_FILTERS), tile_bounds(z, x, y), limit,
+                                                          QUERY_TIMEOUT)
+        summary = TileSummary(summarize_tile(elements_by_layer, z, x, y, settings.STATS_GRID, limit),
+                              elements_by_layer.fetched_at)
+        cache.set(key, summary)
+        return summary
+
+    return await summary_flight.do(key, compute)
+
+
+async def bbox_stats(layers: List[str], bbox: Bbox) -> Tuple[dict, Optional[float]]:
+    """
+    Estadísticas de las capas en el bbox y el instante de obtención de los
+    datos más antiguos (None si no se conoce). Lanza StatsAreaTooLarge.
+    """
+    zoom = stats_zoom(bbox)
+    tiles = tiles_for_bbox(*bbox, zoom)
+    semaphore = asyncio.Semaphore(settings.STATS_CONCURRENCY)
+
+    async def load(tile) -> TileSummary:
+        async with semaphore:
+            return await tile_summary(*tile)
+
+    summaries = await asyncio.gather(*(load(tile) for tile in tiles))
+    accumulator = StatsAccumulator(layers, bbox, settings.STATS_GRID)
+    for tile, summary in zip(tiles, summaries):
+        accumulator.add(*tile, summary)
+    stats = {"zoom": zoom, "tiles": len(tiles), **accumulator.result(settings.STATS_TOP_SPECIES)}
+    fetched = [summary.fetched_at for summary in summaries if summary.fetched_at is not None]
+    return stats, min(fetched) if fetched else None
@@ -0,0 +1,86 @@
+"""
+Lectura incremental de respuestas JSON de Overpass
+
+Overpass devuelve {"version": ..., "osm3s": {...}, "elements": [...], ...}.
+ElementStreamParser recibe la respuesta por trozos y devuelve cada elemento
+en cuanto está completo, sin tener nunca en memoria el cuerpo entero ni el
+árbol JSON completo: solo el trozo pendiente de un elemento a medio llegar.
+"""
+import codecs
+import json
+from typing import Callable, List, Optional
+
+# Tamaño máximo de un elemento incompleto antes de considerar la respuesta inválida
+MAX_PENDING_CHARS = 1024 * 1024
+
+
+class ElementStreamParser:
+    """Parser incremental del array "elements" de una respuesta de Overpass"""
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._in_elements = False
+        self.finished = False
+        self.stopped = False
+        self.elements_read = 0
+
+    def feed(self, chunk: bytes, stop: Optional[Callable[[dict], bool]] = None) -> List[dict]:
+        """
+        Añade un trozo de la respuesta y devuelve los elementos completados.
+
+        Si `stop` devuelve True para un elemento, ese es el último: el resto
+        del trozo no se interpreta y los siguientes se ignoran.
+        """
+        if self.finished:
+            return []
+        self._buffer += self._decoder.decode(chunk)
+        elements = []
+
+        if not self._in_elements:
+            key = self._buffer.find('"elements"')
+            start = self._buffer.find('[', key) if key >= 0 else -1
+            if start < 0:
+                # Conservar solo la cola por si la clave llega partida entre trozos
+                self._buffer = self._buffer[-64:]
+                return elements
+            self._buffer = self._buffer[start + 1:]
+            self._in_elements = True
+
+        buffer = self._buffer
+        pos = 0
+        length = len(buffer)
+        while pos < length:
+            char = buffer[pos]
+            if char in ' \t\r\n,':
+                pos += 1
+                continue
+            if char == ']':
+                self.finished = True
+                pos = length
+                break
+            try:
+                element, end = self._json.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Elemento incompleto: esperar al siguiente trozo
+                break
+            elements.append(element)
+            pos = end
+            if stop is not None and stop(element):
+                self.finished = self.stopped = True
+                break
+
+        self._buffer = buffer[pos:]
+        if len(self._buffer) > MAX_PENDING_CHARS:
+            raise ValueError("Respuesta de Overpass inválida: elemento demasiado grande o JSON mal formado")
+        self.elements_read += len(elements)
+        return elements
+
+    def close(self) -> None:
+        """Comprueba que la respuesta ha terminado con el array de elementos completo"""
+        if self.stopped:
+            return
+        self._buffer += self._decoder.decode(b"", final=True)
+        if self._in_elements and not self.finished:
+            raise ValueError("Respuesta de Overpass incompleta o mal formada")
@@ -1,3 +1,1488 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import CommandError, call_command
+from django.http import QueryDict
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from .background import background_loop
+from .bench.load import mixed_bboxes
+from .bench.stub_overpass import StubConfig, StubOverpassServer, replay_elements
+from .clustering import cell_size, cluster_points, elements_to_arrays
+from .datasources import (
+    DataSource, LocalSource, OverpassSource, acached_data_version, build_bbox_query, cached_data_version, element_layer,
+    fetch_layers_by_tiles, LayerElements, get_tile_refresher, layer_limit_condition, set_data_source, split_by_layer,
+)
+from .filters import FeatureFilter
+from .formats import (
+    BINARY_MAGIC, NDJSON_CONTENT_TYPE, NULL_INDEX, encode_binary_block, layers_response, ndjson_lines,
+    ndjson_response, to_columnar,
+)
+from .http_client import OverpassClientManager, client_manager
+from .http_cache import etag_matches, get_etag_index, normalized_params
+from .lifecycle import LifespanMiddleware
+from .local_store import DATA_VERSION_KEY, SPECIES_INDEX_MAX_POSTINGS, LocalStore, set_local_store
+from .metrics import Histogram, RequestTimings, render_metrics, write_worker_metrics
+from .middleware import CompressionMiddleware, brotli
+from .mvt import EXTENT, encode_tile, project, render_tile, tile_features
+from .osm_import import ExtractReader, detect_format
+from .overpass import query_overpass
+from .parsing import data_time, parse_float_tag, parse_int_tag, parse_stumps, parse_trees
+from .planner import DensityMap, QueryPlanner, fair_sample, get_query_planner, grid_cells, set_query_planner
+from .prefetch import Prefetcher, TileAccessStats
+from .refresh import TileRefresher
+from .replication import SEQUENCE_KEY, apply_changes, open_osmchange, parse_osmchange
+from .singleflight import SingleFlight
+from .stats import StatsAccumulator, TileSummary, summarize_tile, tile_summary
+from .staticfiles import compress_file, reset_static_index, serve_static
+from .streaming import ElementStreamParser
+from .tiles import TileCache, get_tile_cache, lat_lon_to_tile, tile_bounds, tiles_for_bbox
+from .upstream import (
+    AdaptiveTokenBucket, CircuitBreaker, OverpassError, Priority, PrioritySemaphore, UpstreamScheduler,
+    build_endpoint_pool, set_endpoint_pool,
+)
+from .views import Stump, Tree, area_limit
+
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+def node(node_id, lat, lon, **tags):
+    return {"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": {"natural": "tree", **tags}}
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def decode_protobuf(data):
+    """Campos (número, valor) de un mensaje protobuf: enteros, float64 o bytes"""
+    fields = []
+    offset = 0
+    while offset < len(data):
+        key, offset = read_varint(data, offset)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = read_varint(data, offset)
+        elif wire_type == 1:
+            (value,) = struct.unpack_from("<d", data, offset)
+            offset += 8
+        else:
+            length, offset = read_varint(data, offset)
+            value = data[offset:offset + length]
+            offset += length
+        fields.append((field, value))
+    return fields
+
+
+def decode_packed(data):
+    values, offset = [], 0
+    while offset < len(data):
+        value, offset = read_varint(data, offset)
+        values.append(value)
+    return values
+
+
+def decode_mvt(data):
+    """Capa -> (extent, versión, [(id, (x, y), propiedades)]) de una tesela MVT de puntos"""
+    layers = {}
+    for _, layer_data in decode_protobuf(data):
+        layer = decode_protobuf(layer_data)
+        keys = [value.decode() for field, value in layer if field == 3]
+        values = []
+        for field, value in layer:
+            if field == 4:
+                ((kind, decoded),) = decode_protobuf(value)
+                values.append(decoded.decode() if kind == 1 else decoded)
+        features = []
+        for field, value in layer:
+            if field != 2:
+                continue
+            feature = dict(decode_protobuf(value))
+            assert feature[3] == 1  # POINT
+            command, px, py = decode_packed(feature[4])
+            assert command == 9  # MoveTo(1)
+            tags = decode_packed(feature.get(2, b""))
+            properties = {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)}
+            features.append((feature.get(1), ((px >> 1) ^ -(px & 1), (py >> 1) ^ -(py & 1)), properties))
+        fields = dict(layer)
+        layers[fields[1].decode()] = (fields[5], fields[15], features)
+    return layers
+
+
+def decode_binary_blocks(data):
+    """Lee los bloques de encode_binary_block según la estructura de su docstring"""
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        assert data[offset:offset + 4] == BINARY_MAGIC
+        (header_length,) = struct.unpack_from("<I", data, offset + 4)
+        header = json.loads(data[offset + 8:offset + 8 + header_length])
+        offset += 8 + header_length
+        offset += -offset % 4
+        end = offset + header["body_length"]
+        count = header["count"]
+        columns = {}
+        for name in ["lat", "lon"] + header["numeric"]:
+            columns[name] = list(struct.unpack_from(f"<{count}f", data, offset))
+            offset += 4 * count
+        for name, dictionary in header["categorical"].items():
+            index = struct.unpack_from(f"<{count}H", data, offset)
+            columns[name] = [None if i == NULL_INDEX else dictionary[i] for i in index]
+            offset += 2 * count
+        offset += -offset % 4
+        ids, previous = [], 0
+        for _ in range(count):
+            value, offset = read_varint(data, offset)
+            previous += (value >> 1) ^ -(value & 1)
+            ids.append(previous)
+        columns["id"] = ids
+        blocks.append((header, columns))
+        offset = end
+    return blocks
+
+
+class TileCacheTests(SimpleTestCase):
+
+    def test_lru_eviction_by_bytes(self):
+        tile = [node(1, 0.5, 0.5)]
+        size = len(json.dumps(tile, separators=(',', ':')))
+        cache = TileCache(max_bytes=2 * size, ttl=60)
+        cache.set(('trees', 15, 0, 0), tile)
+        cache.set(('trees', 15, 0, 1), tile)
+        self.assertIsNotNone(cache.get(('trees', 15, 0, 0)))
+        cache.set(('trees', 15, 0, 2), tile)
+        # Se expulsa la usada hace más tiempo
+        self.assertIsNone(cache.get(('trees', 15, 0, 1)))
+        self.assertIsNotNone(cache.get(('trees', 15, 0, 0)))
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["bytes"], stats["evictions"]), (2, 2 * size, 1))
+
+    def test_ttl_and_stale_ttl(self):
+        cache = TileCache(max_bytes=10 ** 6, ttl=60, stale_ttl=100)
+        cache._set_memory(('trees', 15, 0, 0), [node(1, 0, 0)], 10, time.time() - 90)
+        self.assertIsNone(cache.get(('trees', 15, 0, 0)))
+        self.assertIsNotNone(cache.get_stale(('trees', 15, 0, 0)))
+        found, missing = cache.get_many([('trees', 15, 0, 0)], max_stale=50)
+        self.assertEqual((list(found), missing), ([('trees', 15, 0, 0)], []))
+        found, missing = cache.get_many([('trees', 15, 0, 0)], max_stale=10)
+        self.assertEqual((found, missing), ({}, [('trees', 15, 0, 0)]))
+
+        cache._set_memory(('trees', 15, 0, 1), [], 10, time.time() - 200)
+        self.assertIsNone(cache.get_stale(('trees', 15, 0, 1)))
+        self.assertEqual((cache.stats()["entries"], cache.stats()["expirations"]), (1, 1))
+
+    def test_disk_tier_shared(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        writer = TileCache(max_bytes=10 ** 6, ttl=60, cache_dir=directory)
+        writer.set(('trees', 15, 1, 2), [node(1, 0.5, 0.5)])
+
+        # Otro worker (otra instancia) la lee del disco y la sube a memoria
+        reader = TileCache(max_bytes=10 ** 6, ttl=60, cache_dir=directory)
+        self.assertEqual(reader.get(('trees', 15, 1, 2)), [node(1, 0.5, 0.5)])
+        self.assertEqual(reader.get(('trees', 15, 1, 2)), [node(1, 0.5, 0.5)])
+        self.assertEqual((reader.stats()["disk_hits"], reader.stats()["hits"]), (1, 1))
+
+        reader.invalidate([('trees', 15, 1, 2)])
+        self.assertIsNone(TileCache(max_bytes=10 ** 6, ttl=60, cache_dir=directory).get(('trees', 15, 1, 2)))
+
+    def test_offload_runs_disk_tier_in_thread(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        disk = TileCache(max_bytes=10 ** 6, ttl=60, cache_dir=directory)
+        memory = TileCache(max_bytes=10 ** 6, ttl=60)
+
+        async def run(cache):
+            loop_thread = threading.get_ident()
+            await cache.offload(cache.set_many, {('trees', 15, 1, 2): [node(1, 0.5, 0.5)]})
+            found, missing = await cache.offload(cache.get_many, [('trees', 15, 1, 2), ('trees', 15, 1, 3)])
+            thread = await cache.offload(threading.get_ident)
+            return list(found), missing, thread != loop_thread
+
+        # Con disco la E/S sale del event loop; solo en memoria se ejecuta en el sitio
+        self.assertEqual(async_to_sync(run)(disk), ([('trees', 15, 1, 2)], [('trees', 15, 1, 3)], True))
+        self.assertEqual(async_to_sync(run)(memory), ([('trees', 15, 1, 2)], [('trees', 15, 1, 3)], False))
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def test_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "tile"
+
+        async def run():
+            return await asyncio.gather(*(flight.do('k', fetch) for _ in range(5)))
+
+        self.assertEqual(async_to_sync(run)(), ["tile"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats(), {"in_flight": 0, "executed": 1, "coalesced": 4})
+
+    def test_error_reaches_every_waiter(self):
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise OverpassError("caído", "http", 504)
+
+        async def run():
+            return await asyncio.gather(*(flight.do('k', fail) for _ in range(3)), return_exceptions=True)
+
+        errors = async_to_sync(run)()
+        self.assertEqual([type(error) for error in errors], [OverpassError] * 3)
+        self.assertIs(errors[1], errors[0])
+        # La clave se libera: la siguiente llamada vuelve a ejecutar
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+        async def ok():
+            return "tile"
+
+        self.assertEqual(async_to_sync(flight.do)('k', ok), "tile")
+        self.assertEqual(flight.stats()["executed"], 2)
+
+    def test_leader_cancelled_waiter_retries(self):
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        async def fast():
+            return "tile"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do('k', slow))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(flight.do('k', fast))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await waiter
+
+        self.assertEqual(async_to_sync(run)(), "tile")
+        self.assertEqual(flight.stats(), {"in_flight": 0, "executed": 2, "coalesced": 1})
+
+    def test_do_many_shares_overlapping_keys(self):
+        flight = SingleFlight()
+        batches = []
+
+        async def fetch(keys):
+            batches.append(sorted(keys))
+            await asyncio.sleep(0.01)
+            return {key: key * 10 for key in keys}
+
+        async def run():
+            return await asyncio.gather(flight.do_many([1, 2], fetch), flight.do_many([2, 3], fetch))
+
+        self.assertEqual(async_to_sync(run)(), [{1: 10, 2: 20}, {2: 20, 3: 30}])
+        self.assertEqual(batches, [[1, 2], [3]])
+
+
+class UpstreamSchedulerTests(SimpleTestCase):
+
+    def test_priority_semaphore_order(self):
+        semaphore = PrioritySemaphore(1)
+        granted = []
+
+        async def worker(priority):
+            await semaphore.acquire(priority)
+            granted.append(priority)
+            await asyncio.sleep(0)
+            semaphore.release()
+
+        async def run():
+            await semaphore.acquire(Priority.INTERACTIVE)
+            tasks = [asyncio.ensure_future(worker(priority)) for priority in (2, 0, 1, 0)]
+            await asyncio.sleep(0.01)
+            self.assertEqual(semaphore.stats(), {"capacity": 1, "in_use": 1, "waiting": 4})
+            semaphore.release()
+            await asyncio.gather(*tasks)
+            # Sin hueco libre, la espera acaba con timeout
+            await semaphore.acquire(0)
+            self.assertFalse(await semaphore.acquire(0, timeout=0.01))
+            semaphore.release()
+
+        async_to_sync(run)()
+        self.assertEqual(granted, [0, 0, 1, 2])
+        self.assertEqual(semaphore.stats(), {"capacity": 1, "in_use": 0, "waiting": 0})
+
+    def test_token_bucket_adapts_to_rate_limits(self):
+        bucket = AdaptiveTokenBucket(rate=10, burst=1, min_rate=2)
+        bucket.on_rate_limited(None)
+        self.assertEqual(bucket.rate, 5)
+        bucket.on_rate_limited(None)
+        bucket.on_rate_limited(None)
+        self.assertEqual(bucket.rate, 2)
+        bucket.on_success()
+        self.assertEqual(bucket.rate, 2.5)
+        for _ in range(20):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 10)
+        bucket.on_rate_limited(30)
+        self.assertGreater(bucket.wait_time(), 29)
+        self.assertFalse(async_to_sync(bucket.acquire)(1))
+
+    def test_circuit_breaker_states(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        # Semiabierto: solo pasa una consulta de prueba
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+        self.assertTrue(breaker.allow() and breaker.allow())
+
+    def test_slot_records_results(self):
+        scheduler = UpstreamScheduler(max_concurrent=2, rate=100, burst=5, min_rate=1, breaker_threshold=1,
+                                      breaker_reset=60, queue_timeout=1, status_url='http://stub/api/status')
+
+        async def rate_limited():
+            async with scheduler.slot():
+                raise OverpassError("429", "http", 429)
+
+        with self.assertRaises(OverpassError):
+            async_to_sync(rate_limited)()
+        self.assertEqual(scheduler.stats()["rate"], 50)
+        self.assertEqual(scheduler.stats()["circuit"], CircuitBreaker.OPEN)
+        with self.assertRaises(OverpassError) as cm:
+            async_to_sync(rate_limited)()
+        self.assertEqual(cm.exception.kind, 'circuit_open')
+        self.assertEqual(scheduler.stats()["in_use"], 0)
+
+
+class EndpointPoolTests(SimpleTestCase):
+
+    def pool(self, *urls, hedge=True):
+        return build_endpoint_pool(list(urls), hedge=hedge)
+
+    def test_routes_by_latency_and_errors(self):
+        pool = self.pool('http://a/api/interpreter', 'http://b/api/interpreter')
+        a, b = pool.endpoints
+        a.record_success(0.2)
+        # Un servidor sin datos se prueba antes que los demás
+        self.assertIs(pool.choose(), b)
+        b.record_success(1.0)
+        self.assertIs(pool.choose(), a)
+        for _ in range(10):
+            b.record_success(0.1)
+        self.assertLess(b.latency_ewma, a.latency_ewma)
+        self.assertIs(pool.choose(), b)
+        self.assertIs(pool.choose(avoid=[b.url]), a)
+        b.record_failure()
+        self.assertIs(pool.choose(), a)
+
+    @override_settings(OVERPASS_HEDGE_MIN_DELAY=0.05)
+    def test_hedge_delay_is_p90(self):
+        pool = self.pool('http://a/api/interpreter', 'http://b/api/interpreter')
+        a = pool.endpoints[0]
+        for latency in range(1, 10):
+            a.record_success(latency / 10)
+        self.assertIsNone(pool.hedge_delay(a))
+        a.record_success(0.01)
+        self.assertEqual(a.latency_percentile(90), 0.9)
+        self.assertEqual(pool.hedge_delay(a), 0.9)
+        self.assertIsNone(self.pool('http://a/api/interpreter', hedge=False).hedge_delay(a))
+        fast = self.pool('http://a/api/interpreter', 'http://b/api/interpreter').endpoints[0]
+        for _ in range(10):
+            fast.record_success(0.01)
+        self.assertEqual(pool.hedge_delay(fast), 0.05)
+
+    @override_settings(OVERPASS_HEDGE_MIN_DELAY=0.05)
+    def test_hedged_query_cancels_loser(self):
+        slow = StubOverpassServer(config=StubConfig(latency=2.0, density=20)).start()
+        fast = StubOverpassServer(config=StubConfig(latency=0, density=20)).start()
+        self.addCleanup(slow.stop)
+        self.addCleanup(fast.stop)
+        pool = self.pool(slow.url, fast.url)
+        set_endpoint_pool(pool)
+        self.addCleanup(set_endpoint_pool, None)
+        primary, secondary = pool.endpoints
+        # El lento parece el más rápido por su historial, así que se elige primero
+        for _ in range(10):
+            primary.record_success(0.01)
+            secondary.record_success(0.5)
+        query = build_bbox_query(['trees'], (40.0, -3.8, 40.01, -3.79), None, 25, None)
+
+        async def run():
+            start = time.monotonic()
+            result = await query_overpass(query)
+            elapsed = time.monotonic() - start
+            await asyncio.sleep(0.05)
+            return result, elapsed
+
+        result, elapsed = async_to_sync(run)()
+        self.assertEqual(len(result["elements"]), 20)
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual((slow.requests, fast.requests), (1, 1))
+        self.assertEqual((secondary.hedges, secondary.hedge_wins), (1, 1))
+        # La consulta perdedora se canceló: liberó su hueco sin contar como éxito ni como fallo
+        self.assertEqual((primary.requests, primary.failures), (10, 0))
+        self.assertEqual(primary.scheduler.semaphore.stats()["in_use"], 0)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condición no cumplida a tiempo")
+        time.sleep(0.01)
+
+
+class StaleWhileRevalidateTests(SimpleTestCase):
+
+    def test_refresher_dedupes_pending_tiles(self):
+        batches = []
+
+        async def fetch(keys):
+            batches.append(sorted(keys))
+            await asyncio.sleep(0.05)
+
+        refresher = TileRefresher(fetch, workers=2, max_pending=3)
+        self.addCleanup(refresher.close)
+        self.assertEqual(refresher.schedule([('trees', 15, 0, 0), ('trees', 15, 0, 1)]), 2)
+        self.assertEqual(refresher.schedule([('trees', 15, 0, 0)]), 0)
+        self.assertEqual(refresher.schedule([('trees', 15, 0, 2), ('trees', 15, 0, 3)]), 0)
+        wait_until(lambda: refresher.stats()["pending"] == 0)
+        self.assertEqual(batches, [[('trees', 15, 0, 0), ('trees', 15, 0, 1)]])
+        self.assertEqual(refresher.stats(), {"pending": 0, "scheduled": 2, "refreshed": 2, "failed": 0, "dropped": 2})
+        # Ya refrescada, se puede volver a encolar
+        self.assertEqual(refresher.schedule([('trees', 15, 0, 0)]), 1)
+
+    @override_settings(PLANNER_ENABLED=False)
+    def test_serves_stale_and_refreshes_once(self):
+        stub = StubOverpassServer(config=StubConfig(latency=0.1, density=20)).start()
+        set_endpoint_pool(build_endpoint_pool([stub.url], hedge=False))
+        self.addCleanup(stub.stop)
+        self.addCleanup(set_endpoint_pool, None)
+        bbox = (10.0, 10.0, 10.004, 10.004)
+        cache = get_tile_cache()
+        keys = [('trees', *tile) for tile in tiles_for_bbox(*bbox, 15)]
+        stale_at = time.time() - cache.ttl - 10
+        for i, key in enumerate(keys):
+            min_lat, min_lon, max_lat, max_lon = tile_bounds(*key[1:])
+            lat, lon = min(max((min_lat + max_lat) / 2, bbox[0]), bbox[2]), min(max((min_lon + max_lon) / 2, bbox[1]), bbox[3])
+            cache._set_memory(key, [node(i, lat, lon)], 100, stale_at)
+        refresher = get_tile_refresher()
+        scheduled = refresher.stats()["scheduled"]
+
+        async def run():
+            # Sin prioridad interactiva no se precargan las vecinas
+            return await asyncio.gather(*(fetch_layers_by_tiles(['trees'], *bbox, 25, Priority.BACKGROUND)
+                                          for _ in range(2)))
+
+        start = time.monotonic()
+        results = async_to_sync(run)()
+        self.assertLess(time.monotonic() - start, 0.1)
+        for result in results:
+            self.assertEqual([element["id"] for element in result["trees"]], list(range(len(keys))))
+            self.assertEqual(result.fetched_at, stale_at)
+        self.assertEqual(refresher.stats()["scheduled"] - scheduled, len(keys))
+
+        wait_until(lambda: all(cache.is_fresh(cache.peek(key)) for key in keys))
+        self.assertEqual(stub.requests, 1)
+        self.assertNotEqual(async_to_sync(fetch_layers_by_tiles)(['trees'], *bbox, 25, Priority.BACKGROUND).fetched_at,
+                            stale_at)
+        self.assertEqual(refresher.stats()["scheduled"] - scheduled, len(keys))
+
+
+class PrefetchTests(SimpleTestCase):
+
+    def test_hot_tiles_decay(self):
+        access = TileAccessStats(half_life=10, max_tracked=4)
+        access.record([('trees', 15, 0, 0)] * 2)
+        # Cuatro visitas hace dos vidas medias valen una ahora
+        access._scores[('trees', 15, 0, 1)] = (4.0, time.monotonic() - 20)
+        access._scores[('trees', 15, 0, 2)] = (8.0, time.monotonic() - 20)
+        self.assertEqual(access.hottest(3), [('trees', 15, 0, 2), ('trees', 15, 0, 0), ('trees', 15, 0, 1)])
+        self.assertAlmostEqual(access._decayed(4.0, time.monotonic() - 20, time.monotonic()), 1.0, places=3)
+        # Por encima de max_tracked se olvida la mitad menos visitada
+        access.record([('trees', 15, 0, 3), ('trees', 15, 0, 4)])
+        self.assertEqual(len(access), 2)
+        self.assertEqual(set(access.hottest(5)), {('trees', 15, 0, 2), ('trees', 15, 0, 0)})
+
+    def test_margin_tiles_scheduled(self):
+        set_endpoint_pool(build_endpoint_pool(['http://127.0.0.1:9/api/interpreter'], hedge=False))
+        self.addCleanup(set_endpoint_pool, None)
+        batches = []
+
+        async def fetch(keys):
+            batches.append(keys)
+
+        refresher = TileRefresher(fetch, workers=1, max_pending=100)
+        self.addCleanup(refresher.close)
+        cache = TileCache(max_bytes=10 ** 6, ttl=60)
+        prefetcher = Prefetcher(refresher, cache, margin=1, hot_tiles=0, interval=60, half_life=60,
+                                max_tracked=100, batch_size=4)
+        cache.set(('trees', 15, 10, 11), [])  # vecina ya en caché
+        cache._set_memory(('trees', 15, 11, 11), [], 10, time.time() - 50)  # caduca en 10 s
+
+        prefetcher.record(['trees'], [(15, 10, 10), (15, 11, 10)])
+        wait_until(lambda: refresher.stats()["refreshed"] == 8)
+        scheduled = sorted(key for batch in batches for key in batch)
+        expected = sorted(('trees', 15, x, y) for x in range(9, 13) for y in range(9, 12)
+                          if y != 10 or x in (9, 12))
+        expected.remove(('trees', 15, 10, 11))
+        expected.remove(('trees', 15, 11, 11))
+        self.assertEqual(scheduled, expected)
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+        self.assertEqual(prefetcher.stats(), {"tracked": 2, "scheduled": 8, "skipped": 0})
+
+        # Con un horizonte de 30 s también se precarga la que caduca pronto
+        self.assertEqual(prefetcher._prefetch(['trees'], [(15, 10, 11), (15, 11, 11)], 30), 1)
+
+
+class FeatureFilterTests(SimpleTestCase):
+
+    def test_from_query(self):
+        self.assertIsNone(FeatureFilter.from_query(QueryDict('bbox=1,2,3,4')))
+        filters = FeatureFilter.from_query(QueryDict('species=Quercus&health=good,fair&min_height=5'))
+        self.assertEqual(filters, FeatureFilter('quercus', ('good', 'fair'), 5.0, None))
+
+    def test_from_query_invalid(self):
+        for query in ('species=a"]', 'min_height=alto', 'min_height=10&max_height=5', 'health=a|b'):
+            with self.subTest(query=query), self.assertRaises(ValueError):
+                FeatureFilter.from_query(QueryDict(query))
+
+    def test_species_matches_genus(self):
+        filters = FeatureFilter(species='quercus')
+        self.assertTrue(filters.matches(node(1, 0, 0, species='Quercus')))
+        self.assertTrue(filters.matches(node(1, 0, 0, species='Quercus ilex')))
+        self.assertFalse(filters.matches(node(1, 0, 0, species='Quercusia alba')))
+        self.assertFalse(filters.matches(node(1, 0, 0)))
+
+    def test_height_range(self):
+        filters = FeatureFilter(min_height=5, max_height=10)
+        self.assertTrue(filters.matches(node(1, 0, 0, height='5')))
+        self.assertFalse(filters.matches(node(1, 0, 0, height='12')))
+        self.assertFalse(filters.matches(node(1, 0, 0, height='7 m')))
+        self.assertFalse(filters.matches(node(1, 0, 0)))
+
+    def test_overpass_pushdown(self):
+        filters = FeatureFilter('quercus ilex', ('good',), 5.0, None)
+        query = build_bbox_query(['trees'], (40.0, -3.8, 40.1, -3.7), 50, 25, filters)
+        self.assertIn('node["natural"="tree"]["species"~"^quercus ilex( |$)",i]["health"~"^(good)$"]'
+                      '(if: is_number(t["height"]) && number(t["height"]) >= 5.0)(40.0,-3.8,40.1,-3.7)', query)
+        self.assertIn('.trees out 50;', query)
+
+
+class LocalStoreFilterTests(SimpleTestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.store = LocalStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.path)
+
+    def query_ids(self, filters, limit=None, bbox=(0, 0, 1, 1)):
+        return sorted(element["id"] for element in self.store.query(['trees'], bbox, limit, filters)['trees'])
+
+    def test_filters_and_limit_after_filtering(self):
+        self.store.upsert_nodes([
+            node(1, 0.5, 0.5, species='Quercus ilex', height='8', health='good'),
+            node(2, 0.5, 0.5, species='Quercus robur', height='15'),
+            node(3, 0.5, 0.5, species='Pinus pinea', height='8'),
+            node(4, 2.0, 2.0, species='Quercus ilex', height='8'),
+        ] + [node(100 + i, 0.1, 0.1, species='Pinus pinea') for i in range(20)], element_layer)
+
+        self.assertEqual(self.query_ids(FeatureFilter(species='quercus')), [1, 2])
+        self.assertEqual(self.query_ids(FeatureFilter(species='quercus ilex')), [1])
+        self.assertEqual(self.query_ids(FeatureFilter(health=('good',))), [1])
+        self.assertEqual(self.query_ids(FeatureFilter(min_height=5, max_height=10)), [1, 3])
+        # Los 20 pinos sin altura no consumen el límite
+        self.assertEqual(self.query_ids(FeatureFilter(min_height=5), limit=2), [1, 2])
+
+    def test_common_species_uses_rtree(self):
+        common = [node(i, 0.5 + i * 1e-6, 0.5, species='Platanus') for i in range(1, SPECIES_INDEX_MAX_POSTINGS + 1)]
+        self.store.upsert_nodes(common + [node(10 ** 6, 0.5, 0.5, species='Ulmus minor')], element_layer)
+        filters = FeatureFilter(species='platanus')
+        self.assertFalse(self.store._few_species_nodes('trees', filters))
+        self.assertTrue(self.store._few_species_nodes('trees', FeatureFilter(species='ulmus')))
+        self.assertEqual(len(self.query_ids(filters, limit=10)), 10)
+        self.assertEqual(self.query_ids(FeatureFilter(species='ulmus')), [10 ** 6])
+
+    def test_adds_filter_columns_to_old_store(self):
+        self.store.close()
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE nodes (id INTEGER PRIMARY KEY, layer TEXT NOT NULL, "
+                     "lat REAL NOT NULL, lon REAL NOT NULL, tags TEXT NOT NULL)")
+        conn.execute("INSERT INTO nodes VALUES (1, 'trees', 0.5, 0.5, '{\"species\": \"Quercus ilex\", \"height\": \"9\"}')")
+        conn.commit()
+        conn.close()
+
+        self.store = LocalStore(self.path)
+        row = self.store.connection.execute("SELECT species, health, height FROM nodes").fetchone()
+        self.assertEqual(row, ('quercus ilex', None, 9.0))
+
+
+class ImportTests(SimpleTestCase):
+    """Extractos de maps/testdata importados a un almacén temporal"""
+
+    OSM = os.path.join(TESTDATA, 'extract.osm')
+    JSON = os.path.join(TESTDATA, 'overpass.json')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LocalStore(os.path.join(self.directory, 'store.sqlite3'))
+        set_local_store(self.store)
+
+    def tearDown(self):
+        set_local_store(None)
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def import_osm(self, *args, **options):
+        output = io.StringIO()
+        call_command('import_osm', *args, stdout=output, **options)
+        return output.getvalue()
+
+    def test_read_xml(self):
+        reader = ExtractReader(self.OSM)
+        # Sin etiquetas, borrados y vías se descartan
+        self.assertEqual([element["id"] for element in reader], [1, 2, 3])
+        self.assertEqual(reader.bounds, (40.0, -3.8, 40.1, -3.7))
+        self.assertEqual(reader.extent, (40.01, -3.79, 40.03, -3.77))
+        self.assertEqual(reader.nodes_read, 3)
+
+    def test_read_json_compressed(self):
+        compressed = os.path.join(self.directory, 'overpass.json.gz')
+        with open(self.JSON, 'rb') as source, gzip.open(compressed, 'wb') as target:
+            target.write(source.read())
+        self.assertEqual((detect_format(compressed), detect_format('a.osm.pbf'), detect_format('a.osm.bz2')),
+                         ('json', 'pbf', 'xml'))
+        reader = ExtractReader(compressed)
+        self.assertEqual([element["id"] for element in reader], [20, 21])
+        self.assertIsNone(reader.bounds)
+        self.assertEqual(reader.extent, (40.06, -3.74, 40.08, -3.71))
+
+    def test_command_uses_declared_bounds(self):
+        output = self.import_osm(self.OSM)
+        self.assertIn('1 árboles, 1 tocones', output)
+        self.assertEqual(self.store.coverage_areas(), [(40.0, -3.8, 40.1, -3.7)])
+        self.assertEqual(self.store.get_meta(DATA_VERSION_KEY), '1')
+
+    def test_command_falls_back_to_extent(self):
+        output = self.import_osm(self.JSON)
+        self.assertIn('no declara su área', output)
+        self.assertEqual(self.store.coverage_areas(), [(40.06, -3.74, 40.08, -3.71)])
+
+        # --bbox tiene prioridad y --replace vacía el almacén antes
+        output = self.import_osm(self.OSM, bbox='40.0,-3.8,40.05,-3.75', replace=True)
+        self.assertIn('1 árboles, 1 tocones', output)
+        self.assertEqual(self.store.coverage_areas(), [(40.0, -3.8, 40.05, -3.75)])
+        self.assertEqual(self.store.get_meta(DATA_VERSION_KEY), '3')
+
+    def test_command_errors(self):
+        with self.assertRaises(CommandError):
+            self.import_osm()
+        with self.assertRaises(CommandError):
+            self.import_osm(self.OSM, bbox='40.0,-3.8')
+        with self.assertRaises(CommandError):
+            self.import_osm(os.path.join(self.directory, 'no_existe.osm'))
+
+
+class ReplicationTests(SimpleTestCase):
+    """Diffs osmChange de maps/testdata aplicados a un almacén temporal"""
+
+    AREA = (40.0, -3.8, 40.1, -3.7)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.sqlite3')
+        self.store = LocalStore(self.path)
+        self.store.add_coverage(self.AREA, 'pruebas')
+        self.store.upsert_nodes([node(10, 40.05, -3.75, species='Pinus pinea'), node(11, 40.02, -3.72)], element_layer)
+
+    def tearDown(self):
+        set_local_store(None)
+        set_data_source(None)
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def apply(self, name, store=None):
+        with open_osmchange(os.path.join(TESTDATA, name)) as f:
+            return apply_changes(store or self.store, parse_osmchange(f), 15)
+
+    def layer(self, layer):
+        return {element["id"]: element for element in self.store.query([layer], self.AREA)[layer]}
+
+    def test_create_modify_and_skip_outside_areas(self):
+        result = self.apply('0001.osc')
+        self.assertEqual((result.created, result.modified, result.deleted, result.skipped), (2, 1, 0, 2))
+        trees = self.layer('trees')
+        self.assertEqual(sorted(trees), [1, 10, 11])
+        self.assertEqual(trees[10]["tags"]["species"], 'Pinus pinaster')
+        self.assertEqual(sorted(self.layer('stumps')), [3])
+        self.assertEqual(self.store.get_positions([2, 4]), {})
+
+    def test_move_and_delete(self):
+        self.apply('0001.osc')
+        result = self.apply('0002.osc')
+        self.assertEqual((result.created, result.modified, result.deleted, result.skipped), (1, 1, 2, 1))
+        self.assertEqual(self.store.get_positions([1]), {1: (40.09, -3.71)})
+        # El nodo movido invalida la tesela de origen y la de destino
+        self.assertIn((15, *lat_lon_to_tile(40.01, -3.79, 15)), result.touched_tiles)
+        self.assertIn((15, *lat_lon_to_tile(40.09, -3.71, 15)), result.touched_tiles)
+        trees = self.layer('trees')
+        self.assertEqual(sorted(trees), [1, 5, 10])
+        self.assertEqual(trees[5]["tags"]["species"], 'Olea europaea')
+        self.assertEqual(self.layer('stumps'), {})
+
+    def test_command_tracks_sequence(self):
+        set_local_store(self.store)
+        compressed = os.path.join(self.directory, '0002.osc.gz')
+        with open(os.path.join(TESTDATA, '0002.osc'), 'rb') as source, gzip.open(compressed, 'wb') as target:
+            target.write(source.read())
+        output = io.StringIO()
+        call_command('apply_osm_changes', os.path.join(TESTDATA, '0001.osc'), compressed, sequence=2, stdout=output)
+        self.assertEqual(self.store.get_meta(SEQUENCE_KEY), '2')
+        self.assertIn('Creados: 3, modificados: 2, eliminados: 2, ignorados: 3', output.getvalue())
+
+    @override_settings(MAPS_DATA_SOURCE='local', LOCAL_STORE_CHECK_INTERVAL=0)
+    def test_data_version_reaches_other_processes(self):
+        set_local_store(self.store)
+        set_data_source(LocalSource())
+        version = cached_data_version(['trees'], self.AREA)
+        self.assertEqual(async_to_sync(acached_data_version)(['trees'], self.AREA), version)
+        x, y = lat_lon_to_tile(40.01, -3.79, 16)
+        etag, _ = async_to_sync(render_tile)('trees', 16, x, y)
+        summary_tile = (14, *lat_lon_to_tile(40.01, -3.79, 14))
+        trees = async_to_sync(tile_summary)(*summary_tile).layers['trees'].count
+
+        # El diff lo aplica otro proceso con su propia conexión
+        other = LocalStore(self.path)
+        self.addCleanup(other.close)
+        self.apply('0001.osc', other)
+
+        self.assertNotEqual(cached_data_version(['trees'], self.AREA), version)
+        self.assertNotEqual(async_to_sync(acached_data_version)(['trees'], self.AREA), version)
+        self.assertNotEqual(async_to_sync(render_tile)('trees', 16, x, y)[0], etag)
+        self.assertEqual(async_to_sync(tile_summary)(*summary_tile).layers['trees'].count, trees + 1)
+
+
+class ClientManagerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stub = StubOverpassServer(config=StubConfig(latency=0, density=5)).start()
+        self.addCleanup(self.stub.stop)
+        self.manager = OverpassClientManager()
+        self.addCleanup(self.manager.close_background_client)
+        self.status_url = self.stub.url.rsplit('/', 1)[0] + '/status'
+
+    def test_delegates_to_background_loop(self):
+        # Bajo WSGI cada petición tiene su propio loop: el cliente vive en el de segundo plano
+        async def consume(response):
+            return asyncio.get_running_loop(), len(await response.aread())
+
+        async def run():
+            response = await self.manager.get(self.status_url)
+            loop, size = await self.manager.stream('POST', self.stub.url, consume, data='[out:json];')
+            return response.status_code, loop, size
+
+        for _ in range(2):
+            status, loop, size = async_to_sync(run)()
+            self.assertEqual(status, 200)
+            self.assertIs(loop, background_loop.loop)
+            self.assertGreater(size, 0)
+        (client,) = self.manager._clients.values()
+        self.assertIn(background_loop.loop, self.manager._clients)
+
+        self.manager.close_background_client()
+        self.assertTrue(client.is_closed)
+        self.assertEqual(self.manager._clients, {})
+
+    def test_server_loop_client(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            await self.manager.startup()
+            client = self.manager._clients[loop]
+            self.assertEqual((await self.manager.get(self.status_url)).status_code, 200)
+            self.assertEqual((await self.manager.post(self.stub.url, data='[out:json];')).status_code, 200)
+            # Mismo cliente para todas las peticiones del loop del servidor, sin pasar por el de segundo plano
+            self.assertEqual(list(self.manager._clients), [loop])
+            self.assertIs(self.manager._clients[loop], client)
+            await self.manager.shutdown()
+            return client
+
+        client = async_to_sync(run)()
+        self.assertTrue(client.is_closed)
+        self.assertEqual(self.manager._clients, {})
+        self.assertIsNone(self.manager._server_loop)
+
+
+class LifespanTests(SimpleTestCase):
+
+    def run_lifespan(self, messages):
+        requests = []
+
+        async def app(scope, receive, send):
+            requests.append(scope['type'])
+
+        async def run():
+            queue = list(messages)
+            sent = []
+
+            async def receive():
+                return {'type': queue.pop(0)}
+
+            async def send(message):
+                sent.append(message)
+
+            middleware = LifespanMiddleware(app)
+            await middleware({'type': 'lifespan'}, receive, send)
+            await middleware({'type': 'http'}, receive, send)
+            return sent
+
+        sent = async_to_sync(run)()
+        self.assertEqual(requests, ['http'])
+        return sent
+
+    def test_startup_and_shutdown(self):
+        sent = self.run_lifespan(['lifespan.startup', 'lifespan.shutdown'])
+        self.assertEqual(sent, [{'type': 'lifespan.startup.complete'}, {'type': 'lifespan.shutdown.complete'}])
+        self.assertIsNone(client_manager._server_loop)
+
+    def test_failed_startup(self):
+        with mock.patch.object(client_manager, 'startup', side_effect=RuntimeError("sin red")):
+            sent = self.run_lifespan(['lifespan.startup'])
+        self.assertEqual(sent, [{'type': 'lifespan.startup.failed', 'message': 'sin red'}])
+
+    def test_failed_shutdown(self):
+        with mock.patch.object(client_manager, 'startup'), \
+                mock.patch.object(client_manager, 'shutdown', side_effect=RuntimeError("bloqueado")):
+            sent = self.run_lifespan(['lifespan.startup', 'lifespan.shutdown'])
+        self.assertEqual(sent, [{'type': 'lifespan.startup.complete'},
+                                {'type': 'lifespan.shutdown.failed', 'message': 'bloqueado'}])
+
+
+@override_settings(TILE_CACHE_MAX_TILES=0)
+class OverpassSourceFilterTests(SimpleTestCase):
+    """Consulta directa (sin caché de teselas) contra el Overpass simulado"""
+
+    def setUp(self):
+        self.stub = StubOverpassServer(config=StubConfig(latency=0, density=200)).start()
+        set_endpoint_pool(build_endpoint_pool([self.stub.url], hedge=False))
+        # La densidad observada por otras pruebas (o sus precargas) cambiaría la división en celdas
+        set_query_planner(None)
+
+    def tearDown(self):
+        set_endpoint_pool(None)
+        set_query_planner(None)
+        self.stub.stop()
+
+    def fetch(self, limit, filters):
+        return async_to_sync(OverpassSource().fetch)(['trees'], (40.0, -3.8, 40.1, -3.7), limit, 25, filters)
+
+    def test_filter_pushed_down_with_limit(self):
+        filters = FeatureFilter(species='pinus', min_height=10)
+        trees = self.fetch(5, filters)['trees']
+        self.assertEqual(len(trees), 5)
+        self.assertTrue(all(filters.matches(tree) for tree in trees))
+
+    @override_settings(PLANNER_MAX_CELL_AREA=0.0025)
+    def test_large_bbox_split_into_cells(self):
+        with override_settings(PLANNER_ENABLED=False):
+            whole = self.fetch(None, None)['trees']
+        split = self.fetch(None, None)['trees']
+        # El simulado genera `density` nodos por consulta: 4 celdas, 4 veces más
+        self.assertEqual(len(whole), 200)
+        self.assertEqual(len(split), 800)
+        self.assertEqual(len(self.fetch(50, None)['trees']), 50)
+
+    @override_settings(PLANNER_MAX_CELL_AREA=0.0025)
+    def test_cells_share_the_limit(self):
+        # 4 celdas con límite 400: cada una pide 100 y no 400
+        requests = self.stub.requests
+        self.assertEqual(len(self.fetch(400, None)['trees']), 400)
+        self.assertEqual(self.stub.requests - requests, 4)
+        self.assertEqual(get_query_planner().stats()["density_tiles"], 0)
+
+    def test_filtered_query_returns_less(self):
+        everything = self.fetch(None, None)['trees']
+        pines = self.fetch(None, FeatureFilter(species='pinus'))['trees']
+        self.assertEqual(pines, [tree for tree in everything if tree['tags'].get('species') == 'Pinus pinea'])
+
+
+class QueryPlannerTests(SimpleTestCase):
+
+    def planner(self, **options):
+        return QueryPlanner(DensityMap(12), **{'max_cell_area': 0.01, 'cell_target': 1000, 'max_cells': 16,
+                                               'concurrency': 2, **options})
+
+    def test_grid_cells_cover_bbox(self):
+        cells = grid_cells((40.0, -4.0, 40.2, -3.6), 8)
+        self.assertEqual(len(cells), 8)
+        self.assertEqual((min(c[0] for c in cells), min(c[1] for c in cells),
+                          max(c[2] for c in cells), max(c[3] for c in cells)), (40.0, -4.0, 40.2, -3.6))
+        self.assertAlmostEqual(sum((c[2] - c[0]) * (c[3] - c[1]) for c in cells), 0.2 * 0.4)
+
+    def test_plan_uses_area_and_density(self):
+        planner = self.planner()
+        bbox = (40.0, -3.8, 40.05, -3.7)  # 0.005 grados²
+        self.assertEqual(len(planner.plan(['trees'], bbox)), 1)
+        planner.density.observe('trees', (40.0, -3.8, 40.01, -3.79), 500)  # 5 millones por grado²
+        self.assertGreaterEqual(len(planner.plan(['trees'], bbox)), 16)
+        self.assertEqual(len(self.planner().plan(['trees'], (40.0, -3.8, 40.2, -3.6))), 4)
+
+    def test_cell_limit(self):
+        planner = self.planner(min_cell_limit=50)
+        self.assertEqual(planner.cell_limit(1000, 16), 63)
+        self.assertEqual(planner.cell_limit(400, 16), 50)
+        self.assertEqual(planner.cell_limit(20, 16), 20)
+        self.assertEqual(planner.cell_limit(500, 1), 500)
+        self.assertIsNone(planner.cell_limit(None, 16))
+
+    def test_area_limit(self):
+        with override_settings(PLANNER_ENABLED=True, PLANNER_MAX_CELLS=16, PLANNER_MAX_CELL_AREA=0.01):
+            self.assertEqual(area_limit(1000, 0.16), 1000)
+            self.assertEqual(area_limit(1000, 0.5), 200)
+        with override_settings(PLANNER_ENABLED=False):
+            self.assertEqual(area_limit(1000, 0.02), 200)
+            self.assertEqual(area_limit(1000, 0.008), 500)
+            self.assertEqual(area_limit(1000, 0.001), 1000)
+
+    def test_fair_sample(self):
+        groups = [list(range(100)), ['a', 'b'], list(range(100, 200))]
+        sample = fair_sample(groups, 10)
+        self.assertEqual(len(sample), 10)
+        self.assertIn('a', sample)
+        self.assertIn('b', sample)
+        self.assertEqual(sum(isinstance(x, int) and x >= 100 for x in sample), 4)
+        self.assertEqual(fair_sample(groups, None), groups[0] + groups[1] + groups[2])
+
+    def test_partial_results_and_dedupe(self):
+        cells = grid_cells((0, 0, 1, 1), 4)
+
+        async def fetch_cell(cell):
+            if cell == cells[0]:
+                raise OverpassError("timeout", 'timeout')
+            # El nodo 1 está en el borde de todas las celdas
+            return {'trees': [node(1, 0.5, 0.5), node(int(cell[0] * 10 + cell[1] * 100) + 2, cell[0], cell[1])]}
+
+        result = async_to_sync(self.planner().fetch)(['trees'], cells, None, fetch_cell)
+        self.assertEqual((result.failed, result.cells), (1, 4))
+        self.assertEqual(len(result.elements_by_layer['trees']), 4)
+
+        async def failing(cell):
+            raise OverpassError("timeout", 'timeout')
+
+        with self.assertRaises(OverpassError):
+            async_to_sync(self.planner().fetch)(['trees'], cells, None, failing)
+
+
+class StubOverpassTests(SimpleTestCase):
+
+    def test_replay_clips_to_query(self):
+        recorded = [
+            node(1, 40.05, -3.75, species='Pinus pinea', height='12'),
+            node(2, 40.05, -3.75, species='Olea europaea'),
+            node(3, 41.0, -3.75, species='Pinus pinea', height='12'),
+            {"type": "node", "id": 4, "lat": 40.05, "lon": -3.75, "tags": {"natural": "tree_stump", "species": "Pinus pinea"}},
+        ]
+        query = build_bbox_query(['trees'], (40.0, -3.8, 40.1, -3.7), 50, 25, None)
+        self.assertEqual([element["id"] for element in replay_elements(query, recorded)], [1, 2])
+        filtered = build_bbox_query(['trees', 'stumps'], (40.0, -3.8, 40.1, -3.7), 50, 25,
+                                    FeatureFilter(species='pinus'))
+        self.assertEqual([element["id"] for element in replay_elements(filtered, recorded)], [1, 4])
+        self.assertEqual(replay_elements('[out:json];out;', recorded), recorded)
+
+    def test_mixed_bboxes(self):
+        bboxes = mixed_bboxes(200, 0.5, hot=5)
+        self.assertEqual(len(bboxes), 200)
+        self.assertLess(len(set(bboxes)), 150)
+        self.assertEqual(len(set(mixed_bboxes(50, 0.0))), 50)
+
+
+class StreamingParserTests(SimpleTestCase):
+
+    def body(self, count):
+        elements = [node(i, 40.0, -3.7, species='Árbol', height=str(i)) for i in range(count)]
+        return json.dumps({"version": 0.6, "osm3s": {}, "elements": elements}, ensure_ascii=False).encode()
+
+    def test_elements_split_across_chunks(self):
+        body = self.body(20)
+        for size in (1, 7, 64, len(body)):
+            parser = ElementStreamParser()
+            elements = []
+            for i in range(0, len(body), size):
+                elements.extend(parser.feed(body[i:i + size]))
+            parser.close()
+            self.assertEqual([element["id"] for element in elements], list(range(20)), size)
+            self.assertEqual(elements[3]["tags"]["species"], 'Árbol')
+
+    def test_incomplete_response(self):
+        parser = ElementStreamParser()
+        parser.feed(self.body(3)[:-20])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_stop_within_chunk(self):
+        parser = ElementStreamParser()
+        elements = parser.feed(self.body(20), layer_limit_condition(['trees'], 5)())
+        self.assertEqual(len(elements), 5)
+        self.assertTrue(parser.stopped)
+        self.assertEqual(parser.feed(b'{"type": "node"}'), [])
+        parser.close()
+
+    def test_query_stops_at_limit(self):
+        stub = StubOverpassServer(config=StubConfig(latency=0, density=500)).start()
+        set_endpoint_pool(build_endpoint_pool([stub.url], hedge=False))
+        self.addCleanup(stub.stop)
+        self.addCleanup(set_endpoint_pool, None)
+        query = build_bbox_query(['trees'], (40.0, -3.8, 40.1, -3.7), None, 25, None)
+        result = async_to_sync(query_overpass)(query, layer_limit_condition(['trees'], 30))
+        self.assertEqual(len(result["elements"]), 30)
+        self.assertEqual(len(async_to_sync(query_overpass)(query)["elements"]), 500)
+
+
+class ParsingTests(SimpleTestCase):
+
+    def test_numeric_tags(self):
+        self.assertEqual([parse_float_tag(value) for value in ("12.5", "3", "", None, "alto", "nan", "inf", "-inf")],
+                         [12.5, 3.0, None, None, None, None, None, None])
+        self.assertEqual([parse_int_tag(value) for value in ("30", " 7 ", "", None, "12.5", "viejo")],
+                         [30, 7, None, None, None, None])
+
+    def test_trees(self):
+        now = datetime(2024, 5, 1, 12, 0)
+        elements = [
+            node(1, "40.01", -3.79, species="Quercus ilex", height="inf", diameter="0.5", age="120", health="good"),
+            {"type": "node", "id": 2, "lat": "norte", "lon": -3.78, "tags": {"natural": "tree"}},
+            {"type": "node", "id": 3, "lon": -3.77, "tags": {"natural": "tree"}},
+            {"type": "way", "id": 4, "lat": 40.0, "lon": -3.7},
+            node(5, 40.05, -3.75, age="antiguo"),
+            node(6, 40.06, -3.74),
+        ]
+        trees = parse_trees(elements, 5, now)
+        self.assertEqual([tree["id"] for tree in trees], ['tree_1', 'tree_5'])
+        self.assertEqual(trees[0], {"id": "tree_1", "lat": 40.01, "lon": -3.79, "species": "Quercus ilex",
+                                    "height": None, "diameter": 0.5, "age": 120, "health": "good",
+                                    "last_updated": now})
+        self.assertIsNone(trees[1]["age"])
+        self.assertTrue(all(tree["last_updated"] is now for tree in trees))
+
+    def test_stumps_share_timestamp(self):
+        stumps = parse_stumps([
+            {"type": "node", "id": i, "lat": 40.0, "lon": -3.7, "tags": {"diameter": "nan", "removal_reason": "storm"}}
+            for i in range(3)
+        ], 10)
+        self.assertEqual(len({id(stump["removal_date"]) for stump in stumps}), 1)
+        self.assertEqual([(stump["diameter"], stump["reason"]) for stump in stumps], [(None, "storm")] * 3)
+        self.assertEqual(data_time(0.0), datetime.fromtimestamp(0.0))
+
+
+class FormatsTests(SimpleTestCase):
+    now = datetime(2024, 5, 1, 12, 0)
+    trees = parse_trees([
+        node(10, 40.05, -3.75, species="Pinus pinea", height="12.5"),
+        node(7, 40.06, -3.74, species="Quercus ilex", health="good"),
+        node(3_000_000_000, 40.07, -3.73, species="Pinus pinea", age="30"),
+    ], 10, now)
+
+    def test_columnar_round_trip(self):
+        data = to_columnar('trees', self.trees, self.now)
+        self.assertEqual((data["count"], data["generated_at"]), (3, self.now.isoformat()))
+        self.assertNotIn("diameter", data)
+        for i, tree in enumerate(self.trees):
+            self.assertEqual(f"tree_{data['id'][i]}", tree["id"])
+            self.assertEqual((data["lat"][i], data["lon"][i]), (tree["lat"], tree["lon"]))
+            self.assertEqual((data["height"][i], data["age"][i]), (tree["height"], tree["age"]))
+            for name in ("species", "health"):
+                index = data[name]["index"][i]
+                self.assertEqual(None if index < 0 else data[name]["values"][index], tree[name])
+        self.assertEqual(data["species"]["values"], ["Pinus pinea", "Quercus ilex"])
+
+    def test_binary_round_trip(self):
+        stumps = [{"id": "stump_5", "lat": 40.0, "lon": -3.8, "diameter": None, "species": None, "reason": "storm"}]
+        data = encode_binary_block('trees', self.trees, self.now) + encode_binary_block('stumps', stumps, self.now)
+        self.assertEqual(len(data) % 4, 0)
+        (header, columns), (stump_header, stump_columns) = decode_binary_blocks(data)
+        self.assertEqual((header["layer"], header["count"], header["numeric"]), ('trees', 3, ["height", "age"]))
+        self.assertEqual(columns["id"], [10, 7, 3_000_000_000])
+        for i, tree in enumerate(self.trees):
+            self.assertAlmostEqual(columns["lat"][i], tree["lat"], places=5)
+            self.assertAlmostEqual(columns["lon"][i], tree["lon"], places=5)
+            self.assertEqual(columns["species"][i], tree["species"])
+            self.assertEqual(columns["health"][i], tree["health"])
+        self.assertEqual(columns["height"][0], 12.5)
+        self.assertTrue(math.isnan(columns["height"][1]))
+        self.assertEqual(columns["age"][2], 30)
+        self.assertEqual((stump_header["layer"], stump_header["numeric"]), ('stumps', []))
+        self.assertEqual((stump_columns["id"], stump_columns["reason"]), ([5], ["storm"]))
+
+    def test_compression_negotiation(self):
+        factory = RequestFactory()
+        many = self.trees * 20
+        middleware = CompressionMiddleware(lambda request: layers_response({'trees': many}, 'json', single=True))
+        body = layers_response({'trees': many}, 'json', single=True).content
+
+        response = middleware(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate, br'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        if brotli is not None:  # sin brotli se usa gzip
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.content), body)
+
+        response = middleware(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), body)
+
+        self.assertFalse(middleware(factory.get('/')).has_header('Content-Encoding'))
+        small = CompressionMiddleware(lambda request: layers_response({'trees': []}, 'json', single=True))
+        self.assertFalse(small(factory.get('/', HTTP_ACCEPT_ENCODING='br')).has_header('Content-Encoding'))
+
+
+class ClusteringTests(SimpleTestCase):
+
+    def test_counts_centroid_and_bbox(self):
+        cell_lat, cell_lon = cell_size(12, 4, 40.0)
+        self.assertAlmostEqual(cell_lon, 360.0 / 4096 / 4)
+        self.assertLess(cell_lat, cell_lon)
+        elements = [node(i, 40.0001 + i * 1e-5, -3.7001 - i * 1e-5) for i in range(3)] + [node(9, 40.2, -3.5)]
+        clusters = cluster_points(*elements_to_arrays(elements), cell_lat, cell_lon)
+        self.assertEqual([cluster["count"] for cluster in clusters], [3, 1])
+        self.assertEqual(sum(cluster["count"] for cluster in clusters), len(elements))
+        self.assertAlmostEqual(clusters[0]["lat"], 40.00011)
+        self.assertAlmostEqual(clusters[0]["lon"], -3.70011)
+        for cluster in clusters:
+            min_lat, min_lon, max_lat, max_lon = cluster["bbox"]
+            self.assertAlmostEqual(max_lat - min_lat, cell_lat)
+            self.assertAlmostEqual(max_lon - min_lon, cell_lon)
+            self.assertTrue(min_lat <= cluster["lat"] < max_lat and min_lon <= cluster["lon"] < max_lon)
+
+    def test_grid_is_global(self):
+        # La celda de un punto no depende de qué otros puntos se agrupan con él
+        cell = cell_size(10, 4, 40.0)
+        alone = cluster_points(*elements_to_arrays([node(1, 40.05, -3.75)]), *cell)
+        shifted = cluster_points(*elements_to_arrays([node(1, 40.05, -3.75), node(2, 41.5, -2.0)]), *cell)
+        self.assertIn(alone[0]["bbox"], [cluster["bbox"] for cluster in shifted])
+        self.assertEqual(cluster_points(*elements_to_arrays([]), *cell), [])
+
+
+class BatchSource(DataSource):
+    """Fuente que entrega lotes fijos y, opcionalmente, falla después"""
+
+    def __init__(self, batches, error=None):
+        self.batches = batches
+        self.error = error
+
+    async def stream(self, layers, bbox, limit, timeout, filters=None):
+        for batch in self.batches:
+            yield batch
+        if self.error is not None:
+            raise self.error
+
+
+class NdjsonTests(SimpleTestCase):
+    bbox = (40.0, -3.8, 40.1, -3.7)
+
+    def lines(self, source, layers, limit):
+        async def collect():
+            return [chunk async for chunk in ndjson_lines(source, layers, self.bbox, limit, 25)]
+
+        return [json.loads(line) for chunk in async_to_sync(collect)() for line in chunk.splitlines()]
+
+    def test_limit_per_layer_across_batches(self):
+        stump = {"type": "node", "id": 50, "lat": 40.05, "lon": -3.75, "tags": {"natural": "tree_stump"}}
+        source = BatchSource([
+            ('trees', [node(1, 40.01, -3.79), node(2, 40.02, -3.78)]),
+            ('stumps', [stump]),
+            ('trees', [node(3, 40.03, -3.77), node(4, 40.04, -3.76)]),
+            ('trees', [node(5, 40.05, -3.75)]),
+        ])
+        lines = self.lines(source, ['trees', 'stumps'], 3)
+        self.assertEqual([(line["layer"], line["id"]) for line in lines[:-1]],
+                         [('trees', 'tree_1'), ('trees', 'tree_2'), ('stumps', 'stump_50'), ('trees', 'tree_3')])
+        self.assertEqual(lines[-1], {"done": True, "counts": {"trees": 3, "stumps": 1}})
+
+    def test_error_line_on_failure(self):
+        source = BatchSource([('trees', [node(1, 40.01, -3.79)])], OverpassError("caído", "http", 504))
+        lines = self.lines(source, ['trees'], 10)
+        self.assertEqual(lines[0]["id"], 'tree_1')
+        self.assertEqual(lines[-1], {"error": "Error interno del servidor."})
+        self.assertNotIn("done", lines[-1])
+
+    def test_response_headers(self):
+        response = ndjson_response(BatchSource([('trees', [node(1, 40.01, -3.79)])]), ['trees'], self.bbox, 10, 25)
+        self.assertEqual(response['Content-Type'], NDJSON_CONTENT_TYPE)
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+
+        async def collect():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        lines = async_to_sync(collect)().decode().splitlines()
+        self.assertEqual(json.loads(lines[-1]), {"done": True, "counts": {"trees": 1}})
+
+
+class MixedSource(DataSource):
+    """Fuente que responde a cada consulta con una mezcla de árboles y tocones"""
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.calls = []
+
+    async def fetch(self, layers, bbox, limit, timeout, filters=None):
+        self.calls.append((layers, limit))
+        return LayerElements(split_by_layer(self.elements, layers), time.time())
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class FeaturesViewTests(SimpleTestCase):
+
+    def setUp(self):
+        stumps = [{"type": "node", "id": 100 + i, "lat": 40.05, "lon": -3.75,
+                   "tags": {"natural": "tree_stump", "diameter": "0.4", "removal_reason": "storm"}} for i in range(3)]
+        trees = [node(i, 40.01, -3.79, species="Quercus ilex", height="7") for i in range(5)]
+        self.source = MixedSource([trees[0], stumps[0], *trees[1:], *stumps[1:], node(99, 40.0, -3.7, amenity="x")])
+        set_data_source(self.source)
+        self.addCleanup(set_data_source, None)
+
+    def test_one_query_split_by_layer(self):
+        response = self.client.get('/api/features/?bbox=40.0,-3.8,40.1,-3.7&limit=4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.source.calls, [(['trees', 'stumps'], 4)])
+        data = response.json()
+        self.assertEqual([tree["id"] for tree in data["trees"]], ['tree_0', 'tree_1', 'tree_2', 'tree_3'])
+        self.assertEqual([stump["id"] for stump in data["stumps"]], ['stump_100', 'stump_101', 'stump_102'])
+        self.assertEqual(set(data["trees"][0]), set(Tree.model_fields))
+        self.assertEqual(set(data["stumps"][0]), set(Stump.model_fields))
+        Tree(**data["trees"][0])
+        stump = Stump(**data["stumps"][0])
+        self.assertEqual((stump.diameter, stump.reason), (0.4, 'storm'))
+        self.assertEqual(data["trees"][0]["height"], 7.0)
+
+    def test_union_query_has_both_layers(self):
+        query = build_bbox_query(['trees', 'stumps'], (40.0, -3.8, 40.1, -3.7), 4, 25)
+        self.assertEqual(query.count('out 4;'), 2)
+        self.assertIn('node["natural"="tree"]', query)
+        self.assertIn('node["natural"="tree_stump"]', query)
+
+
+class MvtTests(SimpleTestCase):
+    z, x, y = 16, *lat_lon_to_tile(40.05, -3.75, 16)
+
+    def elements(self):
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(self.z, self.x, self.y)
+        return [
+            node(1, (min_lat + max_lat) / 2, (min_lon + max_lon) / 2, species="Pinus pinea", height="12.5"),
+            node(2, max_lat - 1e-9, min_lon + 1e-9, species="Quercus ilex"),
+            node(3, max_lat + (max_lat - min_lat) / 2, min_lon),  # fuera del margen de la tesela
+        ]
+
+    def test_detail_tile_decodes(self):
+        elements = self.elements()
+        data = encode_tile({'trees': tile_features('trees', elements, self.z, self.x, self.y), 'stumps': []})
+        layers = decode_mvt(data)
+        self.assertEqual(list(layers), ['trees'])
+        extent, version, features = layers['trees']
+        self.assertEqual((extent, version), (EXTENT, 2))
+        self.assertEqual([feature[0] for feature in features], [1, 2])
+        for (_, point, _), element in zip(features, elements):
+            self.assertEqual(point, project(element["lat"], element["lon"], self.z, self.x, self.y))
+            self.assertTrue(all(0 <= value <= EXTENT for value in point))
+        self.assertEqual(features[0][2], {"species": "Pinus pinea", "height": 12.5})
+        self.assertEqual(features[1][1], (0, 0))
+
+    def test_low_zoom_grouped_with_count(self):
+        z, x, y = self.z - 2, self.x >> 2, self.y >> 2
+        features = decode_mvt(encode_tile({'trees': tile_features('trees', self.elements() * 3, z, x, y)}))['trees'][2]
+        self.assertEqual(sorted(feature[2]["count"] for feature in features), [3, 3, 3])
+        self.assertTrue(all(feature[0] is None for feature in features))
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class HttpCacheTests(SimpleTestCase):
+
+    def test_normalized_params(self):
+        factory = RequestFactory()
+        key = normalized_params(factory.get('/api/features/?tiles=16/2/1,16/1/2&limit=050&format=json&timeout=30'))
+        self.assertEqual(key, '/api/features/?limit=50&tiles=16/1/2,16/2/1')
+        self.assertEqual(normalized_params(factory.get('/api/trees/?species=Pinus&bbox=40.0000001,-3.8,40.1,-3.7')),
+                         normalized_params(factory.get('/api/trees/?bbox=40.0,-3.8,40.1,-3.70&species=pinus')))
+
+    def test_etag_matches_weak(self):
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"a", W/"b"')
+        self.assertTrue(etag_matches(request, '"b"'))
+        self.assertTrue(etag_matches(request, 'W/"a"'))
+        self.assertFalse(etag_matches(request, '"c"'))
+
+    def test_revalidation_without_upstream_query(self):
+        stub = StubOverpassServer(config=StubConfig(latency=0, density=50)).start()
+        set_endpoint_pool(build_endpoint_pool([stub.url], hedge=False))
+        self.addCleanup(stub.stop)
+        self.addCleanup(set_endpoint_pool, None)
+        self.addCleanup(set_query_planner, None)
+
+        # La primera petición llena la caché de teselas; la segunda ya conoce su versión
+        self.client.get('/api/trees/?bbox=38.0,-1.02,38.004,-1.0&limit=20')
+        response = self.client.get('/api/trees/?bbox=38.0,-1.02,38.004,-1.0&limit=20')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        shortcuts = get_etag_index().stats()['shortcuts']
+        queries = stub.requests
+
+        again = self.client.get('/api/trees/?limit=20&bbox=38.0,-1.020,38.004,-1.0',
+                                HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], response['ETag'])
+        self.assertEqual(get_etag_index().stats()['shortcuts'], shortcuts + 1)
+        self.assertEqual(stub.requests, queries)
+
+    @override_settings(TILE_CACHE_MAX_TILES=0, PLANNER_ENABLED=False, OVERPASS_MAX_RETRY_WAIT=0)
+    def test_upstream_error_not_cached(self):
+        stub = StubOverpassServer(config=StubConfig(latency=0, error_rate=1.0, error_status=429)).start()
+        set_endpoint_pool(build_endpoint_pool([stub.url], hedge=False))
+        self.addCleanup(stub.stop)
+        self.addCleanup(set_endpoint_pool, None)
+
+        for path in ('/api/trees/', '/api/stumps/', '/api/features/'):
+            response = self.client.get(path + '?bbox=38.1,-1.02,38.104,-1.0&limit=20')
+            self.assertGreaterEqual(response.status_code, 500, path)
+            self.assertFalse(response.has_header('ETag'), path)
+            self.assertNotIn('public', response.get('Cache-Control', ''), path)
+        self.assertEqual(self.client.get('/api/stumps/?bbox=a,b').status_code, 400)
+
+    def test_static_files_precompressed(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(reset_static_index)
+        os.makedirs(os.path.join(root, 'js'))
+        with open(os.path.join(root, 'js', 'app.0123456789ab.js'), 'w') as f:
+            f.write('console.log("árbol");\n' * 100)
+        with open(os.path.join(root, 'staticfiles.json'), 'w') as f:
+            f.write('{"paths": {"js/app.js": "js/app.0123456789ab.js"}, "version": "1.1"}')
+        compress_file(os.path.join(root, 'js', 'app.0123456789ab.js'))
+        reset_static_index()
+        factory = RequestFactory()
+        with override_settings(STATIC_ROOT=root):
+            response = serve_static(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate'), 'js/app.0123456789ab.js')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            plain = serve_static(factory.get('/'), 'js/app.0123456789ab.js')
+            self.assertFalse(plain.has_header('Content-Encoding'))
+            self.assertNotEqual(plain['ETag'], response['ETag'])
+            self.assertEqual(serve_static(factory.get('/', HTTP_IF_NONE_MATCH=plain['ETag']),
+                                          'js/app.0123456789ab.js').status_code, 304)
+            self.assertIsNone(serve_static(factory.get('/'), 'js/otro.js'))
+
+
+class StatsTests(SimpleTestCase):
+
+    def summary(self):
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(14, 8020, 6194)
+        height, width = max_lat - min_lat, max_lon - min_lon
+        trees = [node(i, min_lat + height * (i % 10 + 0.5) / 10, min_lon + width * (i // 10 + 0.5) / 10,
+                      species='Pinus pinea' if i % 2 else 'Quercus ilex') for i in range(100)]
+        outside = node(100, max_lat + height, min_lon)
+        layers = summarize_tile({'trees': trees + [outside], 'stumps': []}, 14, 8020, 6194, 8)
+        return TileSummary(layers, None), (min_lat, min_lon, max_lat, max_lon)
+
+    def test_whole_tile(self):
+        summary, bounds = self.summary()
+        self.assertEqual(summary.layers['trees'].count, 100)
+        accumulator = StatsAccumulator(['trees', 'stumps'], bounds, 8)
+        accumulator.add(14, 8020, 6194, summary)
+        result = accumulator.result(top_species=1)
+        self.assertFalse(result['approximate'])
+        self.assertEqual(result['trees']['count'], 100)
+        self.assertEqual(result['trees']['species_count'], 2)
+        self.assertEqual(result['trees']['other_species'], 50)
+        self.assertEqual(result['stumps']['count'], 0)
+
+    def test_edge_tile_clipped_by_cells(self):
+        summary, (min_lat, min_lon, max_lat, max_lon) = self.summary()
+        # La mitad oeste coincide con el borde de las subceldas: recuento exacto
+        half = StatsAccumulator(['trees'], (min_lat - 1, min_lon - 1, max_lat + 1, (min_lon + max_lon) / 2), 8)
+        half.add(14, 8020, 6194, summary)
+        self.assertFalse(half.approximate)
+        self.assertEqual(half.result(10)['trees']['count'], 50)
+        # Un corte a mitad de subcelda reparte su recuento por área
+        third = StatsAccumulator(['trees'], (min_lat - 1, min_lon - 1, max_lat + 1, min_lon + (max_lon - min_lon) / 3), 8)
+        third.add(14, 8020, 6194, summary)
+        self.assertTrue(third.approximate)
+        self.assertAlmostEqual(third.counts['trees'], 100 / 3, delta=5)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_histogram_render(self):
+        histogram = Histogram('test_seconds', 'Prueba', ('endpoint',), (0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, 'api_trees')
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{endpoint="api_trees",le="0.1"} 1',
+            'test_seconds_bucket{endpoint="api_trees",le="1.0"} 2',
+            'test_seconds_bucket{endpoint="api_trees",le="+Inf"} 3',
+            'test_seconds_sum{endpoint="api_trees"} 5.55',
+            'test_seconds_count{endpoint="api_trees"} 3',
+        ])
+
+    def test_cache_outcome_keeps_worst(self):
+        timings = RequestTimings()
+        for outcome in ('hit', 'miss', 'stale'):
+            timings.set_cache(outcome)
+        timings.add('parse', 0.002)
+        self.assertEqual(timings.cache, 'miss')
+        self.assertEqual(timings.server_timing(0.01), 'parse;dur=2.0, total;dur=10.0, cache;desc="miss"')
+
+    def test_counters_and_worker_label(self):
+        text = render_metrics()
+        worker = f'worker="{os.getpid()}"'
+        self.assertIn('# TYPE maps_tile_cache_hits_total counter', text)
+        self.assertIn('# TYPE maps_tile_cache_entries gauge', text)
+        self.assertNotIn('# TYPE maps_tile_cache_hits gauge', text)
+        self.assertTrue(any(line.startswith('maps_tile_cache_hits_total{') and worker in line
+                            for line in text.splitlines()))
+
+    def test_aggregates_workers(self):
+        directory = tempfile.mkdtemp()
+        with override_settings(METRICS_DIR=directory):
+            write_worker_metrics()
+            with open(os.path.join(directory, f'{os.getpid()}.json'), encoding='utf-8') as f:
+                own = f.read()
+            # Otro worker vivo (el proceso padre) y uno terminado
+            other = own.replace(f'worker=\\"{os.getpid()}\\"', f'worker=\\"{os.getppid()}\\"')
+            self.assertNotEqual(other, own)
+            for pid in (os.getppid(), 4 * 10 ** 7):
+                with open(os.path.join(directory, f'{pid}.json'), 'w', encoding='utf-8') as f:
+                    f.write(other)
+            lines = render_metrics().splitlines()
+        hits = [line for line in lines if line.startswith('maps_tile_cache_hits_total{')]
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(lines.count('# TYPE maps_tile_cache_hits_total counter'), 1)
+        self.assertFalse(os.path.exists(os.path.join(directory, f'{4 * 10 ** 7}.json')))
@@ -0,0 +1,353 @@
+"""
+Caché de teselas para las consultas a Overpass
+
+Las consultas se descomponen en teselas fijas (z/x/y, esquema de OSM) para
+que bboxes distintos pero solapados reutilicen los mismos resultados. Cada
+tesela guarda la lista completa de elementos OSM de una capa.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# (capa, z, x, y)
+TileKey = Tuple[str, int, int, int]
+Tile = Tuple[int, int, int]
+T = TypeVar('T')
+
+# Latitud máxima representable en la proyección Web Mercator
+MAX_LATITUDE = 85.0511287798
+
+
+def lat_lon_to_tile(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+    """Devuelve las coordenadas x/y de la tesela que contiene el punto"""
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Devuelve el bbox de una tesela como (min_lat, min_lon, max_lat, max_lon)"""
+    n = 1 << zoom
+    min_lon = x / n * 360.0 - 180.0
+    max_lon = (x + 1) / n * 360.0 - 180.0
+    max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def tiles_for_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int) -> List[Tile]:
+    """Lista las teselas (z, x, y) que cubren un bbox"""
+    min_x, max_y = lat_lon_to_tile(min_lat, min_lon, zoom)
+    max_x, min_y = lat_lon_to_tile(max_lat, max_lon, zoom)
+    return [
+        (zoom, x, y)
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+    ]
+
+
+def count_tiles_for_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int) -> int:
+    """Número de teselas que cubren un bbox, sin construir la lista"""
+    min_x, max_y = lat_lon_to_tile(min_lat, min_lon, zoom)
+    max_x, min_y = lat_lon_to_tile(max_lat, max_lon, zoom)
+    return (max_x - min_x + 1) * (max_y - min_y + 1)
+
+
+def parse_tile_list(value: str) -> List[Tile]:
+    """Lista de teselas "z/x/y,z/x/y,..." de un mismo zoom. Lanza ValueError si no es válida"""
+    tiles = []
+    for item in value.split(","):
+        z, x, y = (int(part) for part in item.strip().split("/"))
+        if not 0 <= z <= 22 or not 0 <= x < (1 << z) or not 0 <= y < (1 << z):
+            raise ValueError(f"tesela fuera de rango: {item}")
+        tiles.append((z, x, y))
+    if len({z for z, _, _ in tiles}) > 1:
+        raise ValueError("todas las teselas deben tener el mismo zoom")
+    return list(dict.fromkeys(tiles))
+
+
+def tiles_bbox(tiles: Iterable[Tile]) -> Tuple[float, float, float, float]:
+    """Bbox que cubre un conjunto de teselas"""
+    bounds = [tile_bounds(*tile) for tile in tiles]
+    return (
+        min(b[0] for b in bounds),
+        min(b[1] for b in bounds),
+        max(b[2] for b in bounds),
+        max(b[3] for b in bounds),
+    )
+
+
+def neighbour_tiles(tiles: Iterable[Tile], margin: int) -> List[Tile]:
+    """Teselas del anillo de `margin` teselas alrededor del rectángulo que forman `tiles`"""
+    tiles = list(tiles)
+    if not tiles or margin <= 0:
+        return []
+    zoom = tiles[0][0]
+    n = 1 << zoom
+    min_x = min(x for _, x, _ in tiles)
+    max_x = max(x for _, x, _ in tiles)
+    min_y = min(y for _, _, y in tiles)
+    max_y = max(y for _, _, y in tiles)
+    return [
+        (zoom, x, y)
+        for x in range(max(min_x - margin, 0), min(max_x + margin, n - 1) + 1)
+        for y in range(max(min_y - margin, 0), min(max_y + margin, n - 1) + 1)
+        if not (min_x <= x <= max_x and min_y <= y <= max_y)
+    ]
+
+
+class TileCache:
+    """
+    Caché LRU de teselas con TTL, limitada por tamaño en bytes.
+
+    Nivel en memoria compartido por todos los hilos del proceso y, de forma
+    opcional, un nivel en disco (un fichero JSON por tesela) que sobrevive a
+    reinicios y se comparte entre workers.
+
+    Las teselas caducadas se conservan `stale_ttl` segundos más: get() no las
+    devuelve, pero get_stale() sí, para servirlas si Overpass no responde, y
+    get_many() las devuelve si caducaron hace menos de `max_stale` segundos,
+    para servirlas mientras se refrescan en segundo plano.
+
+    Con nivel en disco, el código asíncrono llama a la caché a través de
+    offload() para no bloquear el event loop con la lectura de ficheros.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, cache_dir: Optional[str] = None, stale_ttl: float = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache_dir = cache_dir or None
+        self._entries: "OrderedDict[TileKey, Tuple[float, int, list]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Nivel en memoria
+    def _get_memory(self, key: TileKey, now: float) -> Optional[Tuple[float, list]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            fetched_at, size, elements = entry
+            if now - fetched_at > self.ttl + self.stale_ttl:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return fetched_at, elements
+
+    def _set_memory(self, key: TileKey, elements: list, size: int, fetched_at: float) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (fetched_at, size, elements)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    # Nivel en disco
+    def _disk_path(self, key: TileKey) -> str:
+        layer, z, x, y = key
+        return os.path.join(self.cache_dir, layer, str(z), str(x), f"{y}.json")
+
+    def _get_disk(self, key: TileKey, now: float) -> Optional[Tuple[float, int, list]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            payload = json.loads(raw)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Tesela en disco ilegible {path}: {e}")
+            return None
+        fetched_at = payload.get("fetched_at", 0)
+        if now - fetched_at > self.ttl + self.stale_ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return fetched_at, len(raw), payload.get("elements", [])
+
+    def _set_disk(self, key: TileKey, raw: bytes) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"No se pudo escribir la tesela en disco {path}: {e}")
+
+    # API pública
+    def _find(self, key: TileKey, now: float) -> Tuple[Optional[Tuple[float, list]], bool]:
+        """Entrada (fetched_at, elementos) en memoria o, si no, en disco, y si venía del disco"""
+        entry = self._get_memory(key, now)
+        if entry is None and self.cache_dir:
+            disk_entry = self._get_disk(key, now)
+            if disk_entry is not None:
+                fetched_at, size, elements = disk_entry
+                self._set_memory(key, elements, size, fetched_at)
+                return (fetched_at, elements), True
+        return entry, False
+
+    def _lookup(self, key: TileKey, max_stale: float, count_miss: bool = True) -> Optional[Tuple[float, list]]:
+        now = time.time()
+        entry, from_disk = self._find(key, now)
+        age = now - entry[0] if entry is not None else None
+        fresh = age is not None and age <= self.ttl
+        usable = age is not None and age <= self.ttl + max_stale
+        with self._lock:
+            if fresh:
+                if from_disk:
+                    self.disk_hits += 1
+                else:
+                    self.hits += 1
+            elif usable:
+                self.stale_hits += 1
+            elif count_miss:
+                self.misses += 1
+        return entry if usable else None
+
+    def get(self, key: TileKey) -> Optional[list]:
+        """Devuelve los elementos de una tesela o None si no está (o ha caducado)"""
+        entry = self._lookup(key, 0)
+        return entry[1] if entry is not None else None
+
+    def get_stale(self, key: TileKey) -> Optional[Tuple[float, list]]:
+        """Devuelve (fetched_at, elementos) de una tesela aunque haya caducado, si se conserva todavía"""
+        return self._lookup(key, self.stale_ttl, count_miss=False)
+
+    def get_many(self, keys: Iterable[TileKey], max_stale: float = 0) -> Tuple[Dict[TileKey, Tuple[float, list]], List[TileKey]]:
+        """
+        Devuelve las teselas encontradas como clave -> (fetched_at, elementos)
+        y la lista de las que faltan.
+
+        Con `max_stale` también se devuelven las que caducaron hace menos de
+        esos segundos; el llamador decide si refrescarlas.
+        """
+        found: Dict[TileKey, Tuple[float, list]] = {}
+        missing: List[TileKey] = []
+        for key in keys:
+            entry = self._lookup(key, max_stale)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry
+        return found, missing
+
+    def peek(self, key: TileKey) -> Optional[float]:
+        """Instante en que se obtuvo una tesela en caché, sin contarlo como acierto ni fallo"""
+        entry, _ = self._find(key, time.time())
+        return entry[0] if entry is not None else None
+
+    def is_fresh(self, fetched_at: float) -> bool:
+        """Indica si una tesela obtenida en `fetched_at` no ha caducado"""
+        return time.time() - fetched_at <= self.ttl
+
+    def set(self, key: TileKey, elements: list) -> None:
+        """Guarda los elementos de una tesela"""
+        fetched_at = time.time()
+        raw = None
+        if self.cache_dir:
+            raw = json.dumps({"fetched_at": fetched_at, "elements": elements}, separators=(',', ':')).encode()
+            self._set_disk(key, raw)
+        size = len(raw) if raw is not None else len(json.dumps(elements, separators=(',', ':')))
+        self._set_memory(key, elements, size, fetched_at)
+
+    def set_many(self, tiles: Dict[TileKey, list]) -> None:
+        """Guarda los elementos de varias teselas"""
+        for key, elements in tiles.items():
+            self.set(key, elements)
+
+    async def offload(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Ejecuta una operación de la caché desde código asíncrono: en un hilo
+        si hay nivel en disco, directamente si solo hay memoria
+        """
+        if self.cache_dir is None:
+            return func(*args, **kwargs)
+        return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+    def invalidate(self, keys: Iterable[TileKey]) -> int:
+        """Elimina teselas de la caché (memoria y disco). Devuelve cuántas había en memoria"""
+        removed = 0
+        for key in keys:
+            with self._lock:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+                    removed += 1
+            if self.cache_dir:
+                try:
+                    os.remove(self._disk_path(key))
+                except OSError:
+                    pass
+        return removed
+
+    def clear(self) -> None:
+        """Vacía el nivel en memoria"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Contadores de uso de la caché"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+_tile_cache: Optional[TileCache] = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache() -> TileCache:
+    """Instancia de TileCache del proceso, configurada desde settings"""
+    global _tile_cache
+    if _tile_cache is None:
+        with _tile_cache_lock:
+            if _tile_cache is None:
+                _tile_cache = TileCache(
+                    max_bytes=settings.TILE_CACHE_MAX_BYTES,
+                    ttl=settings.TILE_CACHE_TTL,
+                    cache_dir=settings.TILE_CACHE_DIR,
+                    stale_ttl=settings.TILE_CACHE_STALE_TTL,
+                )
+    return _tile_cache
@@ -0,0 +1,629 @@
+"""
+Control del tráfico hacia la API de Overpass
+
+Las consultas se reparten entre los servidores de OVERPASS_URLS eligiendo el
+de menor latencia media y tasa de errores recientes (EWMA). Opcionalmente, si
+el servidor elegido tarda más que su p90, se lanza la misma consulta a otro
+(cobertura o "hedging") y se usa la primera respuesta.
+
+Cada servidor tiene su propio planificador que:
+
+- limita las consultas simultáneas (OVERPASS_MAX_CONCURRENT, ajustado al
+  "Rate limit" que anuncia /api/status) con una cola por prioridad, para que
+  las peticiones del mapa adelanten a la precarga y al refresco en segundo
+  plano;
+- espacia las consultas con un token bucket que reduce el ritmo a la mitad
+  con cada 429 (respetando Retry-After) y lo recupera poco a poco con cada
+  respuesta correcta;
+- corta el tráfico con un circuit breaker tras varios fallos seguidos, de
+  modo que las peticiones fallan al momento (y se sirven de la caché, aunque
+  esté caducada) en lugar de acumular reintentos contra un servidor caído.
+
+Las consultas pueden venir de loops distintos (el del servidor ASGI, los de
+async_to_sync bajo WSGI, el de segundo plano), así que el estado se protege
+con locks de threading y las esperas usan futures de concurrent.futures.
+"""
+import asyncio
+import concurrent.futures
+import enum
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Iterable, List, Optional
+
+from django.conf import settings
+
+from .http_client import client_manager
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo entre consultas a /api/status
+STATUS_MIN_INTERVAL = 10.0  # segundos
+
+# Estadísticas por servidor
+EWMA_ALPHA = 0.2
+ERROR_PENALTY = 30.0       # segundos de coste añadidos con una tasa de errores del 100%
+ERROR_HALF_LIFE = 60.0     # segundos
+LATENCY_SAMPLES = 100      # latencias recientes para calcular el p90
+HEDGE_MIN_SAMPLES = 10
+
+
+class Priority(enum.IntEnum):
+    """Prioridad de una consulta: los valores menores se atienden antes"""
+    INTERACTIVE = 0  # peticiones del mapa
+    BACKGROUND = 1   # precarga y refresco de teselas
+
+
+class OverpassError(Exception):
+    """
+    Error de una consulta a Overpass.
+
+    El mensaje es el que se registra y se muestra; `kind` clasifica el error:
+    'timeout', 'http', 'connection', 'unexpected', 'circuit_open' o
+    'queue_timeout'. `endpoint` es la URL del servidor que falló.
+    """
+
+    def __init__(self, message: str, kind: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None, endpoint: Optional[str] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.endpoint = endpoint
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.status_code == 429
+
+    @property
+    def retryable(self) -> bool:
+        """Errores transitorios del servidor o de la red, que merece la pena reintentar"""
+        if self.kind in ('timeout', 'connection'):
+            return True
+        return self.kind == 'http' and self.status_code in (429, 502, 503, 504)
+
+    @property
+    def unavailable(self) -> bool:
+        """Overpass no acepta consultas ahora mismo (saturado o circuito abierto)"""
+        return self.kind in ('circuit_open', 'queue_timeout') or self.rate_limited
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Segundos de una cabecera Retry-After (número de segundos o fecha HTTP)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class OverpassStatus:
+    """Estado de nuestra IP en Overpass según /api/status"""
+    rate_limit: int                 # huecos por IP (0 = sin límite)
+    slots_available: int            # huecos libres ahora mismo
+    next_slot_in: Optional[float]   # segundos hasta el próximo hueco, si no hay ninguno libre
+
+
+STATUS_RATE_LIMIT_RE = re.compile(r'^Rate limit: (\d+)', re.MULTILINE)
+STATUS_SLOTS_RE = re.compile(r'^(\d+) slots? available now', re.MULTILINE)
+STATUS_SLOT_AFTER_RE = re.compile(r'^Slot available after: .*?, in (-?\d+) seconds?', re.MULTILINE)
+
+
+def parse_status(text: str) -> OverpassStatus:
+    """Interpreta la respuesta en texto de /api/status"""
+    rate_limit = STATUS_RATE_LIMIT_RE.search(text)
+    if rate_limit is None:
+        raise ValueError("Respuesta de /api/status sin 'Rate limit'")
+    slots = STATUS_SLOTS_RE.search(text)
+    waits = [max(0, int(seconds)) for seconds in STATUS_SLOT_AFTER_RE.findall(text)]
+    return OverpassStatus(
+        rate_limit=int(rate_limit.group(1)),
+        slots_available=int(slots.group(1)) if slots else 0,
+        next_slot_in=float(min(waits)) if waits else None,
+    )
+
+
+class PrioritySemaphore:
+    """
+    Semáforo con cola por prioridad utilizable desde varios event loops.
+
+    Los huecos libres se conceden siempre al esperador de menor prioridad (y,
+    a igual prioridad, al más antiguo). La capacidad se puede cambiar en
+    caliente.
+    """
+
+    def __init__(self, capacity: int):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._in_use = 0
+        self._waiters: list = []  # heap de (prioridad, orden, future)
+        self._order = itertools.count()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def set_capacity(self, capacity: int) -> None:
+        with self._lock:
+            self._capacity = max(1, capacity)
+            self._wake()
+
+    def _wake(self) -> None:
+        """Concede huecos libres a los esperadores. Requiere self._lock"""
+        while self._in_use < self._capacity and self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            # Los esperadores cancelados se descartan al salir de la cola
+            if future.set_running_or_notify_cancel():
+                self._in_use += 1
+                future.set_result(None)
+
+    async def acquire(self, priority: int, timeout: Optional[float] = None) -> bool:
+        """Espera un hueco; devuelve False si pasa `timeout` segundos sin conseguirlo"""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, next(self._order), future))
+            self._wake()
+        if future.done():
+            return True
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Si el hueco se concedió justo a la vez, devolverlo
+            if not future.cancel():
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_use -= 1
+            self._wake()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": self._capacity,
+                "in_use": self._in_use,
+                "waiting": sum(1 for _, _, future in self._waiters if not future.cancelled()),
+            }
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket con ritmo adaptativo.
+
+    Cada 429 reduce el ritmo a la mitad (hasta `min_rate`) y pausa las
+    consultas durante el Retry-After; cada respuesta correcta lo recupera en
+    un 5% del máximo.
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, max_wait: Optional[float]) -> float:
+        """
+        Reserva un token y devuelve cuántos segundos hay que esperar para usarlo.
+        Si la espera supera `max_wait` no lo reserva y devuelve la espera con signo negativo.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max((1 - self._tokens) / self.rate, 0.0, self._paused_until - now)
+            if max_wait is not None and wait > max_wait:
+                return -wait
+            self._tokens -= 1
+            return wait
+
+    async def acquire(self, max_wait: Optional[float] = None) -> bool:
+        """Espera un token; devuelve False sin esperar si habría que hacerlo más de `max_wait` segundos"""
+        wait = self._reserve(max_wait)
+        if wait < 0:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def wait_time(self) -> float:
+        """Segundos hasta que haya un token disponible"""
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            return max((1 - tokens) / self.rate, 0.0, self._paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """No conceder tokens durante `seconds` segundos"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        if retry_after:
+            self.pause(retry_after)
+        logger.warning(f"Overpass limita el ritmo (429): {self.rate:.2f} consultas/s"
+                       f"{f', pausa de {retry_after:.1f}s' if retry_after else ''}")
+
+    def on_success(self) -> None:
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de tres estados.
+
+    Tras `threshold` fallos seguidos se abre y rechaza las consultas durante
+    `reset_timeout` segundos; después deja pasar una sola consulta de prueba
+    (semiabierto) que lo cierra si va bien o lo vuelve a abrir si falla.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Indica si se puede hacer una consulta; en semiabierto, solo la de prueba"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def retry_after(self) -> float:
+        """Segundos hasta que el circuito abierto deje pasar una consulta de prueba"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuito de Overpass cerrado: las consultas vuelven a funcionar")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                logger.error(f"Circuito de Overpass abierto tras {self.failures} fallos seguidos: "
+                             f"se rechazan las consultas durante {self.reset_timeout:.0f}s")
+
+    def release_probe(self) -> None:
+        """La consulta terminó sin éxito ni fallo del servidor (p. ej. cancelada)"""
+        with self._lock:
+            self._probing = False
+
+
+class UpstreamScheduler:
+    """Planificador de consultas a Overpass: cola por prioridad, ritmo y circuit breaker"""
+
+    def __init__(self, max_concurrent: int, rate: float, burst: int, min_rate: float,
+                 breaker_threshold: int, breaker_reset: float, queue_timeout: float, status_url: str):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.status_url = status_url
+        self.semaphore = PrioritySemaphore(max_concurrent)
+        self.bucket = AdaptiveTokenBucket(rate, burst, min_rate)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.status: Optional[OverpassStatus] = None
+        self._status_checked = 0.0
+        self._status_lock = threading.Lock()
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.INTERACTIVE) -> AsyncIterator[None]:
+        """
+        Reserva un hueco para una consulta y registra su resultado.
+
+        Lanza OverpassError de inmediato si el circuito está abierto, o si la
+        consulta tendría que esperar más de OVERPASS_QUEUE_TIMEOUT segundos en
+        cola o por el ritmo. Dentro del bloque solo se cuentan como fallo los
+        OverpassError reintentables.
+        """
+        if not self.breaker.allow():
+            raise OverpassError("Overpass API no disponible temporalmente (circuito abierto)",
+                                kind='circuit_open', retry_after=self.breaker.retry_after())
+        try:
+            acquired = await self.semaphore.acquire(priority, self.queue_timeout)
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        if not acquired:
+            self.breaker.release_probe()
+            raise OverpassError("Demasiadas consultas pendientes a Overpass API", kind='queue_timeout')
+
+        try:
+            if not await self.bucket.acquire(self.queue_timeout):
+                raise OverpassError("Demasiadas consultas pendientes a Overpass API", kind='queue_timeout',
+                                    retry_after=self.bucket.wait_time())
+            yield
+        except OverpassError as e:
+            if e.retryable:
+                self.breaker.record_failure()
+            else:
+                self.breaker.release_probe()
+            if e.rate_limited:
+                self.bucket.on_rate_limited(e.retry_after)
+            raise
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        else:
+            self.breaker.record_success()
+            self.bucket.on_success()
+        finally:
+            self.semaphore.release()
+
+    def has_spare_capacity(self) -> bool:
+        """Indica si una consulta nueva empezaría ya: circuito cerrado, huecos libres sin cola y token disponible"""
+        semaphore = self.semaphore.stats()
+        return (
+            self.breaker.retry_after() == 0
+            and semaphore["waiting"] == 0
+            and semaphore["in_use"] < semaphore["capacity"]
+            and self.bucket.wait_time() == 0
+        )
+
+    async def refresh_status(self) -> Optional[OverpassStatus]:
+        """
+        Consulta /api/status y ajusta la concurrencia al límite de huecos de
+        nuestra IP. Si no hay huecos libres, pausa las consultas hasta el
+        próximo. Como mucho una vez cada STATUS_MIN_INTERVAL segundos.
+        """
+        with self._status_lock:
+            now = time.monotonic()
+            if now - self._status_checked < STATUS_MIN_INTERVAL:
+                return self.status
+            self._status_checked = now
+        try:
+            response = await client_manager.get(self.status_url, timeout=5.0)
+            response.raise_for_status()
+            status = parse_status(response.text)
+        except Exception as e:
+            logger.warning(f"No se pudo consultar el estado de Overpass ({self.status_url}): {str(e)}")
+            return self.status
+
+        self.status = status
+        if status.rate_limit:
+            self.semaphore.set_capacity(min(self.max_concurrent, status.rate_limit))
+        if status.slots_available == 0 and status.next_slot_in:
+            self.bucket.pause(status.next_slot_in)
+        logger.info(f"Estado de Overpass: límite {status.rate_limit}, huecos libres {status.slots_available}"
+                    f"{f', próximo en {status.next_slot_in:.0f}s' if status.next_slot_in is not None else ''}")
+        return status
+
+    def stats(self) -> dict:
+        return {
+            **self.semaphore.stats(),
+            "rate": round(self.bucket.rate, 3),
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+        }
+
+
+class Endpoint:
+    """
+    Un servidor Overpass con su propio planificador (los límites de ritmo y
+    de huecos son por servidor) y estadísticas de latencia y errores
+    """
+
+    def __init__(self, url: str, scheduler: UpstreamScheduler):
+        self.url = url
+        self.scheduler = scheduler
+        self.latency_ewma: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0      # consultas lanzadas como cobertura de otro servidor más lento
+        self.hedge_wins = 0  # coberturas que respondieron antes que la consulta original
+        self._error_ewma = 0.0
+        self._error_updated = time.monotonic()
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def _decayed_errors(self, now: float) -> float:
+        """Tasa de errores, que se reduce a la mitad cada ERROR_HALF_LIFE segundos sin consultas"""
+        return self._error_ewma * 0.5 ** ((now - self._error_updated) / ERROR_HALF_LIFE)
+
+    def _record(self, error: float) -> None:
+        now = time.monotonic()
+        self._error_ewma = self._decayed_errors(now) * (1 - EWMA_ALPHA) + error * EWMA_ALPHA
+        self._error_updated = now
+        self.requests += 1
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._record(0.0)
+            self._latencies.append(latency)
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma = self.latency_ewma * (1 - EWMA_ALPHA) + latency * EWMA_ALPHA
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._record(1.0)
+            self.failures += 1
+
+    def record_hedge(self, won: bool = False) -> None:
+        """Anota una consulta de cobertura lanzada a este servidor, o que respondió antes que la original"""
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedges += 1
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            return self._decayed_errors(time.monotonic())
+
+    def score(self) -> float:
+        """
+        Coste estimado de una consulta, menor es mejor: latencia media más una
+        penalización por la tasa de errores reciente. Un servidor sin datos
+        tiene coste 0, así que se prueba antes que los demás.
+        """
+        return (self.latency_ewma or 0.0) + ERROR_PENALTY * self.error_rate
+
+    def available(self) -> bool:
+        """False mientras su circuito está abierto"""
+        return self.scheduler.breaker.retry_after() == 0
+
+    def latency_percentile(self, pct: float) -> Optional[float]:
+        """Percentil de las últimas latencias, o None si aún hay pocas muestras"""
+        with self._lock:
+            values = sorted(self._latencies)
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+    def stats(self) -> dict:
+        p90 = self.latency_percentile(90)
+        return {
+            "url": self.url,
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate, 3),
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "latency_p90": round(p90, 3) if p90 is not None else None,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            **self.scheduler.stats(),
+        }
+
+
+class EndpointPool:
+    """Servidores Overpass configurados, eligiendo en cada consulta el más sano"""
+
+    def __init__(self, endpoints: List[Endpoint], hedge: bool = False, hedge_min_delay: float = 0.5):
+        self.endpoints = endpoints
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self._by_url = {endpoint.url: endpoint for endpoint in endpoints}
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def get(self, url: str) -> Optional[Endpoint]:
+        return self._by_url.get(url)
+
+    def choose(self, avoid: Iterable[str] = ()) -> Endpoint:
+        """
+        Servidor con menor coste, descartando los de `avoid` y los que tienen
+        el circuito abierto mientras quede alguno
+        """
+        avoid = set(avoid)
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in avoid] or self.endpoints
+        available = [endpoint for endpoint in candidates if endpoint.available()] or candidates
+        return min(available, key=Endpoint.score)
+
+    def has_spare_capacity(self) -> bool:
+        """Indica si algún servidor atendería ya una consulta (ver UpstreamScheduler.has_spare_capacity)"""
+        return any(endpoint.scheduler.has_spare_capacity() for endpoint in self.endpoints)
+
+    def hedge_delay(self, endpoint: Endpoint) -> Optional[float]:
+        """
+        Espera antes de lanzar una consulta de cobertura a otro servidor: el
+        p90 de latencia del servidor elegido (mínimo OVERPASS_HEDGE_MIN_DELAY).
+        None si no hay cobertura (desactivada, un solo servidor o pocas muestras).
+        """
+        if not self.hedge or len(self.endpoints) < 2:
+            return None
+        p90 = endpoint.latency_percentile(90)
+        if p90 is None:
+            return None
+        return max(self.hedge_min_delay, p90)
+
+    def stats(self) -> dict:
+        return {
+            "hedge": self.hedge,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
+
+
+def status_url_for(url: str) -> str:
+    """URL de /api/status de un servidor a partir de la de /api/interpreter"""
+    return url.rsplit('/', 1)[0] + '/status'
+
+
+def build_endpoint_pool(urls: List[str], hedge: bool) -> EndpointPool:
+    """Pool de servidores con un planificador por servidor configurado desde settings"""
+    endpoints = [
+        Endpoint(url, UpstreamScheduler(
+            max_concurrent=settings.OVERPASS_MAX_CONCURRENT,
+            rate=settings.OVERPASS_RATE,
+            burst=settings.OVERPASS_BURST,
+            min_rate=settings.OVERPASS_MIN_RATE,
+            breaker_threshold=settings.OVERPASS_BREAKER_THRESHOLD,
+            breaker_reset=settings.OVERPASS_BREAKER_RESET,
+            queue_timeout=settings.OVERPASS_QUEUE_TIMEOUT,
+            status_url=status_url_for(url),
+        ))
+        for url in urls
+    ]
+    return EndpointPool(endpoints, hedge=hedge, hedge_min_delay=settings.OVERPASS_HEDGE_MIN_DELAY)
+
+
+_endpoint_pool: Optional[EndpointPool] = None
+_endpoint_pool_lock = threading.Lock()
+
+
+def get_endpoint_pool() -> EndpointPool:
+    """Pool de servidores Overpass del proceso (OVERPASS_URLS)"""
+    global _endpoint_pool
+    if _endpoint_pool is None:
+        with _endpoint_pool_lock:
+            if _endpoint_pool is None:
+                _endpoint_pool = build_endpoint_pool(settings.OVERPASS_URLS, settings.OVERPASS_HEDGE)
+    return _endpoint_pool
+
+
+def set_endpoint_pool(pool: Optional[EndpointPool]) -> None:
+    """Sustituye el pool del proceso (benchmarks); None lo vuelve a crear desde settings"""
+    global _endpoint_pool
+    with _endpoint_pool_lock:
+        _endpoint_pool = pool
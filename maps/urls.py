@@ -10,7 +10,14 @@ urlpatterns = [
     path('', views.welcome, name='welcome'),
     path('mapa/', views.mapa, name='mapa'),
     path('api/trees/', views.get_trees, name='api_trees'),
+    path('api/trees/clusters/', views.get_tree_clusters, name='api_tree_clusters'),
     path('api/stumps/', views.get_stumps, name='api_stumps'),
+    path('api/features/', views.get_features, name='api_features'),
+    path('api/stats/', views.get_stats, name='api_stats'),
+    path('api/prefetch/', views.prefetch, name='api_prefetch'),
+    path('api/overpass/status/', views.get_overpass_status, name='api_overpass_status'),
+    path('metrics', views.metrics, name='metrics'),
+    path('tiles/<str:layer>/<int:z>/<int:x>/<int:y>.mvt', views.get_vector_tile, name='vector_tile'),
     path('robots.txt', views.robots_txt, name='robots_txt'),
 ]
 
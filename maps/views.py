@@ -2,27 +2,42 @@
 Vistas de la aplicación maps
 """
 import logging
+import math
 import time
 import asyncio
+import functools
 from datetime import datetime
 from typing import Optional, List
-from django.http import JsonResponse, HttpRequest, HttpResponse
+from django.http import Http404, JsonResponse, HttpRequest, HttpResponse
 from django.shortcuts import render
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from django.contrib.staticfiles import finders
 import os
-import httpx
 from pydantic import BaseModel
 
+from .clustering import cell_size, cluster_points, elements_to_arrays
+from .datasources import LAYER_FILTERS, get_data_source
+from .filters import FeatureFilter
+from .formats import FORMATS, layers_response, ndjson_response, set_data_age
+from .http_cache import conditional_api, content_etag, etag_matches, not_modified
+from .metrics import log_event, render_metrics, stage
+from .mvt import render_tile
+from .parsing import data_time, parse_stumps, parse_trees
+from .stats import StatsAreaTooLarge, bbox_stats
+from .tiles import count_tiles_for_bbox, lat_lon_to_tile, parse_tile_list, tiles_bbox
+from .upstream import OverpassError, get_endpoint_pool
+
 # Configurar logging
 logger = logging.getLogger(__name__)
 
-# Configuración de la API de Overpass
-OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+# Copia local de Leaflet.VectorGrid (ver `make vendor-js`)
+VECTORGRID_STATIC = 'vendor/Leaflet.VectorGrid.bundled.js'
 
 
-# Modelos Pydantic (mantenidos de FastAPI)
+# Modelos Pydantic (mantenidos de FastAPI). Son el esquema de la API; la
+# conversión de elementos se hace por lotes en parsing.py
 class Tree(BaseModel):
     id: str
     lat: float
@@ -55,104 +70,29 @@ class Stump(BaseModel):
         }
 
 
-# Funciones auxiliares
-async def query_overpass(query: str) -> dict:
-    """Realiza una consulta a la API de Overpass en una sola petición (sin reintentos)."""
-    start_time = time.time()
-    logger.info(f"Iniciando consulta a Overpass API. Query length: {len(query)} chars")
-    logger.debug(f"Query Overpass: {query[:200]}...")  # Log solo los primeros 200 chars
-
-    timeout = httpx.Timeout(60.0, connect=10.0, read=60.0, write=10.0)
+def parse_filters(request: HttpRequest):
+    """
+    Filtros species, health, min_height y max_height de la petición.
 
+    Devuelve (filtro o None, None) o (None, respuesta 400) si no son válidos.
+    """
     try:
-        request_start = time.time()
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            logger.debug(f"Enviando POST a {OVERPASS_URL} con timeout: {timeout}")
-            response = await client.post(OVERPASS_URL, data=query, headers={
-                'User-Agent': 'Mapa-Arboles-Tocones/1.0'
-            })
-
-        response_time = time.time() - request_start
-        logger.info(f"Respuesta recibida en {response_time:.2f}s. Status: {response.status_code}")
+        return FeatureFilter.from_query(request.GET), None
+    except ValueError as e:
+        return None, JsonResponse({'error': f'Filtro inválido: {str(e)}'}, status=400)
 
-        response.raise_for_status()
-        result = response.json()
 
-        total_time = time.time() - start_time
-        elements_count = len(result.get("elements", []))
-        logger.info(f"Consulta exitosa. Elementos encontrados: {elements_count}. Tiempo total: {total_time:.2f}s")
-
-        return result
-
-    except httpx.TimeoutException as e:
-        total_time = time.time() - start_time
-        logger.error(f"TIMEOUT consultando Overpass API en {total_time:.2f}s: {str(e)}")
-        raise Exception(f"Timeout al consultar Overpass API")
-    except httpx.HTTPStatusError as e:
-        total_time = time.time() - start_time
-        status_code = e.response.status_code
-        logger.error(f"Error HTTP {status_code} consultando Overpass API en {total_time:.2f}s. Response: {e.response.text[:200]}")
-        if status_code == 504:
-            raise Exception(f"Gateway Timeout desde Overpass API")
-        raise Exception(f"Error HTTP {status_code} al consultar Overpass API")
-    except httpx.RequestError as e:
-        total_time = time.time() - start_time
-        logger.error(f"Error de conexión consultando Overpass API en {total_time:.2f}s: {str(e)}")
-        raise Exception(f"Error de conexión con Overpass API: {str(e)}")
-    except Exception as e:
-        total_time = time.time() - start_time
-        logger.error(f"Error inesperado consultando Overpass API en {total_time:.2f}s: {str(e)}")
-        raise Exception(f"Error inesperado al consultar Overpass API: {str(e)}")
-
-
-def parse_tree_element(element: dict) -> Tree:
-    """Convierte un elemento de OSM en un objeto Tree"""
-    tags = element.get("tags", {})
-    return Tree(
-        id=f"tree_{element['id']}",
-        lat=element["lat"],
-        lon=element["lon"],
-        species=tags.get("species"),
-        height=float(tags["height"]) if tags.get("height") else None,
-        diameter=float(tags["diameter"]) if tags.get("diameter") else None,
-        age=int(tags["age"]) if tags.get("age") and type(tags["age"]) == int else None,
-        health=tags.get("health"),
-        last_updated=datetime.now()
-    )
-
-
-def parse_stump_element(element: dict) -> Stump:
-    """Convierte un elemento de OSM en un objeto Stump"""
-    tags = element.get("tags", {})
-    return Stump(
-        id=f"stump_{element['id']}",
-        lat=element["lat"],
-        lon=element["lon"],
-        species=tags.get("species"),
-        diameter=float(tags["diameter"]) if tags.get("diameter") else None,
-        removal_date=datetime.now(),  # OSM no suele tener esta info
-        reason=tags.get("removal_reason")
-    )
-
-
-async def query_overpass_with_retry(query: str, max_retries: int = 2, initial_delay: float = 1.5, backoff_factor: float = 2.0) -> dict:
-    """Ejecuta la consulta a Overpass con reintentos en caso de timeout."""
-    attempt = 0
-    delay = initial_delay
-    while True:
-        try:
-            return await query_overpass(query)
-        except Exception as exc:
-            error_msg = str(exc)
-            if "504" in error_msg or "Timeout" in error_msg:
-                if attempt < max_retries:
-                    attempt += 1
-                    logger.warning(f"Intento {attempt}/{max_retries} tras timeout de Overpass. Reintentando en {delay:.1f}s")
-                    await asyncio.sleep(delay)
-                    delay *= backoff_factor
-                    continue
-            # No es timeout o se agotaron los reintentos
-            raise
+def error_response(e: Exception) -> JsonResponse:
+    """
+    Respuesta de las vistas API cuando falla la consulta de datos: 503 con
+    Retry-After si Overpass no acepta consultas ahora mismo, 500 en otro caso
+    """
+    if isinstance(e, OverpassError) and e.unavailable:
+        response = JsonResponse({'error': 'Overpass API no disponible temporalmente, inténtalo más tarde.'}, status=503)
+        if e.retry_after:
+            response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+    return JsonResponse({'error': 'Error interno del servidor.'}, status=500)
 
 
 # Vistas de páginas
@@ -161,26 +101,66 @@ def welcome(request: HttpRequest):
     return render(request, 'welcome.html')
 
 
-def mapa(request: HttpRequest):
-    """Página del mapa interactivo"""
-    return render(request, 'mapa.html')
+@functools.lru_cache(maxsize=1)
+def vectorgrid_vendored() -> bool:
+    """Si Leaflet.VectorGrid está copiado en static/ (make vendor-js) en lugar de cargarlo de unpkg"""
+    return finders.find(VECTORGRID_STATIC) is not None
 
 
-def robots_txt(request: HttpRequest):
-    """Servir robots.txt"""
+def mapa(request: HttpRequest):
+    """Página del mapa interactivo"""
+    return render(request, 'mapa.html', {
+        'map_config': {
+            'tileZoom': settings.TILE_CACHE_ZOOM,
+            'maxTilesPerRequest': settings.TILE_CACHE_MAX_TILES,
+        },
+        'vectorgrid_static': VECTORGRID_STATIC if vectorgrid_vendored() else None,
+    })
+
+
+@functools.lru_cache(maxsize=1)
+def robots_content() -> tuple:
+    """Contenido de robots.txt y su ETag, leídos una sola vez por proceso"""
     robots_path = os.path.join(settings.BASE_DIR, 'static', 'robots.txt')
     try:
-        with open(robots_path, 'r') as f:
+        with open(robots_path, 'rb') as f:
             content = f.read()
-        return HttpResponse(content, content_type='text/plain')
     except FileNotFoundError:
         # Si no existe, devolver un robots.txt básico
-        return HttpResponse('User-agent: *\nDisallow:', content_type='text/plain')
+        content = b'User-agent: *\nDisallow:'
+    return content, content_etag(content)
+
+
+def robots_txt(request: HttpRequest):
+    """Servir robots.txt desde memoria"""
+    content, etag = robots_content()
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={settings.STATIC_MAX_AGE}'}
+    if etag_matches(request, etag):
+        return not_modified(headers)
+    return HttpResponse(content, content_type='text/plain', headers=headers)
+
+
+def area_limit(limit: int, area: float) -> int:
+    """
+    Reduce el límite en áreas grandes (grados²), salvo con el planificador
+    (ver planner.py) si el área cabe en PLANNER_MAX_CELLS celdas de
+    PLANNER_MAX_CELL_AREA: entonces se consulta como varias celdas en paralelo
+    en lugar de con una sola consulta lenta a Overpass. Por encima, las celdas
+    serían más grandes de lo previsto y se aplica el mismo límite que sin él
+    """
+    if settings.PLANNER_ENABLED and area <= settings.PLANNER_MAX_CELLS * settings.PLANNER_MAX_CELL_AREA:
+        return limit
+    if area > 0.01:
+        return min(limit, 200)
+    if area > 0.005:
+        return min(limit, 500)
+    return limit
 
 
 # Vistas API
 @csrf_exempt
 @require_http_methods(["GET"])
+@conditional_api(['trees'])
 async def get_trees(request: HttpRequest):
     """
     Obtiene árboles de OSM en un área específica
@@ -189,19 +169,25 @@ async def get_trees(request: HttpRequest):
         bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon"
         limit: Número máximo de resultados (máximo 1000)
         timeout: Timeout para la consulta Overpass
+        format: Formato de salida: json (default), columnar, bin o ndjson (streaming)
+        species, health, min_height, max_height: Filtros opcionales (ver filters.py)
     """
     start_time = time.time()
-    logger.info(f"Starting endpoint /api/trees")
     
     bbox = request.GET.get('bbox')
     limit = int(request.GET.get('limit', 500))
     timeout = int(request.GET.get('timeout', 6000))
-    
-    logger.info(f"Parámetros recibidos - bbox: {bbox}, limit: {limit}, timeout: {timeout}")
+
+    fmt = request.GET.get('format', 'json')
+    if fmt not in FORMATS:
+        return JsonResponse({'error': f'Formato desconocido: {fmt}. Opciones: {", ".join(FORMATS)}'}, status=400)
+    filters, invalid = parse_filters(request)
+    if invalid:
+        return invalid
     
     if not bbox:
         logger.warning("No se proporcionó bbox, devolviendo lista vacía")
-        return JsonResponse([], safe=False)
+        return layers_response({'trees': []}, fmt, single=True)
     
     try:
         if not timeout:
@@ -209,8 +195,6 @@ async def get_trees(request: HttpRequest):
             timeout = 6000
             
         min_lat, min_lon, max_lat, max_lon = map(float, bbox.split(","))
-        bbox_str = bbox
-        logger.info(f"Bbox parseado - min_lat: {min_lat}, min_lon: {min_lon}, max_lat: {max_lat}, max_lon: {max_lon}")
         
         # Limitar el límite para evitar consultas demasiado grandes
         original_limit = limit
@@ -220,67 +204,35 @@ async def get_trees(request: HttpRequest):
         
         # Calcular área del bbox para ajustar límite dinámicamente
         area = abs(max_lat - min_lat) * abs(max_lon - min_lon)
-        logger.info(f"Área del bbox: {area:.6f}")
-        
-        if area > 0.01:  # Área muy grande
-            limit = min(limit, 200)
-            logger.warning(f"Área muy grande detectada, limitando a {limit} elementos")
-        elif area > 0.005:  # Área grande
-            limit = min(limit, 500)
-            logger.info(f"Área grande detectada, limitando a {limit} elementos")
-    
-        # Query Overpass para árboles (optimizada)
-        query = f"""
-        [out:json][timeout:{timeout}];
-        (
-          node["natural"="tree"]({min_lat},{min_lon},{max_lat},{max_lon});
-        );
-        out center {limit};
-        """
-        logger.info("Query para obtener árboles sin filtro de especie")
-        
-        logger.info(f"Ejecutando consulta Overpass con timeout: {timeout}s")
-        query_start = time.time()
-        
+        limit = area_limit(limit, area)
+
+        if fmt == 'ndjson':
+            return ndjson_response(get_data_source(), ['trees'], (min_lat, min_lon, max_lat, max_lon), limit, timeout,
+                                   filters)
+
         try:
-            result = await query_overpass_with_retry(query)
-            query_time = time.time() - query_start
-            logger.info(f"Consulta Overpass completada en {query_time:.2f}s")
-            
-            trees = []
-            elements = result.get("elements", [])
-            logger.info(f"Elementos raw recibidos de Overpass: {len(elements)}")
+            elements_by_layer = await get_data_source().fetch(
+                ['trees'], (min_lat, min_lon, max_lat, max_lon), limit, timeout, filters
+            )
+            elements = elements_by_layer['trees']
 
             if not elements:
-                logger.warning("No se encontraron elementos en la respuesta de Overpass")
-                return JsonResponse([], safe=False)
+                logger.warning("No se encontraron elementos en la respuesta")
+                return layers_response({'trees': []}, fmt, single=True, fetched_at=elements_by_layer.fetched_at,
+                                       partial=elements_by_layer.partial)
             
             # Procesar elementos
-            processed_count = 0
-            error_count = 0
-            
-            for element in elements[:limit]:
-                if element.get("type") == "node":
-                    try:
-                        tree = parse_tree_element(element)
-                        trees.append(tree.model_dump())
-                        processed_count += 1
-                    except Exception as e:
-                        error_count += 1
-                        logger.error(f"Error parsing tree element {element.get('id', 'unknown')}: {e}")
-                        continue
+            with stage('parse'):
+                trees = parse_trees(elements, limit, data_time(elements_by_layer.fetched_at))
             
-            total_time = time.time() - start_time
-            logger.info("Finished endpoint /api/trees")
-            logger.info(f"Árboles procesados: {processed_count}, Errores: {error_count}, Tiempo total: {total_time:.2f}s")
-            
-            return JsonResponse(trees, safe=False)
+            return layers_response({'trees': trees}, fmt, single=True, fetched_at=elements_by_layer.fetched_at,
+                                   partial=elements_by_layer.partial)
             
         except Exception as e:
             total_time = time.time() - start_time
             logger.error("Error happened in /api/trees")
             logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
-            return JsonResponse({'error': 'Error interno del servidor.'}, status=500)
+            return error_response(e)
     
     except Exception as e:
         total_time = time.time() - start_time
@@ -291,6 +243,7 @@ async def get_trees(request: HttpRequest):
 
 @csrf_exempt
 @require_http_methods(["GET"])
+@conditional_api(['stumps'])
 async def get_stumps(request: HttpRequest):
     """
     Obtiene tocones de OSM en un área específica
@@ -299,24 +252,28 @@ async def get_stumps(request: HttpRequest):
         bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon" (required)
         limit: Número máximo de resultados (default: 500, máximo 1000)
         timeout: Timeout para la consulta Overpass
+        format: Formato de salida: json (default), columnar, bin o ndjson (streaming)
+        species, health, min_height, max_height: Filtros opcionales (ver filters.py)
     """
     start_time = time.time()
-    logger.info("Starting endpoint /api/stumps")
     
     bbox = request.GET.get('bbox')
     limit = int(request.GET.get('limit', 500))
     timeout = int(request.GET.get('timeout', 6000))
-    
-    logger.info(f"Parámetros recibidos - bbox: {bbox}, limit: {limit}, timeout: {timeout}")
+
+    fmt = request.GET.get('format', 'json')
+    if fmt not in FORMATS:
+        return JsonResponse({'error': f'Formato desconocido: {fmt}. Opciones: {", ".join(FORMATS)}'}, status=400)
+    filters, invalid = parse_filters(request)
+    if invalid:
+        return invalid
     
     if not bbox:
         logger.warning("No se proporcionó bbox, devolviendo lista vacía")
-        return JsonResponse([], safe=False)
+        return layers_response({'stumps': []}, fmt, single=True)
 
     try:
         min_lat, min_lon, max_lat, max_lon = map(float, bbox.split(","))
-        bbox_str = bbox
-        logger.info(f"Bbox parseado - min_lat: {min_lat}, min_lon: {min_lon}, max_lat: {max_lat}, max_lon: {max_lon}")
         
         if not timeout:
             logger.warning("Timeout not provided, using default value of 6000 seconds")
@@ -330,77 +287,335 @@ async def get_stumps(request: HttpRequest):
         
         # Calcular área del bbox para ajustar límite dinámicamente
         area = abs(max_lat - min_lat) * abs(max_lon - min_lon)
-        logger.info(f"Área del bbox: {area:.6f}")
-        
-        if area > 0.01:  # Área muy grande
-            limit = min(limit, 200)
-            logger.warning(f"Área muy grande detectada, limitando a {limit} elementos")
-        elif area > 0.005:  # Área grande
-            limit = min(limit, 500)
-            logger.info(f"Área grande detectada, limitando a {limit} elementos")
-
-        logger.debug(f"Getting stumps for bbox: {bbox_str}")
-        logger.debug(f"Getting stumps for limit: {limit}")
-    
-        # Query Overpass para tocones (optimizada)
-        query = f"""
-        [out:json][timeout:{timeout}];
-        (
-          node["natural"="tree_stump"]({min_lat},{min_lon},{max_lat},{max_lon});
-        );
-        out {limit};
-        """
-        logger.info("Query para obtener tocones sin filtro de especie")
-        
-        logger.info(f"Ejecutando consulta Overpass con timeout: {timeout}s")
-        query_start = time.time()
-        
+        limit = area_limit(limit, area)
+
+        if fmt == 'ndjson':
+            return ndjson_response(get_data_source(), ['stumps'], (min_lat, min_lon, max_lat, max_lon), limit, timeout,
+                                   filters)
+
         try:
-            result = await query_overpass_with_retry(query)
-            query_time = time.time() - query_start
-            logger.info(f"Consulta Overpass completada en {query_time:.2f}s")
-            
-            stumps = []
-            elements = result.get("elements", [])
-            logger.info(f"Elementos raw recibidos de Overpass: {len(elements)}")
-            
+            elements_by_layer = await get_data_source().fetch(
+                ['stumps'], (min_lat, min_lon, max_lat, max_lon), limit, timeout, filters
+            )
+            elements = elements_by_layer['stumps']
+
             if not elements:
-                logger.warning("No se encontraron elementos en la respuesta de Overpass")
-                return JsonResponse([], safe=False)
+                logger.warning("No se encontraron elementos en la respuesta")
+                return layers_response({'stumps': []}, fmt, single=True, fetched_at=elements_by_layer.fetched_at,
+                                       partial=elements_by_layer.partial)
             
             # Procesar elementos
-            processed_count = 0
-            error_count = 0
+            with stage('parse'):
+                stumps = parse_stumps(elements, limit, data_time(elements_by_layer.fetched_at))
             
-            for element in elements[:limit]:
-                if element.get("type") == "node":
-                    try:
-                        stump = parse_stump_element(element)
-                        stumps.append(stump.model_dump())
-                        processed_count += 1
-                    except Exception as e:
-                        error_count += 1
-                        logger.error(f"Error parsing stump element {element.get('id', 'unknown')}: {e}")
-                        continue
-            
-            total_time = time.time() - start_time
-            logger.info("Finished endpoint /api/stumps")
-            logger.info(f"Tocones procesados: {processed_count}, Errores: {error_count}, Tiempo total: {total_time:.2f}s")
-            
-            return JsonResponse(stumps, safe=False)
+            return layers_response({'stumps': stumps}, fmt, single=True, fetched_at=elements_by_layer.fetched_at,
+                                   partial=elements_by_layer.partial)
             
         except Exception as e:
             total_time = time.time() - start_time
             logger.error("Error happened in /api/stumps")
             logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
-            # Devolver lista vacía en lugar de fallar
-            logger.warning("Devolviendo lista vacía debido a error")
-            return JsonResponse([], safe=False)
+            return error_response(e)
     
     except Exception as e:
         total_time = time.time() - start_time
         logger.error("Error happened in parsing bbox in /api/stumps")
         logger.error(f"Error parsing bbox: {str(e)}. Tiempo total: {total_time:.2f}s")
-        # Devolver lista vacía en lugar de fallar
-        logger.warning("Devolviendo lista vacía debido a error de parsing")
-        return JsonResponse([], safe=False)
+        return JsonResponse({'error': f'Error en formato de bbox: {str(e)}'}, status=400)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@conditional_api(['trees', 'stumps'])
+async def get_features(request: HttpRequest):
+    """
+    Obtiene árboles y tocones de OSM en un área específica con una sola consulta
+
+    Args:
+        bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon" (required)
+        limit: Número máximo de resultados por capa (default: 500, máximo 1000)
+        timeout: Timeout para la consulta Overpass
+        format: Formato de salida: json (default), columnar, bin o ndjson (streaming)
+        species, health, min_height, max_height: Filtros opcionales (ver filters.py)
+
+        tiles: En lugar de bbox, teselas "z/x/y,z/x/y,..." (ver get_features_by_tiles)
+
+    Returns:
+        {"trees": [...], "stumps": [...]}
+    """
+    start_time = time.time()
+
+    fmt = request.GET.get('format', 'json')
+    if fmt not in FORMATS:
+        return JsonResponse({'error': f'Formato desconocido: {fmt}. Opciones: {", ".join(FORMATS)}'}, status=400)
+    filters, invalid = parse_filters(request)
+    if invalid:
+        return invalid
+
+    if request.GET.get('tiles'):
+        return await get_features_by_tiles(request, start_time, filters)
+
+    bbox = request.GET.get('bbox')
+    if not bbox:
+        logger.warning("No se proporcionó bbox, devolviendo listas vacías")
+        return layers_response({'trees': [], 'stumps': []}, fmt)
+
+    try:
+        limit = int(request.GET.get('limit', 500))
+        timeout = int(request.GET.get('timeout', 6000)) or 6000
+        min_lat, min_lon, max_lat, max_lon = map(float, bbox.split(","))
+    except Exception as e:
+        logger.error(f"Error parsing params in /api/features: {str(e)}")
+        return JsonResponse({'error': f'Error en formato de bbox: {str(e)}'}, status=400)
+
+    # Mismos límites que /api/trees y /api/stumps
+    limit = min(limit, 1000)
+    area = abs(max_lat - min_lat) * abs(max_lon - min_lon)
+    limit = area_limit(limit, area)
+    log_event(logger, logging.DEBUG, "features", bbox=bbox, limit=limit, area=area, filters=filters or '-')
+
+    if fmt == 'ndjson':
+        return ndjson_response(get_data_source(), ['trees', 'stumps'], (min_lat, min_lon, max_lat, max_lon), limit, timeout,
+                               filters)
+
+    try:
+        elements_by_layer = await get_data_source().fetch(
+            ['trees', 'stumps'], (min_lat, min_lon, max_lat, max_lon), limit, timeout, filters
+        )
+    except Exception as e:
+        total_time = time.time() - start_time
+        logger.error("Error happened in /api/features")
+        logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
+        return error_response(e)
+
+    with stage('parse'):
+        now = data_time(elements_by_layer.fetched_at)
+        trees = parse_trees(elements_by_layer['trees'], limit, now)
+        stumps = parse_stumps(elements_by_layer['stumps'], limit, now)
+    return layers_response({'trees': trees, 'stumps': stumps}, fmt, fetched_at=elements_by_layer.fetched_at,
+                           partial=elements_by_layer.partial)
+
+
+async def get_features_by_tiles(request: HttpRequest, start_time: float,
+                                 filters: Optional[FeatureFilter] = None) -> HttpResponse:
+    """
+    /api/features con el parámetro tiles: elementos agrupados por tesela
+
+    El mapa pide solo las teselas que no tiene cargadas y guarda cada una por
+    separado. `limit` se aplica a cada capa de cada tesela, después de los
+    filtros, y la respuesta es siempre JSON:
+
+        {"zoom": 15, "tiles": {"15/x/y": {"trees": [...], "stumps": [...]}, ...}}
+    """
+    try:
+        tiles = parse_tile_list(request.GET['tiles'])
+        limit = min(int(request.GET.get('limit', 500)), 1000)
+        timeout = int(request.GET.get('timeout', 6000)) or 6000
+    except Exception as e:
+        logger.error(f"Error parsing params in /api/features: {str(e)}")
+        return JsonResponse({'error': f'Error en formato de tiles: {str(e)}'}, status=400)
+
+    bbox = tiles_bbox(tiles)
+    if len(tiles) > settings.TILE_CACHE_MAX_TILES or \
+            count_tiles_for_bbox(*bbox, settings.TILE_CACHE_ZOOM) > settings.TILE_CACHE_MAX_TILES:
+        return JsonResponse({'error': f'Demasiadas teselas (máximo {settings.TILE_CACHE_MAX_TILES} '
+                                      f'de zoom {settings.TILE_CACHE_ZOOM})'}, status=400)
+
+    try:
+        elements_by_layer = await get_data_source().fetch(['trees', 'stumps'], bbox, None, timeout, filters)
+    except Exception as e:
+        total_time = time.time() - start_time
+        logger.error("Error happened in /api/features")
+        logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
+        return error_response(e)
+
+    with stage('parse'):
+        # Repartir los elementos entre las teselas pedidas
+        zoom = tiles[0][0]
+        by_tile = {(x, y): {'trees': [], 'stumps': []} for _, x, y in tiles}
+        for layer, elements in elements_by_layer.items():
+            for element in elements:
+                tile_layers = by_tile.get(lat_lon_to_tile(element["lat"], element["lon"], zoom))
+                if tile_layers is not None:
+                    tile_layers[layer].append(element)
+
+        now = data_time(elements_by_layer.fetched_at)
+        data = {
+            f"{zoom}/{x}/{y}": {
+                'trees': parse_trees(tile_layers['trees'], limit, now),
+                'stumps': parse_stumps(tile_layers['stumps'], limit, now),
+            }
+            for (x, y), tile_layers in by_tile.items()
+        }
+
+    with stage('serialize'):
+        response = JsonResponse({'zoom': zoom, 'tiles': data})
+    return set_data_age(response, elements_by_layer.fetched_at)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@conditional_api(['trees'])
+async def get_tree_clusters(request: HttpRequest):
+    """
+    Agrupa los árboles de un área en celdas, para niveles de zoom bajos
+
+    Args:
+        bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon" (required)
+        zoom: Nivel de zoom del mapa, que determina el tamaño de celda (required)
+        timeout: Timeout para la consulta Overpass
+        species, health, min_height, max_height: Filtros opcionales (ver filters.py)
+
+    Returns:
+        {"zoom": int, "cell_size": [lat, lon], "total": int, "truncated": bool,
+         "clusters": [{"lat", "lon", "count", "bbox"}, ...]}
+    """
+    start_time = time.time()
+
+    try:
+        min_lat, min_lon, max_lat, max_lon = map(float, request.GET['bbox'].split(","))
+        zoom = min(max(int(request.GET['zoom']), 0), 22)
+        timeout = int(request.GET.get('timeout', 6000)) or 6000
+    except Exception as e:
+        logger.error(f"Error parsing params in /api/trees/clusters: {str(e)}")
+        return JsonResponse({'error': f'Parámetros inválidos (bbox y zoom son obligatorios): {str(e)}'}, status=400)
+    filters, invalid = parse_filters(request)
+    if invalid:
+        return invalid
+
+    max_points = settings.CLUSTER_MAX_POINTS
+    try:
+        elements_by_layer = await get_data_source().fetch(
+            ['trees'], (min_lat, min_lon, max_lat, max_lon), max_points, timeout, filters
+        )
+    except Exception as e:
+        total_time = time.time() - start_time
+        logger.error("Error happened in /api/trees/clusters")
+        logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
+        return error_response(e)
+
+    with stage('parse'):
+        elements = [element for element in elements_by_layer['trees'][:max_points] if element.get("type") == "node"]
+        cell_lat, cell_lon = cell_size(zoom, settings.CLUSTER_CELLS_PER_TILE, (min_lat + max_lat) / 2)
+        clusters = cluster_points(*elements_to_arrays(elements), cell_lat, cell_lon)
+
+    with stage('serialize'):
+        response = JsonResponse({
+            'zoom': zoom,
+            'cell_size': [cell_lat, cell_lon],
+            'total': len(elements),
+            'truncated': len(elements) >= max_points,
+            'clusters': clusters,
+        })
+    return set_data_age(response, elements_by_layer.fetched_at)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@conditional_api()
+async def get_stats(request: HttpRequest):
+    """
+    Estadísticas de árboles y tocones en un área, sin enviar los puntos
+
+    Se calculan sumando resúmenes precalculados por tesela (ver stats.py), así
+    que el coste depende del número de teselas y no del de elementos.
+
+    Args:
+        bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon" (required)
+        layers: Capas separadas por comas (default: trees,stumps)
+
+    Returns:
+        {"bbox": [...], "zoom": int, "tiles": int, "area_km2": float, "approximate": bool, "truncated": bool,
+         "<capa>": {"count", "density", "species": [{"species", "count"}, ...], "species_count", "other_species"}}
+    """
+    start_time = time.time()
+
+    try:
+        min_lat, min_lon, max_lat, max_lon = map(float, request.GET['bbox'].split(","))
+        layers = [layer for layer in request.GET.get('layers', 'trees,stumps').split(",") if layer]
+        unknown = [layer for layer in layers if layer not in LAYER_FILTERS]
+        if unknown or not layers:
+            raise ValueError(f"capas desconocidas: {', '.join(unknown) or '-'}")
+    except Exception as e:
+        logger.error(f"Error parsing params in /api/stats: {str(e)}")
+        return JsonResponse({'error': f'Parámetros inválidos: {str(e)}'}, status=400)
+
+    bbox = (min_lat, min_lon, max_lat, max_lon)
+    try:
+        stats, fetched_at = await bbox_stats(layers, bbox)
+    except StatsAreaTooLarge as e:
+        return JsonResponse({'error': f'Área demasiado grande para calcular estadísticas: {str(e)}'}, status=400)
+    except Exception as e:
+        total_time = time.time() - start_time
+        logger.error("Error happened in /api/stats")
+        logger.error(f"Error: {str(e)}. Tiempo total: {total_time:.2f}s")
+        return error_response(e)
+
+    with stage('serialize'):
+        response = JsonResponse({'bbox': list(bbox), **stats})
+    return set_data_age(response, fetched_at)
+
+
+@require_http_methods(["GET"])
+async def get_vector_tile(request: HttpRequest, layer: str, z: int, x: int, y: int):
+    """
+    Tesela vectorial (MVT) de árboles o tocones
+
+    Responde con ETag fuerte y Cache-Control público para que navegador y CDN
+    puedan cachearla; un If-None-Match coincidente devuelve 304.
+    """
+    if layer not in LAYER_FILTERS or z > 22 or x >= (1 << z) or y >= (1 << z):
+        raise Http404("Tesela no válida")
+
+    try:
+        etag, data = await render_tile(layer, z, x, y)
+    except Exception as e:
+        logger.error(f"Error rendering tile {layer}/{z}/{x}/{y}: {str(e)}")
+        return HttpResponse(status=502)
+
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={settings.MVT_MAX_AGE}',
+    }
+    if etag_matches(request, etag):
+        return not_modified(headers)
+    return HttpResponse(data, content_type='application/vnd.mapbox-vector-tile', headers=headers)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def prefetch(request: HttpRequest):
+    """
+    Aviso del cliente de la vista que probablemente pedirá a continuación
+
+    Args:
+        bbox: Bounding box en formato "min_lat,min_lon,max_lat,max_lon" (required)
+        layers: Capas separadas por comas (default: trees,stumps)
+
+    Responde 202 si se ha encolado la precarga y 204 si no hace falta (p. ej.
+    almacén local o bbox demasiado grande).
+    """
+    try:
+        min_lat, min_lon, max_lat, max_lon = map(float, request.POST['bbox'].split(","))
+        layers = request.POST.get('layers', 'trees,stumps').split(",")
+        if any(layer not in LAYER_FILTERS for layer in layers):
+            raise ValueError(f"capas válidas: {', '.join(LAYER_FILTERS)}")
+    except Exception as e:
+        return JsonResponse({'error': f'Parámetros inválidos: {str(e)}'}, status=400)
+
+    accepted = await get_data_source().prefetch(layers, (min_lat, min_lon, max_lat, max_lon))
+    return HttpResponse(status=202 if accepted else 204)
+
+
+@require_http_methods(["GET"])
+def get_overpass_status(request: HttpRequest):
+    """Estado de los servidores Overpass de este proceso: latencia, errores, coberturas y circuito"""
+    return JsonResponse(get_endpoint_pool().stats())
+
+
+@require_http_methods(["GET"])
+def metrics(request: HttpRequest):
+    """Métricas del proceso en el formato de texto de Prometheus (ver metrics.py)"""
+    if not settings.METRICS_ENABLED:
+        raise Http404("Métricas desactivadas")
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
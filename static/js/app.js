@@ -10,6 +10,7 @@
 let map;
 let treeLayer;
 let stumpLayer;
+let clusterLayer;
 let treeCount = 0;
 let stumpCount = 0;
 let autoUpdateEnabled = true;
@@ -18,6 +19,264 @@ let isUpdatingBbox = false;
 let isProgrammaticMove = false;
 let loadDataButtonEnabled = true;
 let controlsExpanded = false;
+let vectorTilesEnabled = false;
+let loadGeneration = 0;
+let lastMapCenter = null;
+
+// Carga por teselas: solo se piden al servidor las teselas que faltan
+const MAP_CONFIG = JSON.parse(document.getElementById('map-config')?.textContent || '{}');
+const TILE_ZOOM = MAP_CONFIG.tileZoom || 15;
+const TILES_PER_REQUEST = Math.min(MAP_CONFIG.maxTilesPerRequest || 16, 16);
+const TILE_TTL_MS = 10 * 60 * 1000;  // vigencia de una tesela en memoria y en IndexedDB
+const MAX_LOADED_POINTS = 50000;  // puntos en memoria, contando los de teselas que no se ven
+const LOAD_DEBOUNCE_MS = 250;
+const TILE_DB_NAME = 'arboles-tiles';
+let loadedTiles = new Map();  // "z/x/y" -> {trees, stumps, fetchedAt, limit, lastSeen}
+let loadAbortController = null;
+let loadDebounceTimer = null;
+let tileDbPromise = null;
+let statsAbortController = null;
+let serverStats = null;  // respuesta de /api/stats para la vista actual, o null si no está disponible
+let pointRenderer;
+let treePoints;
+let stumpPoints;
+
+/**
+ * Renderer de puntos en un único canvas
+ *
+ * Dibuja todos los puntos de cada PointSet con un solo trazado por capa en
+ * lugar de un elemento SVG por marcador, y solo los grupos (teselas) que
+ * caen en la vista. Los clics se resuelven con un índice espacial en
+ * rejilla y el popup se construye al abrirlo. Hereda de L.Canvas el tamaño,
+ * la posición y la animación de zoom.
+ */
+const PointCanvas = L.Canvas.extend({
+    options: {
+        padding: 0.5,
+        hitTolerance: 3,  // píxeles extra alrededor de cada punto para el clic
+        hitCellSize: 32   // celda del índice espacial, en píxeles
+    },
+
+    initialize: function (options) {
+        L.Canvas.prototype.initialize.call(this, options);
+        this._sets = [];
+        this._hitIndex = null;
+    },
+
+    onAdd: function () {
+        L.Canvas.prototype.onAdd.call(this);
+        // Los eventos se reciben del mapa para no tapar otras capas interactivas
+        this._container.style.pointerEvents = 'none';
+        this._map.on('click', this._onMapClick, this);
+        this._map.on('mousemove', this._onMapMouseMove, this);
+        this._map.on('zoomend', this._resetHitIndex, this);
+    },
+
+    onRemove: function () {
+        this._map.off('click', this._onMapClick, this);
+        this._map.off('mousemove', this._onMapMouseMove, this);
+        this._map.off('zoomend', this._resetHitIndex, this);
+        this._map.getContainer().style.cursor = '';
+        L.Canvas.prototype.onRemove.call(this);
+    },
+
+    addSet: function (set) {
+        this._sets.push(set);
+        this.redraw();
+    },
+
+    removeSet: function (set) {
+        this._sets = this._sets.filter(other => other !== set);
+        this.redraw();
+    },
+
+    /**
+     * Volver a dibujar en el siguiente frame (tras cambiar los puntos)
+     */
+    redraw: function () {
+        this._hitIndex = null;
+        if (this._map && !this._redrawRequest) {
+            this._redrawRequest = L.Util.requestAnimFrame(this._redraw, this);
+        }
+    },
+
+    _resetHitIndex: function () {
+        this._hitIndex = null;
+    },
+
+    _draw: function () {
+        if (!this._map) return;
+        const ctx = this._ctx;
+        const zoom = this._map.getZoom();
+        const origin = this._map.getPixelOrigin();
+        // Límites del canvas en píxeles absolutos del zoom actual
+        const minX = this._bounds.min.x + origin.x;
+        const minY = this._bounds.min.y + origin.y;
+        const maxX = this._bounds.max.x + origin.x;
+        const maxY = this._bounds.max.y + origin.y;
+        
+        this._sets.forEach(set => {
+            const style = set.options;
+            const r = style.radius;
+            ctx.beginPath();
+            set.forEachGroup(group => {
+                set.project(group, this._map, zoom);
+                if (group.maxX < minX - r || group.minX > maxX + r || group.maxY < minY - r || group.minY > maxY + r) return;
+                for (let i = 0; i < group.xs.length; i++) {
+                    const x = group.xs[i] - origin.x;
+                    const y = group.ys[i] - origin.y;
+                    ctx.moveTo(x + r, y);
+                    ctx.arc(x, y, r, 0, Math.PI * 2);
+                }
+            });
+            ctx.globalAlpha = style.fillOpacity;
+            ctx.fillStyle = style.fillColor;
+            ctx.fill();
+            ctx.globalAlpha = style.opacity;
+            ctx.lineWidth = style.weight;
+            ctx.strokeStyle = style.color;
+            ctx.stroke();
+        });
+        ctx.globalAlpha = 1;
+    },
+
+    _buildHitIndex: function () {
+        const zoom = this._map.getZoom();
+        const size = this.options.hitCellSize;
+        const index = new Map();
+        this._sets.forEach(set => {
+            set.forEachGroup(group => {
+                set.project(group, this._map, zoom);
+                for (let i = 0; i < group.xs.length; i++) {
+                    const cell = `${Math.floor(group.xs[i] / size)}:${Math.floor(group.ys[i] / size)}`;
+                    let bucket = index.get(cell);
+                    if (!bucket) index.set(cell, bucket = []);
+                    bucket.push({ set, group, index: i });
+                }
+            });
+        });
+        this._hitIndex = index;
+    },
+
+    /**
+     * Punto más cercano a una posición del mapa, si hay alguno a distancia de clic
+     * @param {L.LatLng} latlng - Posición
+     * @returns {Object|null} {set, item}
+     */
+    hitTest: function (latlng) {
+        if (!this._hitIndex) this._buildHitIndex();
+        const size = this.options.hitCellSize;
+        const point = this._map.project(latlng, this._map.getZoom());
+        const cellX = Math.floor(point.x / size);
+        const cellY = Math.floor(point.y / size);
+        let best = null;
+        let bestDistance = Infinity;
+        for (let dx = -1; dx <= 1; dx++) {
+            for (let dy = -1; dy <= 1; dy++) {
+                (this._hitIndex.get(`${cellX + dx}:${cellY + dy}`) || []).forEach(candidate => {
+                    const style = candidate.set.options;
+                    const distance = Math.hypot(candidate.group.xs[candidate.index] - point.x,
+                                                candidate.group.ys[candidate.index] - point.y);
+                    if (distance <= style.radius + style.weight / 2 + this.options.hitTolerance && distance < bestDistance) {
+                        best = candidate;
+                        bestDistance = distance;
+                    }
+                });
+            }
+        }
+        return best ? { set: best.set, item: best.group.items[best.index] } : null;
+    },
+
+    _onMapClick: function (event) {
+        const hit = this.hitTest(event.latlng);
+        if (!hit || !hit.set.options.popup) return;
+        L.popup()
+            .setLatLng([hit.item.lat, hit.item.lon])
+            .setContent(hit.set.options.popup(hit.item))
+            .openOn(this._map);
+    },
+
+    _onMapMouseMove: function (event) {
+        if (this._map.dragging.moving() || this._map._animatingZoom) return;
+        this._map.getContainer().style.cursor = this.hitTest(event.latlng) ? 'pointer' : '';
+    }
+});
+
+/**
+ * Conjunto de puntos de una capa (árboles o tocones) dibujado por un PointCanvas
+ *
+ * Los puntos se agrupan por tesela para añadirlos y quitarlos juntos. Al
+ * añadir o quitar el conjunto de un L.layerGroup se muestra u oculta, como
+ * cualquier otra capa.
+ */
+const PointSet = L.Layer.extend({
+    options: {
+        radius: 6,
+        fillColor: '#3388ff',
+        color: '#3388ff',
+        weight: 2,
+        opacity: 1,
+        fillOpacity: 0.8,
+        popup: null  // función elemento -> HTML, llamada al abrir el popup
+    },
+
+    initialize: function (renderer, options) {
+        L.setOptions(this, options);
+        this._renderer = renderer;
+        this._groups = new Map();
+    },
+
+    onAdd: function (map) {
+        if (!map.hasLayer(this._renderer)) map.addLayer(this._renderer);
+        this._renderer.addSet(this);
+    },
+
+    onRemove: function () {
+        this._renderer.removeSet(this);
+    },
+
+    setGroup: function (key, items) {
+        this._groups.set(key, { items, zoom: null });
+        this._changed();
+    },
+
+    removeGroup: function (key) {
+        if (this._groups.delete(key)) this._changed();
+    },
+
+    forEachGroup: function (callback) {
+        this._groups.forEach(callback);
+    },
+
+    /**
+     * Calcular (una vez por zoom) las coordenadas en píxeles de un grupo y su rectángulo
+     */
+    project: function (group, map, zoom) {
+        if (group.zoom === zoom) return;
+        const count = group.items.length;
+        group.xs = new Float64Array(count);
+        group.ys = new Float64Array(count);
+        group.minX = group.minY = Infinity;
+        group.maxX = group.maxY = -Infinity;
+        for (let i = 0; i < count; i++) {
+            const point = map.project([group.items[i].lat, group.items[i].lon], zoom);
+            group.xs[i] = point.x;
+            group.ys[i] = point.y;
+            group.minX = Math.min(group.minX, point.x);
+            group.minY = Math.min(group.minY, point.y);
+            group.maxX = Math.max(group.maxX, point.x);
+            group.maxY = Math.max(group.maxY, point.y);
+        }
+        group.zoom = zoom;
+    },
+
+    _changed: function () {
+        if (this._map) this._renderer.redraw();
+    }
+});
+
+// Por debajo de este zoom se muestran clusters agregados en el servidor en lugar de puntos
+const CLUSTER_MAX_ZOOM = 14;
 
 // Estado de visibilidad de las capas
 let layerVisibility = {
@@ -57,6 +316,18 @@ function initializeMap() {
     // Crear capas para árboles y tocones
     treeLayer = L.layerGroup().addTo(map);
     stumpLayer = L.layerGroup().addTo(map);
+    clusterLayer = L.layerGroup().addTo(map);
+    
+    // Árboles y tocones se dibujan en un canvas compartido (ver PointCanvas)
+    pointRenderer = new PointCanvas();
+    treePoints = new PointSet(pointRenderer, {
+        radius: 6, fillColor: '#2d5016', color: '#1a3009', popup: createTreePopup
+    });
+    stumpPoints = new PointSet(pointRenderer, {
+        radius: 5, fillColor: '#8b4513', color: '#5d2e0a', popup: createStumpPopup
+    });
+    treeLayer.addLayer(treePoints);
+    stumpLayer.addLayer(stumpPoints);
     
     // Añadir control de zoom con posición personalizada
     L.control.zoom({
@@ -209,6 +480,9 @@ function initializeEventListeners() {
     document.getElementById('autoFitBounds').addEventListener('change', function() {
         autoFitBoundsEnabled = this.checked;
     });
+    document.getElementById('vectorTiles').addEventListener('change', function() {
+        setVectorTiles(this.checked);
+    });
     
     // Event listeners para la leyenda
     initializeLegendListeners();
@@ -248,19 +522,47 @@ function setLoadDataButtonState(enabled) {
     }
 }
 
+/**
+ * Pedir al servidor las estadísticas del área visible
+ * @param {string} bbox - Bbox visible
+ */
+async function loadStats(bbox) {
+    if (statsAbortController) statsAbortController.abort();
+    const controller = new AbortController();
+    statsAbortController = controller;
+    
+    try {
+        const response = await fetch(`/api/stats/?${new URLSearchParams({ bbox })}`, { signal: controller.signal });
+        // Con un área demasiado grande o un error se cuentan los puntos cargados
+        serverStats = response.ok ? await response.json() : null;
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        console.error('Error al cargar estadísticas:', error);
+        serverStats = null;
+    }
+    updateStats();
+}
+
 /**
  * Actualizar estadísticas en la interfaz
  */
 function updateStats() {
+    // Las del servidor cubren todo el área; si no las hay, los puntos cargados
+    const trees = serverStats ? serverStats.trees.count : treeCount;
+    const stumps = serverStats ? serverStats.stumps.count : stumpCount;
+    const prefix = serverStats && serverStats.approximate ? '~' : '';
+    
     // Actualizar estadísticas laterales (desktop)
-    document.getElementById('tree-count').textContent = treeCount;
-    document.getElementById('stump-count').textContent = stumpCount;
-    document.getElementById('total-count').textContent = treeCount + stumpCount;
+    document.getElementById('tree-count').textContent = prefix + trees;
+    document.getElementById('stump-count').textContent = prefix + stumps;
+    document.getElementById('total-count').textContent = prefix + (trees + stumps);
+    document.getElementById('tree-density').textContent =
+        serverStats && serverStats.trees.density !== null ? serverStats.trees.density.toFixed(1) : '-';
     
     // Actualizar estadísticas móviles
-    document.getElementById('mobile-tree-count').textContent = treeCount;
-    document.getElementById('mobile-stump-count').textContent = stumpCount;
-    document.getElementById('mobile-total-count').textContent = treeCount + stumpCount;
+    document.getElementById('mobile-tree-count').textContent = prefix + trees;
+    document.getElementById('mobile-stump-count').textContent = prefix + stumps;
+    document.getElementById('mobile-total-count').textContent = prefix + (trees + stumps);
     
     // Actualizar desglose por especies
     updateSpeciesBreakdown();
@@ -272,22 +574,35 @@ function updateStats() {
 function updateSpeciesBreakdown() {
     const speciesList = document.getElementById('species-list');
     
-    if (treesData.length === 0) {
-        speciesList.innerHTML = '<p class="no-data">No hay datos cargados</p>';
-        return;
+    let sortedSpecies;
+    if (serverStats) {
+        // Histograma ya ordenado por el servidor; el resto de especies se agrupa
+        sortedSpecies = serverStats.trees.species.map(item => [item.species || 'No especificada', item.count]);
+        if (serverStats.trees.other_species > 0) {
+            sortedSpecies.push(['Otras especies', serverStats.trees.other_species]);
+        }
+        if (serverStats.trees.count === 0) {
+            speciesList.innerHTML = '<p class="no-data">No hay árboles en el área</p>';
+            return;
+        }
+    } else {
+        if (treesData.length === 0) {
+            speciesList.innerHTML = '<p class="no-data">No hay datos cargados</p>';
+            return;
+        }
+        
+        // Contar especies
+        const speciesCount = {};
+        treesData.forEach(tree => {
+            const species = tree.species || 'No especificada';
+            speciesCount[species] = (speciesCount[species] || 0) + 1;
+        });
+        
+        // Ordenar por cantidad (descendente)
+        sortedSpecies = Object.entries(speciesCount)
+            .sort(([,a], [,b]) => b - a);
     }
     
-    // Contar especies
-    const speciesCount = {};
-    treesData.forEach(tree => {
-        const species = tree.species || 'No especificada';
-        speciesCount[species] = (speciesCount[species] || 0) + 1;
-    });
-    
-    // Ordenar por cantidad (descendente)
-    const sortedSpecies = Object.entries(speciesCount)
-        .sort(([,a], [,b]) => b - a);
-    
     // Generar HTML
     if (sortedSpecies.length === 0) {
         speciesList.innerHTML = '<p class="no-data">No hay especies identificadas</p>';
@@ -345,123 +660,441 @@ function createStumpPopup(stump) {
 }
 
 
+/**
+ * Teselas (z/x/y) que cubren un bbox, en el zoom de la caché del servidor
+ * @param {string} bbox - Bbox en formato "min_lat,min_lon,max_lat,max_lon"
+ * @returns {Array<string>} Claves "z/x/y"
+ */
+function tilesForBbox(bbox) {
+    const [minLat, minLon, maxLat, maxLon] = bbox.split(',').map(Number);
+    const n = 2 ** TILE_ZOOM;
+    const clamp = value => Math.min(Math.max(value, 0), n - 1);
+    const tileX = lon => clamp(Math.floor((lon + 180) / 360 * n));
+    const tileY = lat => {
+        const rad = Math.max(Math.min(lat, 85.0511287798), -85.0511287798) * Math.PI / 180;
+        return clamp(Math.floor((1 - Math.asinh(Math.tan(rad)) / Math.PI) / 2 * n));
+    };
+    const keys = [];
+    for (let x = tileX(minLon); x <= tileX(maxLon); x++) {
+        for (let y = tileY(maxLat); y <= tileY(minLat); y++) {
+            keys.push(`${TILE_ZOOM}/${x}/${y}`);
+        }
+    }
+    return keys;
+}
+
+/**
+ * Abrir la base de datos IndexedDB de teselas (null si el navegador no la permite)
+ * @returns {Promise<IDBDatabase|null>}
+ */
+function openTileDb() {
+    if (!tileDbPromise) {
+        tileDbPromise = new Promise(resolve => {
+            if (!window.indexedDB) return resolve(null);
+            const request = indexedDB.open(TILE_DB_NAME, 1);
+            request.onupgradeneeded = () => request.result.createObjectStore('tiles');
+            request.onsuccess = () => {
+                pruneTileDb(request.result);
+                resolve(request.result);
+            };
+            request.onerror = () => resolve(null);
+        });
+    }
+    return tileDbPromise;
+}
+
+/**
+ * Eliminar de IndexedDB las teselas caducadas
+ * @param {IDBDatabase} db - Base de datos de teselas
+ */
+function pruneTileDb(db) {
+    const store = db.transaction('tiles', 'readwrite').objectStore('tiles');
+    const now = Date.now();
+    store.openCursor().onsuccess = event => {
+        const cursor = event.target.result;
+        if (!cursor) return;
+        if (now - cursor.value.fetchedAt > TILE_TTL_MS) cursor.delete();
+        cursor.continue();
+    };
+}
+
+/**
+ * Leer de IndexedDB las teselas vigentes
+ * @param {Array<string>} keys - Claves "z/x/y"
+ * @param {number} limit - Límite por capa con el que se pidieron
+ * @returns {Promise<Map>} Clave -> {trees, stumps, fetchedAt, limit}
+ */
+async function readCachedTiles(keys, limit) {
+    const found = new Map();
+    const db = await openTileDb();
+    if (!db || keys.length === 0) return found;
+    
+    return new Promise(resolve => {
+        const transaction = db.transaction('tiles', 'readonly');
+        const store = transaction.objectStore('tiles');
+        const now = Date.now();
+        keys.forEach(key => {
+            store.get(key).onsuccess = event => {
+                const entry = event.target.result;
+                if (entry && entry.limit === limit && now - entry.fetchedAt <= TILE_TTL_MS) {
+                    found.set(key, entry);
+                }
+            };
+        });
+        transaction.oncomplete = () => resolve(found);
+        transaction.onerror = () => resolve(found);
+    });
+}
+
+/**
+ * Guardar teselas en IndexedDB
+ * @param {Map} entries - Clave -> {trees, stumps, fetchedAt, limit}
+ */
+async function writeCachedTiles(entries) {
+    const db = await openTileDb();
+    if (!db) return;
+    try {
+        const store = db.transaction('tiles', 'readwrite').objectStore('tiles');
+        entries.forEach((entry, key) => store.put(entry, key));
+    } catch (error) {
+        console.warn('No se pudieron guardar las teselas en IndexedDB:', error);
+    }
+}
+
+/**
+ * Pedir al servidor los elementos de varias teselas
+ * @param {Array<string>} keys - Claves "z/x/y"
+ * @param {number} limit - Límite por capa y tesela
+ * @param {AbortSignal} signal - Señal para cancelar la petición
+ * @returns {Promise<Map>} Clave -> {trees, stumps, fetchedAt, limit}
+ */
+async function fetchTiles(keys, limit, signal) {
+    const params = new URLSearchParams();
+    // Ordenadas, para que la misma petición tenga siempre la misma URL en la caché del navegador y la CDN
+    params.append('tiles', keys.slice().sort().join(','));
+    params.append('limit', limit);
+    
+    const response = await fetch(`/api/features/?${params}`, { signal });
+    if (!response.ok) {
+        let detail;
+        try {
+            detail = (await response.json()).error;
+        } catch (_) {
+            detail = response.statusText;
+        }
+        throw new Error(`Error árboles y tocones (${response.status}): ${detail}`);
+    }
+    
+    // X-Data-Age indica la antigüedad de los datos en la caché del servidor
+    const fetchedAt = Date.now() - 1000 * (parseInt(response.headers.get('X-Data-Age'), 10) || 0);
+    const data = await response.json();
+    const tiles = new Map();
+    Object.entries(data.tiles || {}).forEach(([key, tile]) => {
+        tiles.set(key, { trees: tile.trees || [], stumps: tile.stumps || [], fetchedAt, limit });
+    });
+    return tiles;
+}
+
+/**
+ * Dibujar los puntos de una tesela, sustituyendo los que tuviera
+ * @param {string} key - Clave "z/x/y"
+ * @param {Object} entry - {trees, stumps, fetchedAt, limit}
+ */
+function showTile(key, entry) {
+    // clearMap() vacía los grupos de capas; los conjuntos de puntos se vuelven a añadir
+    if (!treeLayer.hasLayer(treePoints)) treeLayer.addLayer(treePoints);
+    if (!stumpLayer.hasLayer(stumpPoints)) stumpLayer.addLayer(stumpPoints);
+    treePoints.setGroup(key, entry.trees);
+    stumpPoints.setGroup(key, entry.stumps);
+    loadedTiles.set(key, { ...entry, lastSeen: Date.now() });
+}
+
+/**
+ * Quitar del mapa los puntos de una tesela
+ * @param {string} key - Clave "z/x/y"
+ */
+function removeTile(key) {
+    treePoints.removeGroup(key);
+    stumpPoints.removeGroup(key);
+    loadedTiles.delete(key);
+}
+
+/**
+ * Quitar todas las teselas cargadas y cancelar las peticiones en curso
+ */
+function clearTiles() {
+    if (loadAbortController) loadAbortController.abort();
+    loadedTiles.forEach((_, key) => removeTile(key));
+}
+
+/**
+ * Quitar las teselas fuera de la vista usadas hace más tiempo mientras se supere MAX_LOADED_POINTS
+ * @param {Set<string>} visible - Claves de las teselas visibles
+ */
+function evictTiles(visible) {
+    const size = tile => tile.trees.length + tile.stumps.length;
+    let total = 0;
+    loadedTiles.forEach(tile => { total += size(tile); });
+    if (total <= MAX_LOADED_POINTS) return;
+    const offscreen = [...loadedTiles.entries()]
+        .filter(([key]) => !visible.has(key))
+        .sort(([, a], [, b]) => a.lastSeen - b.lastSeen);
+    for (const [key, tile] of offscreen) {
+        if (total <= MAX_LOADED_POINTS) break;
+        total -= size(tile);
+        removeTile(key);
+    }
+}
+
+/**
+ * Actualizar los datos de las estadísticas con las teselas visibles
+ * @param {Array<string>} keys - Claves de las teselas visibles
+ */
+function updateVisibleData(keys) {
+    treesData = [];
+    stumpsData = [];
+    keys.forEach(key => {
+        const tile = loadedTiles.get(key);
+        if (!tile) return;
+        treesData.push(...tile.trees);
+        stumpsData.push(...tile.stumps);
+    });
+    treeCount = treesData.length;
+    stumpCount = stumpsData.length;
+    updateStats();
+}
+
+/**
+ * Programar una carga tras un breve intervalo, agrupando movimientos seguidos del mapa
+ */
+function scheduleLoadData() {
+    clearTimeout(loadDebounceTimer);
+    loadDebounceTimer = setTimeout(loadData, LOAD_DEBOUNCE_MS);
+}
+
 /**
  * Cargar datos de árboles y tocones desde la API
+ *
+ * Solo se piden las teselas del área que no están ya en el mapa ni en
+ * IndexedDB; al mover el mapa se cancelan las peticiones anteriores.
  */
 async function loadData() {
-    // Deshabilitar el botón al inicio de la carga
-    setLoadDataButtonState(false);
-    showLoading(true);
-    
     const bbox = document.getElementById('bbox').value;
-    const limit = document.getElementById('limit').value;
+    // Las estadísticas las calcula el servidor, sin depender de los puntos cargados
+    if (bbox) loadStats(bbox);
+    
+    // Con teselas vectoriales el mapa carga los datos por sí mismo
+    if (vectorTilesEnabled) return;
+    
+    // Una carga nueva invalida y cancela las que sigan en curso
+    const generation = ++loadGeneration;
+    if (loadAbortController) loadAbortController.abort();
+    const controller = new AbortController();
+    loadAbortController = controller;
+    
+    const limit = Math.min(parseInt(document.getElementById('limit').value, 10) || 500, 1000);
+    if (!bbox) return;
     
+    // Con zoom bajo se piden clusters en lugar de puntos individuales
+    if (map.getZoom() < CLUSTER_MAX_ZOOM) {
+        setLoadDataButtonState(false);
+        showLoading(true);
+        await loadClusters(bbox, controller.signal, generation);
+        return;
+    }
+    clusterLayer.clearLayers();
+    
+    const keys = tilesForBbox(bbox);
+    const visible = new Set(keys);
+    const now = Date.now();
+    const missing = keys.filter(key => {
+        const tile = loadedTiles.get(key);
+        if (tile && tile.limit === limit && now - tile.fetchedAt <= TILE_TTL_MS) {
+            tile.lastSeen = now;
+            return false;
+        }
+        return true;
+    });
+    
+    if (missing.length > 0) {
+        setLoadDataButtonState(false);
+        showLoading(true);
+    }
+    
+    try {
+        const cached = await readCachedTiles(missing, limit);
+        if (generation !== loadGeneration) return;
+        cached.forEach((entry, key) => showTile(key, entry));
+        
+        // El resto se pide en lotes en paralelo y se dibuja según llega cada uno
+        const remaining = missing.filter(key => !cached.has(key));
+        const batches = [];
+        for (let i = 0; i < remaining.length; i += TILES_PER_REQUEST) {
+            batches.push(remaining.slice(i, i + TILES_PER_REQUEST));
+        }
+        await Promise.all(batches.map(async batch => {
+            const tiles = await fetchTiles(batch, limit, controller.signal);
+            if (generation !== loadGeneration) return;
+            tiles.forEach((entry, key) => showTile(key, entry));
+            writeCachedTiles(tiles);
+            updateVisibleData(keys);
+            applyLayerVisibility();
+        }));
+        if (generation !== loadGeneration) return;
+        
+        evictTiles(visible);
+        updateVisibleData(keys);
+        applyLayerVisibility();
+        
+        // Ajustar vista del mapa si hay datos y está habilitado
+        if (autoFitBoundsEnabled && (treesData.length > 0 || stumpsData.length > 0)) {
+            adjustMapView(treesData, stumpsData);
+        }
+        
+    } catch (error) {
+        // Cancelada por una carga posterior
+        if (error.name === 'AbortError') return;
+        console.error('Error al cargar datos:', error);
+        showErrorCard('Error al cargar los datos. Por favor, inténtalo de nuevo.');
+    } finally {
+        // Si hay otra carga en curso, es ella quien oculta el indicador
+        if (generation === loadGeneration) {
+            showLoading(false);
+            // Rehabilitar el botón siempre al finalizar
+            setLoadDataButtonState(true);
+        }
+    }
+}
+
+/**
+ * Cargar clusters de árboles para niveles de zoom bajos
+ * @param {string} bbox - Bbox visible
+ * @param {AbortSignal} signal - Señal de la carga en curso
+ * @param {number} generation - Carga a la que pertenece la petición
+ */
+async function loadClusters(bbox, signal, generation) {
     try {
-        // Limpiar capas existentes
-        treeLayer.clearLayers();
-        stumpLayer.clearLayers();
+        // loadData ya ha cancelado las peticiones anteriores; clearTiles cancelaría también esta
+        loadedTiles.forEach((_, key) => removeTile(key));
+        clusterLayer.clearLayers();
         treeCount = 0;
         stumpCount = 0;
-        
-        // Limpiar datos almacenados
         treesData = [];
         stumpsData = [];
         
-        // Construir parámetros de consulta
         const params = new URLSearchParams();
         if (bbox) params.append('bbox', bbox);
-        if (limit) params.append('limit', limit);
+        params.append('zoom', map.getZoom());
         
-        // Cargar árboles y tocones en paralelo
-        const [treesResponse, stumpsResponse] = await Promise.all([
-            fetch(`/api/trees?${params}`),
-            fetch(`/api/stumps?${params}`)
-        ]);
-
-        // Manejo explícito de errores HTTP antes de parsear JSON
-        const readError = async (resp) => {
-            try {
-                const data = await resp.json();
-                if (data && typeof data === 'object') {
-                    return data.detail || JSON.stringify(data);
-                }
-                return String(data);
-            } catch (_) {
-                try {
-                    return await resp.text();
-                } catch (__){
-                    return 'Respuesta no legible';
-                }
-            }
-        };
-
-        if (!treesResponse.ok) {
-            const detail = await readError(treesResponse);
-            throw new Error(`Error árboles (${treesResponse.status}): ${detail}`);
-        }
-        if (!stumpsResponse.ok) {
-            const detail = await readError(stumpsResponse);
-            throw new Error(`Error tocones (${stumpsResponse.status}): ${detail}`);
+        const response = await fetch(`/api/trees/clusters/?${params}`, { signal });
+        if (!response.ok) {
+            throw new Error(`Error clusters (${response.status})`);
         }
-
-        const treesRaw = await treesResponse.json();
-        const stumpsRaw = await stumpsResponse.json();
-
-        const trees = Array.isArray(treesRaw) ? treesRaw : [];
-        const stumps = Array.isArray(stumpsRaw) ? stumpsRaw : [];
         
-        // Almacenar datos de árboles y añadir al mapa
-        treesData = trees;
-        trees.forEach(tree => {
-            const marker = L.circleMarker([tree.lat, tree.lon], {
-                radius: 6,
+        const data = await response.json();
+        // Una carga posterior ya ha sustituido a esta
+        if (generation !== loadGeneration) return;
+        const clusters = Array.isArray(data.clusters) ? data.clusters : [];
+        
+        clusters.forEach(cluster => {
+            const marker = L.circleMarker([cluster.lat, cluster.lon], {
+                radius: Math.min(6 + 4 * Math.log10(cluster.count), 24),
                 fillColor: '#2d5016',
                 color: '#1a3009',
                 weight: 2,
                 opacity: 1,
-                fillOpacity: 0.8
+                fillOpacity: 0.6
             });
             
-            marker.bindPopup(createTreePopup(tree));
-            treeLayer.addLayer(marker);
-            treeCount++;
-        });
-        
-        // Almacenar datos de tocones y añadir al mapa
-        stumpsData = stumps;
-        stumps.forEach(stump => {
-            const marker = L.circleMarker([stump.lat, stump.lon], {
-                radius: 5,
-                fillColor: '#8b4513',
-                color: '#5d2e0a',
-                weight: 2,
-                opacity: 1,
-                fillOpacity: 0.8
+            marker.bindTooltip(String(cluster.count), {
+                permanent: true,
+                direction: 'center',
+                className: 'cluster-label'
             });
             
-            marker.bindPopup(createStumpPopup(stump));
-            stumpLayer.addLayer(marker);
-            stumpCount++;
+            // Al pulsar un cluster, acercar el mapa a su celda
+            marker.on('click', () => {
+                const [minLat, minLon, maxLat, maxLon] = cluster.bbox;
+                map.fitBounds([[minLat, minLon], [maxLat, maxLon]]);
+            });
+            clusterLayer.addLayer(marker);
         });
         
-        // Actualizar estadísticas
+        treeCount = data.total || 0;
         updateStats();
-        
-        // Aplicar el estado de visibilidad actual
         applyLayerVisibility();
         
-        // Ajustar vista del mapa si hay datos y está habilitado
-        if (autoFitBoundsEnabled && (trees.length > 0 || stumps.length > 0)) {
-            adjustMapView(trees, stumps);
-        }
-        
     } catch (error) {
-        console.error('Error al cargar datos:', error);
+        // Cancelada por una carga posterior
+        if (error.name === 'AbortError' || generation !== loadGeneration) return;
+        console.error('Error al cargar clusters:', error);
         showErrorCard('Error al cargar los datos. Por favor, inténtalo de nuevo.');
     } finally {
-        showLoading(false);
-        // Rehabilitar el botón siempre al finalizar
-        setLoadDataButtonState(true);
+        // Si hay otra carga en curso, es ella quien oculta el indicador
+        if (generation === loadGeneration) {
+            showLoading(false);
+            setLoadDataButtonState(true);
+        }
+    }
+}
+
+/**
+ * Crear una capa de teselas vectoriales (MVT) dibujada en canvas
+ * @param {string} layerType - Tipo de capa ('trees' o 'stumps')
+ * @param {Object} colors - Colores de relleno y borde
+ * @returns {L.Layer} Capa de Leaflet.VectorGrid
+ */
+function createVectorLayer(layerType, colors) {
+    const layer = L.vectorGrid.protobuf(`/tiles/${layerType}/{z}/{x}/{y}.mvt`, {
+        rendererFactory: L.canvas.tile,
+        interactive: true,
+        maxNativeZoom: 18,
+        vectorTileLayerStyles: {
+            [layerType]: properties => ({
+                // Los puntos agregados (zoom bajo) crecen con el número de elementos
+                radius: properties.count ? Math.min(3 + Math.log2(properties.count), 12) : 6,
+                fill: true,
+                fillColor: colors.fill,
+                color: colors.stroke,
+                weight: 2,
+                opacity: 1,
+                fillOpacity: 0.8
+            })
+        }
+    });
+    
+    layer.on('click', event => {
+        const properties = event.layer.properties || {};
+        if (properties.count) {
+            map.setView(event.latlng, map.getZoom() + 2);
+            return;
+        }
+        const item = {
+            ...properties,
+            reason: properties.removal_reason,
+            lat: event.latlng.lat,
+            lon: event.latlng.lng
+        };
+        const content = layerType === 'trees' ? createTreePopup(item) : createStumpPopup(item);
+        L.popup().setLatLng(event.latlng).setContent(content).openOn(map);
+    });
+    return layer;
+}
+
+/**
+ * Activar o desactivar el modo de teselas vectoriales
+ * @param {boolean} enabled - Usar teselas vectoriales en lugar de marcadores
+ */
+function setVectorTiles(enabled) {
+    clearMap();
+    vectorTilesEnabled = enabled && typeof L.vectorGrid !== 'undefined';
+    
+    if (vectorTilesEnabled) {
+        // Las capas vectoriales van dentro de los grupos para respetar la leyenda
+        treeLayer.addLayer(createVectorLayer('trees', { fill: '#2d5016', stroke: '#1a3009' }));
+        stumpLayer.addLayer(createVectorLayer('stumps', { fill: '#8b4513', stroke: '#5d2e0a' }));
+    } else {
+        loadData();
     }
 }
 
@@ -500,11 +1133,17 @@ function applyLayerVisibility() {
         if (!map.hasLayer(treeLayer)) {
             map.addLayer(treeLayer);
         }
+        if (!map.hasLayer(clusterLayer)) {
+            map.addLayer(clusterLayer);
+        }
         document.getElementById('legend-trees').classList.remove('hidden');
     } else {
         if (map.hasLayer(treeLayer)) {
             map.removeLayer(treeLayer);
         }
+        if (map.hasLayer(clusterLayer)) {
+            map.removeLayer(clusterLayer);
+        }
         document.getElementById('legend-trees').classList.add('hidden');
     }
     
@@ -564,11 +1203,21 @@ function adjustMapView(trees, stumps) {
  * Limpiar el mapa de todos los marcadores
  */
 function clearMap() {
+    if (statsAbortController) statsAbortController.abort();
+    serverStats = null;
+    clearTiles();
     treeLayer.clearLayers();
     stumpLayer.clearLayers();
+    clusterLayer.clearLayers();
     treeCount = 0;
     stumpCount = 0;
     
+    // Al limpiar el mapa se sale del modo de teselas vectoriales
+    if (vectorTilesEnabled) {
+        vectorTilesEnabled = false;
+        document.getElementById('vectorTiles').checked = false;
+    }
+    
     // Limpiar datos almacenados
     treesData = [];
     stumpsData = [];
@@ -633,9 +1282,11 @@ function toggleLayer(layerType) {
     if (layerType === 'trees') {
         if (layerVisibility[layerType]) {
             map.addLayer(treeLayer);
+            map.addLayer(clusterLayer);
             legendElement.classList.remove('hidden');
         } else {
             map.removeLayer(treeLayer);
+            map.removeLayer(clusterLayer);
             legendElement.classList.add('hidden');
         }
     } else if (layerType === 'stumps') {
@@ -681,10 +1332,37 @@ function onMapMoveEnd() {
     if (autoUpdateEnabled && !isProgrammaticMove) {
         updateBboxFromMap();
         // Cargar datos automáticamente después de actualizar el bbox
-        loadData();
+        scheduleLoadData();
+        sendPrefetchHint();
     }
 }
 
+/**
+ * Avisar al servidor de la próxima vista probable para que la precargue:
+ * la actual desplazada otra vez en la dirección del último movimiento
+ */
+function sendPrefetchHint() {
+    const center = map.getCenter();
+    const previous = lastMapCenter;
+    lastMapCenter = center;
+    if (!previous || vectorTilesEnabled || map.getZoom() < CLUSTER_MAX_ZOOM) return;
+    
+    const dLat = center.lat - previous.lat;
+    const dLon = center.lng - previous.lng;
+    const bounds = map.getBounds();
+    // Un zoom sin desplazamiento no indica hacia dónde seguirá el usuario
+    if (Math.abs(dLat) < (bounds.getNorth() - bounds.getSouth()) / 10 &&
+        Math.abs(dLon) < (bounds.getEast() - bounds.getWest()) / 10) return;
+    
+    const params = new URLSearchParams();
+    params.append('bbox', [
+        bounds.getSouth() + dLat, bounds.getWest() + dLon,
+        bounds.getNorth() + dLat, bounds.getEast() + dLon,
+    ].map(value => value.toFixed(6)).join(','));
+    params.append('layers', 'trees,stumps');
+    fetch('/api/prefetch/', { method: 'POST', body: params, keepalive: true }).catch(() => {});
+}
+
 /**
  * Inicializar el estado de los controles basado en el tamaño de pantalla
  */